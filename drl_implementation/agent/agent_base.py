@@ -1,11 +1,20 @@
 import os
+import time
 import torch as T
+import torch.nn.functional as F
 import numpy as np
 import json
+import copy
+import threading
 from torch.utils.tensorboard import SummaryWriter
 from .utils.plot import smoothed_plot
 from .utils.replay_buffer import make_buffer
-from .utils.normalizer import Normalizer
+from .utils.normalizer import RunningNormalizer, TorchNormalizer
+from .utils.prefetcher import BatchPrefetcher
+from .utils.target_update import soft_update, PolyakAveraging
+from .utils.inference import PolicyInference
+from .utils.vector_env import VectorEnv
+from .utils.evaluation import EvaluationService
 
 
 def mkdir(paths):
@@ -83,7 +92,16 @@ class Agent(object):
         self.goal_conditioned = goal_conditioned
         # prioritised replay
         self.prioritised = algo_params['prioritised']
+        # replay storage backend, see .utils.replay_buffer.make_buffer
+        self.buffer_storage = 'list'
+        if 'buffer_storage' in algo_params.keys():
+            self.buffer_storage = algo_params['buffer_storage']
+        # reopen the memmap buffer of an earlier run in the same path with its transitions
+        buffer_resume = False
+        if 'buffer_resume' in algo_params.keys():
+            buffer_resume = algo_params['buffer_resume']
 
+        self.n_step = 1
         if self.goal_conditioned:
             if self.image_obs:
                 self.goal_dim = 0
@@ -91,6 +109,10 @@ class Agent(object):
             else:
                 self.goal_dim = algo_params['goal_dim']
             self.hindsight = algo_params['hindsight']
+            # relabel goals lazily when sampling rather than storing k relabelled copies of each transition
+            her_relabel_at_sample = False
+            if 'her_relabel_at_sample' in algo_params.keys():
+                her_relabel_at_sample = algo_params['her_relabel_at_sample']
             try:
                 goal_distance_threshold = self.env.env.distance_threshold
             except:
@@ -103,21 +125,43 @@ class Agent(object):
                                       sampling_strategy=algo_params['her_sampling_strategy'],
                                       num_sampled_goal=4,
                                       terminal_on_achieved=algo_params['terminate_on_achieve'],
-                                      goal_distance_threshold=goal_distance_threshold)
+                                      goal_distance_threshold=goal_distance_threshold,
+                                      relabel_at_sample=her_relabel_at_sample, hindsight=self.hindsight,
+                                      storage=self.buffer_storage, saving_path=self.data_path,
+                                      resume=buffer_resume)
         else:
             self.goal_dim = 0
+            # with pixel_buffer, stacked image observations are stored as deduplicated uint8 frames,
+            #       uniform replay in memory only, see .utils.replay_buffer.PixelReplayBuffer
+            pixel_buffer = False
+            if 'pixel_buffer' in algo_params.keys():
+                pixel_buffer = algo_params['pixel_buffer'] and self.image_obs
+            frame_stack = 3
+            if 'frame_stack' in algo_params.keys():
+                frame_stack = algo_params['frame_stack']
+            # store n-step transitions, see .utils.replay_buffer.NStepReplayBuffer
+            if 'n_step' in algo_params.keys():
+                self.n_step = algo_params['n_step']
             self.buffer = make_buffer(mem_capacity=algo_params['memory_capacity'],
                                       transition_tuple=transition_tuple, prioritised=self.prioritised,
                                       seed=seed, rng=self.rng,
+                                      storage=self.buffer_storage, saving_path=self.data_path,
+                                      resume=buffer_resume, image_obs=pixel_buffer, frame_stack=frame_stack,
+                                      n_step=self.n_step, gamma=algo_params['discount_factor'],
+                                      discard_time_limit=algo_params['discard_time_limit'],
                                       goal_conditioned=False)
 
         # common args
+        self.torch_normalizer = None
         if not self.image_obs:
             self.observation_normalization = algo_params['observation_normalization']
             # if not using obs normalization, the normalizer is just a scale multiplier, returns inputs*scale
-            self.normalizer = Normalizer(self.state_dim+self.goal_dim,
-                                         algo_params['init_input_means'], algo_params['init_input_vars'],
-                                         activated=self.observation_normalization)
+            self.normalizer = RunningNormalizer(self.state_dim+self.goal_dim,
+                                                algo_params['init_input_means'], algo_params['init_input_vars'],
+                                                activated=self.observation_normalization)
+            # normalize the learner batches on the device, see .utils.normalizer.TorchNormalizer
+            if ('torch_normalizer' in algo_params.keys()) and algo_params['torch_normalizer']:
+                self.torch_normalizer = TorchNormalizer(self.state_dim+self.goal_dim).to(self.device)
 
         self.actor_learning_rate = algo_params['actor_learning_rate']
         self.critic_learning_rate = algo_params['critic_learning_rate']
@@ -128,6 +172,50 @@ class Agent(object):
         self.discard_time_limit = algo_params['discard_time_limit']
         self.tau = algo_params['tau']
         self.optim_step_count = 0
+        # train the twin critics as one .utils.networks_mlp.CriticEnsemble, for the agents that have them
+        self.fused_critics = False
+        if 'fused_critics' in algo_params.keys():
+            self.fused_critics = algo_params['fused_critics']
+        self.num_critics = 2
+        if 'num_critics' in algo_params.keys():
+            self.num_critics = algo_params['num_critics']
+        # number of batches prepared ahead of the learner by a background thread, 0 samples in the learner itself
+        self.prefetch_batches = 0
+        if 'prefetch_batches' in algo_params.keys():
+            self.prefetch_batches = algo_params['prefetch_batches']
+        self.prefetcher = None
+        # guards the buffer against concurrent storing, sampling and priority updates
+        self.buffer_lock = threading.Lock()
+        # guards the normalizer statistics, updated by the collector while the learner or prefetching thread samples,
+        #       which normalizes its batches with a copy of them, see _normalizer_snapshot()
+        self.normalizer_lock = threading.Lock()
+        self._normalizer_copy = None
+        # collect with a snapshot of the acting network while a learner thread trains, see _collector_step()
+        self.async_learner = False
+        if 'async_learner' in algo_params.keys():
+            self.async_learner = algo_params['async_learner']
+        # learner updates per environment step (per episode for the goal-conditioned agents), as in the synchronous mode
+        self.utd_ratio = self.optimizer_steps if self.goal_conditioned else self.optimizer_steps / self.update_interval
+        if 'utd_ratio' in algo_params.keys():
+            self.utd_ratio = algo_params['utd_ratio']
+        # number of updates the learner can fall behind the ratio before the collector waits
+        self.async_max_lag = 100
+        if 'async_max_lag' in algo_params.keys():
+            self.async_max_lag = algo_params['async_max_lag']
+        # number of learner updates between two snapshots of the acting network
+        self.actor_sync_interval = 20
+        if 'actor_sync_interval' in algo_params.keys():
+            self.actor_sync_interval = algo_params['actor_sync_interval']
+        self.learner_thread = None
+        self.async_condition = threading.Condition()
+        self.async_data = 0
+        self.async_updates = 0
+        self.async_learning_starts = 0
+        self._async_stop = False
+        self._async_error = None
+        self._last_actor_sync = 0
+        self._acting_source_key = None
+        self._staged_episode = []
 
         assert training_mode in ['episode_based', 'step_based']
         self.training_mode = training_mode
@@ -137,6 +225,48 @@ class Agent(object):
         # network dict is filled in each specific agent
         self.network_dict = {}
         self.network_keys_to_save = None
+        # fused target network updates, see _soft_update_networks()
+        self.target_averaging = {}
+        # run the per-step update of the learner (_optimize) through torch.compile, see _learn_step()
+        self.compile_learner = False
+        if 'compile_learner' in algo_params.keys():
+            self.compile_learner = algo_params['compile_learner']
+        self.compile_warmup_steps = 20
+        if 'compile_warmup_steps' in algo_params.keys():
+            self.compile_warmup_steps = algo_params['compile_warmup_steps']
+        assert self.compile_warmup_steps >= 4
+        self.compiled_optimize = None
+        self.compile_report = {}
+        self._compile_step = 0
+        self._compile_timer = None
+        # the agents can step several environments as a batch, see .utils.vector_env.VectorEnv
+        self.vectorized = isinstance(getattr(self, 'env', None), VectorEnv)
+        self.num_envs = self.env.num_envs if self.vectorized else 1
+        # the unfinished episode of each environment of the goal-conditioned agents, see _vectorized_step()
+        self._vectorized_episodes = [[] for _ in range(self.num_envs)]
+        # select the actions of state-based agents through .utils.inference.PolicyInference, see _get_policy_inference()
+        self.fast_inference = False
+        if 'fast_inference' in algo_params.keys():
+            self.fast_inference = algo_params['fast_inference'] and (not self.image_obs)
+        # sets the number of torch threads of the process once, when the inference path is made
+        self.inference_threads = None
+        if 'inference_threads' in algo_params.keys():
+            self.inference_threads = algo_params['inference_threads']
+        self.policy_inference = None
+        # the network that selects the actions, set in each specific agent
+        self.acting_network_key = None
+        # play the test episodes in worker processes while training continues, see _collect_evaluations()
+        self.eval_env_fn = None
+        if ('eval_env_fn' in algo_params.keys()) and (not self.image_obs):
+            self.eval_env_fn = algo_params['eval_env_fn']
+        self.eval_workers = 2
+        if 'eval_workers' in algo_params.keys():
+            self.eval_workers = algo_params['eval_workers']
+        self.eval_seed = seed
+        # made by the first submission of a training run, closed at its end, see _close_evaluation_service()
+        self.evaluation_service = None
+        # the episode or epoch of each evaluation result, in the order of the test statistics
+        self.evaluation_tags = []
 
         # algorithm-specific statistics are defined in each agent sub-class
         self.statistic_dict = {
@@ -151,27 +281,380 @@ class Agent(object):
     def _interact(self, render=False, test=False, sleep=0):
         raise NotImplementedError
 
+    def _interact_vectorized(self, render=False, test=False, sleep=0):
+        # one episode in each environment of a .utils.vector_env.VectorEnv, the finished ones wait for the others
+        obs = self.env.reset()
+        if getattr(self, 'curriculum', False):
+            # each environment follows its own curriculum, _max_episode_steps of the vector env then holds one limit per env
+            max_episode_steps = self.env.get_attr('env.curriculum_goal_step')
+            self.env.set_attr('_max_episode_steps', max_episode_steps)
+            self.env._max_episode_steps = np.array(max_episode_steps)
+        active = np.ones(self.num_envs, dtype=bool)
+        ep_returns = np.zeros(self.num_envs)
+        while active.any():
+            if render:
+                self.env.render()
+            if self.env_step_count < getattr(self, 'warmup_step', 0):
+                actions = np.stack([self.env.action_space.sample() for _ in range(self.num_envs)])
+            else:
+                actions = self._select_action(obs, test=test)
+            new_obs, rewards, dones, infos = self.env.step(actions, active=active)
+            time.sleep(sleep)
+            ep_returns[active] += rewards[active]
+            self._vectorized_step(obs, actions, new_obs, rewards, dones, active, test=test)
+            obs = new_obs
+            active &= ~dones
+        return ep_returns
+
+    def _vectorized_step(self, obs, actions, new_obs, rewards, dones, active, test=False):
+        # stores the transitions of the $active environments and learns, as _interact() does for one environment
+        if test:
+            return
+        if self.goal_conditioned:
+            for i in np.flatnonzero(active):
+                self._vectorized_episodes[i].append((obs['observation'][i], obs['desired_goal'][i], actions[i],
+                                                     new_obs['observation'][i], new_obs['achieved_goal'][i],
+                                                     rewards[i], 1 - int(dones[i])))
+                if dones[i]:
+                    # stored as a whole, so that the episodes of different environments are not interleaved
+                    self._remember_episode(self._vectorized_episodes[i])
+                    self._vectorized_episodes[i] = []
+            if self.observation_normalization:
+                with self.normalizer_lock:
+                    self.normalizer.store_history(np.concatenate((new_obs['observation'][active],
+                                                                  new_obs['achieved_goal'][active]), axis=1))
+            if not (active & ~dones).any():
+                with self.normalizer_lock:
+                    self.normalizer.update_mean()
+                if self.async_learner:
+                    self._collector_step(self.num_envs)
+                else:
+                    # keep the number of updates per episode of the single environment loop
+                    self._learn(steps=self.num_envs * self.optimizer_steps)
+            return
+        self._remember_batch(obs[active], actions[active], new_obs[active], rewards[active],
+                             1 - dones[active].astype(int), streams=np.flatnonzero(active))
+        if self.observation_normalization:
+            with self.normalizer_lock:
+                self.normalizer.store_history(new_obs[active])
+                self.normalizer.update_mean()
+        num_updates = 0
+        for _ in range(active.sum()):
+            if (self.env_step_count % self.update_interval == 0) and (self.env_step_count > self.warmup_step):
+                num_updates += 1
+            self.env_step_count += 1
+        if self.async_learner:
+            self._collector_step(int(active.sum()))
+        elif num_updates > 0:
+            # keep the number of updates per environment step of the single environment loop
+            self._learn(steps=num_updates * self.optimizer_steps)
+
+    def _call_env(self, name, *args):
+        # calls a method of the environment, or of every environment of a vector env
+        if self.vectorized:
+            return self.env.call(name, *args)
+        return getattr(self.env, name)(*args)
+
     def _select_action(self, obs, test=False):
         raise NotImplementedError
 
     def _learn(self, steps=None):
         raise NotImplementedError
 
+    def _optimize(self, *args):
+        # one update of the networks from one batch, defined in the agents that support compile_learner
+        raise NotImplementedError
+
+    def _learn_step(self, *args):
+        """
+        Runs self._optimize(*args), through torch.compile if compile_learner is set.
+        The first $compile_warmup_steps steps run eagerly to time them, the next one compiles the function (dynamic=False,
+            since batches always have the same shapes) and the ones after are timed as well.
+        The timings are then printed and kept in self.compile_report, with the number of steps after which compiling pays off.
+        If a compiled call fails, at compile time or on any later step (e.g., when recompiling for a new batch shape),
+            the step is run again eagerly and so are all the next ones, the error is kept in compile_report['fallback'].
+        """
+        if not self.compile_learner:
+            return self._optimize(*args)
+
+        step = self._compile_step
+        self._compile_step += 1
+        warmup = self.compile_warmup_steps
+        if step < warmup:
+            # eager steps, the first quarter is not timed
+            if step == warmup // 4:
+                self._compile_timer = self._timestamp()
+            out = self._optimize(*args)
+            if step == warmup - 1:
+                self.compile_report['eager_step_time'] = \
+                    (self._timestamp() - self._compile_timer) / (warmup - warmup // 4)
+            return out
+
+        if step == warmup:
+            start = self._timestamp()
+            # every optimizer compiles its own step(), which can exceed the default limit of recompilations
+            for name in ['recompile_limit', 'cache_size_limit']:
+                if hasattr(T._dynamo.config, name):
+                    setattr(T._dynamo.config, name, max(getattr(T._dynamo.config, name), 32))
+                    break
+            self.compiled_optimize = T.compile(self._optimize, dynamic=False)
+            out = self._call_compiled(*args)
+            if self.compile_learner:
+                self.compile_report['compile_time'] = self._timestamp() - start
+            return out
+
+        if step == warmup + 1 + warmup // 4:
+            self._compile_timer = self._timestamp()
+        out = self._call_compiled(*args)
+        if self.compile_learner and step == 2 * warmup:
+            report = self.compile_report
+            report['compiled_step_time'] = (self._timestamp() - self._compile_timer) / (warmup - warmup // 4)
+            report['speedup'] = report['eager_step_time'] / report['compiled_step_time']
+            saving = report['eager_step_time'] - report['compiled_step_time']
+            report['break_even_steps'] = int(np.ceil(report['compile_time'] / saving)) if saving > 0 else None
+            print("Compiled learner: compile time %0.1f s," % report['compile_time'],
+                  "eager step %0.2f ms," % (report['eager_step_time'] * 1000),
+                  "compiled step %0.2f ms," % (report['compiled_step_time'] * 1000),
+                  "speedup %0.2fx," % report['speedup'],
+                  "break-even after %s steps" % report['break_even_steps'])
+        return out
+
+    def _call_compiled(self, *args):
+        # a failed compiled call leaves the learner on eager steps for the rest of the run
+        try:
+            return self.compiled_optimize(*args)
+        except Exception as e:
+            print("torch.compile failed, the learner runs eagerly:", repr(e))
+            self.compile_learner = False
+            self.compiled_optimize = None
+            self.compile_report['fallback'] = repr(e)
+            return self._optimize(*args)
+
+    def _timestamp(self):
+        if self.device.type == 'cuda':
+            T.cuda.synchronize(self.device)
+        return time.perf_counter()
+
     def _remember(self, *args, new_episode=False):
-        if self.goal_conditioned:
-            self.buffer.new_episode = new_episode
-            self.buffer.store_experience(*args)
+        if self.goal_conditioned and self.async_learner:
+            # the episodes are handed over whole by _collector_step(), so the learner never stores a partial one
+            if new_episode:
+                self._staged_episode = []
+            self._staged_episode.append(args)
+            return
+        with self.buffer_lock:
+            if self.goal_conditioned:
+                self.buffer.new_episode = new_episode
+                self.buffer.store_experience(*args)
+            else:
+                self.buffer.store_experience(*args)
+
+    def _remember_batch(self, *columns, streams=None):
+        # stores one transition per row, the rows of n-step buffers go to the windows of $streams (e.g., environments)
+        with self.buffer_lock:
+            if self.n_step > 1:
+                self.buffer.store_stream_experiences(*columns, streams=streams)
+            else:
+                self.buffer.store_experiences(*columns)
+
+    def _remember_episode(self, transitions):
+        # stores the transitions of one whole episode into an episode-wise (e.g., hindsight) buffer
+        with self.buffer_lock:
+            for i, transition in enumerate(transitions):
+                self.buffer.new_episode = (i == 0)
+                self.buffer.store_experience(*transition)
+
+    def _collector_step(self, num_data=1):
+        """
+        Called by the collector in place of _learn() in the asynchronous mode,
+            $num_data is the number of environment steps (episodes for the goal-conditioned agents) since the last call.
+        The learner thread is started on the first call, it then runs self.optimizer_steps updates at a time
+            whenever the update-to-data ratio allows them, and the collector waits here while the learner
+            is more than self.async_max_lag updates behind the ratio.
+        """
+        if len(self._staged_episode) > 0:
+            self._remember_episode(self._staged_episode)
+            self._staged_episode = []
+        if self.learner_thread is None:
+            self._start_async_learner()
+        with self.async_condition:
+            self.async_data += num_data
+            self.async_condition.notify_all()
+            while (self._async_error is None) and (self._due_updates() > self.async_max_lag):
+                self.async_condition.wait()
+        if self._async_error is not None:
+            raise RuntimeError("the learner thread failed") from self._async_error
+
+    def _due_updates(self):
+        return self.utd_ratio * (self.async_data - self.async_learning_starts) - self.async_updates
+
+    def _start_async_learner(self):
+        # the step-based agents only learn after their warmup steps, as in the synchronous mode
+        self.async_learning_starts = getattr(self, 'warmup_step', 0)
+        self._acting_source_key = self.acting_network_key
+        self._sync_acting_snapshot()
+        self.acting_network_key = 'acting_snapshot'
+        self._async_stop = False
+        self.learner_thread = threading.Thread(target=self._async_learn, daemon=True)
+        self.learner_thread.start()
+
+    def _sync_acting_snapshot(self):
+        # the snapshot is replaced as a whole, so the collector never acts with a partially updated network
+        self.network_dict['acting_snapshot'] = copy.deepcopy(self.network_dict[self._acting_source_key])
+        self._last_actor_sync = self.async_updates
+
+    def _async_learn(self):
+        try:
+            while True:
+                with self.async_condition:
+                    while (not self._async_stop) and (self._due_updates() < self.optimizer_steps):
+                        self.async_condition.wait()
+                    if self._async_stop:
+                        return
+                # updates skipped because the buffer is too small are lost, as in the synchronous mode
+                self._learn(steps=self.optimizer_steps)
+                with self.async_condition:
+                    self.async_updates += self.optimizer_steps
+                    self.async_condition.notify_all()
+                if self.async_updates - self._last_actor_sync >= self.actor_sync_interval:
+                    self._sync_acting_snapshot()
+        except Exception as e:
+            # hand the error over to the collector
+            with self.async_condition:
+                self._async_error = e
+                self.async_condition.notify_all()
+
+    def _stop_async_learner(self):
+        # runs the updates that are already due, then stops the learner and acts with the trained network again
+        if self.learner_thread is None:
+            return
+        with self.async_condition:
+            while (self._async_error is None) and (self._due_updates() >= self.optimizer_steps):
+                self.async_condition.wait()
+            self._async_stop = True
+            self.async_condition.notify_all()
+        self.learner_thread.join()
+        self.learner_thread = None
+        self.acting_network_key = self._acting_source_key
+        del self.network_dict['acting_snapshot']
+        if self._async_error is not None:
+            raise RuntimeError("the learner thread failed") from self._async_error
+
+    def _sample_batch(self):
+        # sample a batch and convert it into tensors for the learner
+        with self.buffer_lock:
+            if self.prioritised:
+                batch, weights, inds = self.buffer.sample(self.batch_size)
+            else:
+                batch = self.buffer.sample(self.batch_size)
+                weights, inds = None, None
+
+        if self.image_obs:
+            # uint8 frames are copied to the device before the conversion, the encoders rescale them
+            actor_inputs = T.as_tensor(np.asarray(batch.state), device=self.device).float()
+            actor_inputs_ = T.as_tensor(np.asarray(batch.next_state), device=self.device).float()
+        else:
+            if self.goal_conditioned:
+                actor_inputs = np.concatenate((batch.state, batch.desired_goal), axis=1)
+                actor_inputs_ = np.concatenate((batch.next_state, batch.desired_goal), axis=1)
+            else:
+                actor_inputs = batch.state
+                actor_inputs_ = batch.next_state
+            normalizer = self._normalizer_snapshot()
+            if self.torch_normalizer is None:
+                actor_inputs = T.as_tensor(np.asarray(normalizer(actor_inputs)), dtype=T.float32, device=self.device)
+                actor_inputs_ = T.as_tensor(np.asarray(normalizer(actor_inputs_)), dtype=T.float32, device=self.device)
+            else:
+                if self.torch_normalizer.version != normalizer.version:
+                    self.torch_normalizer.sync(normalizer)
+                # sampled batches are new arrays, so they can be normalized in place
+                actor_inputs = T.as_tensor(np.asarray(actor_inputs), dtype=T.float32, device=self.device)
+                actor_inputs_ = T.as_tensor(np.asarray(actor_inputs_), dtype=T.float32, device=self.device)
+                actor_inputs = self.torch_normalizer(actor_inputs)
+                actor_inputs_ = self.torch_normalizer(actor_inputs_)
+        actions = T.as_tensor(np.asarray(batch.action), dtype=T.float32, device=self.device)
+        rewards = T.as_tensor(np.asarray(batch.reward), dtype=T.float32, device=self.device).view(self.batch_size, 1)
+        if self.discard_time_limit and self.n_step == 1:
+            # n-step buffers store the bootstrap discounts in done instead
+            done = T.ones(size=(self.batch_size, 1), device=self.device)
+        else:
+            done = T.as_tensor(np.asarray(batch.done), dtype=T.float32, device=self.device).view(self.batch_size, 1)
+        if self.prioritised:
+            weights = T.as_tensor(weights, dtype=T.float32, device=self.device).view(self.batch_size, 1)
         else:
-            self.buffer.store_experience(*args)
+            weights = T.ones(size=(self.batch_size, 1), device=self.device)
+        return actor_inputs, actions, actor_inputs_, rewards, done, weights, inds
+
+    def _normalizer_snapshot(self):
+        # a copy of the normalizer taken under normalizer_lock, so that a batch never mixes old and new statistics,
+        #       it is only taken again once the statistics have changed
+        if (self._normalizer_copy is None) or (self._normalizer_copy.version != self.normalizer.version):
+            with self.normalizer_lock:
+                self._normalizer_copy = copy.deepcopy(self.normalizer)
+        return self._normalizer_copy
+
+    def _get_batch(self):
+        # returns a prefetched batch if prefetching is activated, see .utils.prefetcher
+        if self.prefetch_batches == 0:
+            return self._sample_batch()
+        if self.prefetcher is None:
+            self.prefetcher = BatchPrefetcher(self._sample_batch, num_batches=self.prefetch_batches)
+        return self.prefetcher.get()
+
+    def _fused_critic_step(self, critic_inputs, value_target, weights):
+        # one forward pass, backward pass and optimizer step for all the critics, returns the losses of the first one
+        self.critic_optimizer.zero_grad()
+        value_estimates = self.network_dict['critic'](critic_inputs)
+        critic_losses = F.mse_loss(value_estimates, value_target.detach().expand_as(value_estimates), reduction='none')
+        # the sum over critics gives each critic the same gradient as a separate update
+        (critic_losses * weights).mean(dim=(1, 2)).sum().backward()
+        self.critic_optimizer.step()
+        return critic_losses[0]
+
+    def _update_priority(self, inds, critic_loss):
+        with self.buffer_lock:
+            self.buffer.update_priority(inds, np.abs(critic_loss.cpu().detach().numpy()))
+
+    def _close_prefetcher(self):
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def _flush_buffer(self):
+        # writes the transitions still staged or held in n-step windows to the memmap files at the end of a run
+        if self.buffer_storage != 'memmap':
+            return
+        with self.buffer_lock:
+            if self.n_step > 1:
+                self.buffer.flush_windows()
+            self.buffer.flush()
+
+    def _get_policy_inference(self):
+        # built on the first call, when the acting network exists
+        actor = self.network_dict[self.acting_network_key]
+        if self.policy_inference is None:
+            self.policy_inference = PolicyInference(actor, self.normalizer, num_threads=self.inference_threads)
+        elif self.policy_inference.actor is not actor:
+            # e.g., a new snapshot of the asynchronous mode
+            self.policy_inference.set_actor(actor)
+        return self.policy_inference
 
     def _soft_update(self, source, target, tau=None):
         if tau is None:
             tau = self.tau
+        soft_update(list(target.parameters()), list(source.parameters()), tau)
 
-        for target_param, param in zip(target.parameters(), source.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - tau) + param.data * tau
-            )
+    def _soft_update_networks(self, keys, tau=None):
+        # updates the network_dict[key+'_target'] of all keys in one fused call, the pairs are registered on the first call
+        if tau is None:
+            tau = self.tau
+        keys = tuple(keys)
+        if keys not in self.target_averaging.keys():
+            averaging = PolyakAveraging()
+            for key in keys:
+                averaging.register(self.network_dict[key], self.network_dict[key + '_target'])
+            self.target_averaging[keys] = averaging
+        self.target_averaging[keys].update(tau)
 
     def _save_network(self, keys=None, ep=None, step=None):
         if ep is None:
@@ -190,8 +673,10 @@ class Agent(object):
 
     def _load_network(self, keys=None, ep=None, step=None):
         if (not self.image_obs) and self.observation_normalization:
-            self.normalizer.history_mean = np.load(os.path.join(self.data_path, 'input_means.npy'))
-            self.normalizer.history_var = np.load(os.path.join(self.data_path, 'input_vars.npy'))
+            with self.normalizer_lock:
+                self.normalizer.history_mean = np.load(os.path.join(self.data_path, 'input_means.npy'))
+                self.normalizer.history_var = np.load(os.path.join(self.data_path, 'input_vars.npy'))
+                self.normalizer.version += 1
         if ep is None:
             ep = ''
         else:
@@ -206,6 +691,32 @@ class Agent(object):
         for key in keys:
             self.network_dict[key].load_state_dict(T.load(self.ckpt_path+'/ckpt_'+key+ep+step+'.pt', map_location=self.device))
 
+    def _submit_evaluation(self, tag):
+        if self.evaluation_service is None:
+            self.evaluation_service = EvaluationService(self.eval_env_fn, num_workers=self.eval_workers,
+                                                        goal_conditioned=self.goal_conditioned,
+                                                        action_max=self.action_max, seed=self.eval_seed)
+        self.evaluation_service.submit(tag, self.network_dict[self.acting_network_key], self.normalizer,
+                                       self.testing_episodes)
+
+    def _collect_evaluations(self, return_key, success_key=None, success_threshold=None, tag_name='Episode', wait=False):
+        # record the finished evaluations, with $wait, blocks until all the submitted ones are finished
+        if self.evaluation_service is None:
+            return
+        for tag, returns in self.evaluation_service.results(wait=wait):
+            returns = np.array(returns)
+            self.statistic_dict[return_key].append(returns.mean())
+            if success_key is not None:
+                self.statistic_dict[success_key].append(np.mean(returns > success_threshold))
+            self.evaluation_tags.append(tag)
+            print("%s %i" % (tag_name, tag), "test avg. return %0.1f" % returns.mean())
+
+    def _close_evaluation_service(self):
+        # called at the end of a training run, a later run makes a new service
+        if self.evaluation_service is not None:
+            self.evaluation_service.close()
+            self.evaluation_service = None
+
     def _save_statistics(self, keys=None):
         if (not self.image_obs) and self.observation_normalization:
             np.save(os.path.join(self.data_path, 'input_means'), self.normalizer.history_mean)
@@ -221,6 +732,8 @@ class Agent(object):
             else:
                 self.statistic_dict[key] = np.array(self.statistic_dict[key]).tolist()
             json.dump(self.statistic_dict[key], open(os.path.join(self.data_path, key+'.json'), 'w'))
+        if len(self.evaluation_tags) > 0:
+            json.dump(self.evaluation_tags, open(os.path.join(self.data_path, 'evaluation_tags.json'), 'w'))
     
     def _plot_statistics(self, keys=None, x_labels=None, y_labels=None, window=5, save_to_file=True):
         if save_to_file:
@@ -14,7 +14,7 @@ class DDPG(Agent):
         self.env = env
         self.env.seed(seed)
         obs = self.env.reset()
-        algo_params.update({'state_dim': obs.shape[0],
+        algo_params.update({'state_dim': obs.shape[-1],
                             'action_dim': self.env.action_space.shape[0],
                             'action_max': self.env.action_space.high,
                             'action_scaling': self.env.action_space.high[0],
@@ -41,6 +41,7 @@ class DDPG(Agent):
         })
         self.network_keys_to_save = ['actor_target', 'critic_target']
         self.actor_optimizer = Adam(self.network_dict['actor'].parameters(), lr=self.actor_learning_rate)
+        self.acting_network_key = 'actor_target'
         self._soft_update(self.network_dict['actor'], self.network_dict['actor_target'], tau=1)
         self.critic_optimizer = Adam(self.network_dict['critic'].parameters(), lr=self.critic_learning_rate, weight_decay=algo_params['Q_weight_decay'])
         self._soft_update(self.network_dict['critic'], self.network_dict['critic_target'], tau=1)
@@ -66,21 +67,33 @@ class DDPG(Agent):
             print("Start training...")
 
         for ep in range(num_episode):
-            ep_return = self._interact(render, test, sleep=sleep)
+            ep_return = np.mean(self._interact(render, test, sleep=sleep))
             self.statistic_dict['episode_return'].append(ep_return)
             print("Episode %i" % ep, "return %0.1f" % ep_return)
 
             if (ep % self.testing_gap == 0) and (ep != 0) and (not test):
-                ep_test_return = []
-                for test_ep in range(self.testing_episodes):
-                    ep_test_return.append(self._interact(render, test=True))
-                self.statistic_dict['episode_test_return'].append(sum(ep_test_return)/self.testing_episodes)
-                print("Episode %i" % ep, "test return %0.1f" % (sum(ep_test_return)/self.testing_episodes))
+                if self.eval_env_fn is not None:
+                    self._submit_evaluation(ep)
+                else:
+                    ep_test_return = []
+                    for test_ep in range(self.testing_episodes):
+                        ep_test_return.append(np.mean(self._interact(render, test=True)))
+                    self.statistic_dict['episode_test_return'].append(sum(ep_test_return)/self.testing_episodes)
+                    print("Episode %i" % ep, "test return %0.1f" % (sum(ep_test_return)/self.testing_episodes))
+
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('episode_test_return', tag_name='Episode')
 
             if (ep % self.saving_gap == 0) and (ep != 0) and (not test):
                 self._save_network(ep=ep)
 
         if not test:
+            self._stop_async_learner()
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('episode_test_return', tag_name='Episode', wait=True)
+                self._close_evaluation_service()
+            self._close_prefetcher()
+            self._flush_buffer()
             print("Finished training")
             print("Saving statistics...")
             self._plot_statistics(save_to_file=True)
@@ -88,6 +101,8 @@ class DDPG(Agent):
             print("Finished testing")
 
     def _interact(self, render=False, test=False, sleep=0):
+        if self.vectorized:
+            return self._interact_vectorized(render, test, sleep=sleep)
         done = False
         obs = self.env.reset()
         ep_return = 0
@@ -106,19 +121,25 @@ class DDPG(Agent):
             if not test:
                 self._remember(obs, action, new_obs, reward, 1 - int(done))
                 if self.observation_normalization:
-                    self.normalizer.store_history(new_obs)
-                    self.normalizer.update_mean()
-                if (self.env_step_count % self.update_interval == 0) and (self.env_step_count > self.warmup_step):
+                    with self.normalizer_lock:
+                        self.normalizer.store_history(new_obs)
+                        self.normalizer.update_mean()
+                if self.async_learner:
+                    self._collector_step()
+                elif (self.env_step_count % self.update_interval == 0) and (self.env_step_count > self.warmup_step):
                     self._learn()
                 self.env_step_count += 1
             obs = new_obs
         return ep_return
 
     def _select_action(self, obs, test=False):
-        obs = self.normalizer(obs)
-        with T.no_grad():
-            inputs = T.as_tensor(obs, dtype=T.float, device=self.device)
-            action = self.network_dict['actor_target'](inputs).cpu().detach().numpy()
+        if self.fast_inference:
+            action = self._get_policy_inference()(obs)
+        else:
+            obs = self.normalizer(obs)
+            with T.no_grad():
+                inputs = T.as_tensor(obs, dtype=T.float, device=self.device)
+                action = self.network_dict[self.acting_network_key](inputs).cpu().detach().numpy()
         if test:
             # evaluate
             return np.clip(action, -self.action_max, self.action_max)
@@ -133,51 +154,38 @@ class DDPG(Agent):
             steps = self.optimizer_steps
 
         for i in range(steps):
-            if self.prioritised:
-                batch, weights, inds = self.buffer.sample(self.batch_size)
-                weights = T.as_tensor(weights, device=self.device).view(self.batch_size, 1)
-            else:
-                batch = self.buffer.sample(self.batch_size)
-                weights = T.ones(size=(self.batch_size, 1), device=self.device)
-                inds = None
-
-            actor_inputs = np.array(self.normalizer(batch.state))
-            actor_inputs = T.as_tensor(actor_inputs, dtype=T.float32, device=self.device)
-            actions = T.as_tensor(np.array(batch.action), dtype=T.float32, device=self.device)
-            critic_inputs = T.cat((actor_inputs, actions), dim=1)
-            actor_inputs_ = np.array(self.normalizer(batch.next_state))
-            actor_inputs_ = T.as_tensor(np.array(actor_inputs_), dtype=T.float32, device=self.device)
-            rewards = T.as_tensor(np.array(batch.reward), dtype=T.float32, device=self.device).unsqueeze(1)
-            done = T.as_tensor(np.array(batch.done), dtype=T.float32, device=self.device).unsqueeze(1)
-
-            if self.discard_time_limit:
-                done = done * 0 + 1
-
-            with T.no_grad():
-                actions_ = self.network_dict['actor_target'](actor_inputs_)
-                critic_inputs_ = T.cat((actor_inputs_, actions_), dim=1)
-                value_ = self.network_dict['critic_target'](critic_inputs_)
-                value_target = rewards + done * self.gamma * value_
-
-            self.critic_optimizer.zero_grad()
-            value_estimate = self.network_dict['critic'](critic_inputs)
-            critic_loss = F.mse_loss(value_estimate, value_target, reduction='none')
-            (critic_loss * weights).mean().backward()
-            self.critic_optimizer.step()
+            actor_inputs, actions, actor_inputs_, rewards, done, weights, inds = self._get_batch()
+            critic_loss, actor_loss = self._learn_step(actor_inputs, actions, actor_inputs_, rewards, done, weights)
 
             if self.prioritised:
                 assert inds is not None
-                self.buffer.update_priority(inds, np.abs(critic_loss.cpu().detach().numpy()))
+                self._update_priority(inds, critic_loss)
 
-            self.actor_optimizer.zero_grad()
-            new_actions = self.network_dict['actor'](actor_inputs)
-            critic_eval_inputs = T.cat((actor_inputs, new_actions), dim=1).to(self.device)
-            actor_loss = -self.network_dict['critic'](critic_eval_inputs).mean()
-            actor_loss.backward()
-            self.actor_optimizer.step()
+            self.statistic_dict['critic_loss'].append(critic_loss.mean())
+            self.statistic_dict['actor_loss'].append(actor_loss.mean())
 
-            self._soft_update(self.network_dict['actor'], self.network_dict['actor_target'])
-            self._soft_update(self.network_dict['critic'], self.network_dict['critic_target'])
+    def _optimize(self, actor_inputs, actions, actor_inputs_, rewards, done, weights):
+        # one update of the critic, the actor and the target networks, compiled with compile_learner
+        critic_inputs = T.cat((actor_inputs, actions), dim=1)
 
-            self.statistic_dict['critic_loss'].append(critic_loss.detach().mean())
-            self.statistic_dict['actor_loss'].append(actor_loss.detach().mean())
+        with T.no_grad():
+            actions_ = self.network_dict['actor_target'](actor_inputs_)
+            critic_inputs_ = T.cat((actor_inputs_, actions_), dim=1)
+            value_ = self.network_dict['critic_target'](critic_inputs_)
+            value_target = rewards + done * self.gamma * value_
+
+        self.critic_optimizer.zero_grad()
+        value_estimate = self.network_dict['critic'](critic_inputs)
+        critic_loss = F.mse_loss(value_estimate, value_target, reduction='none')
+        (critic_loss * weights).mean().backward()
+        self.critic_optimizer.step()
+
+        self.actor_optimizer.zero_grad()
+        new_actions = self.network_dict['actor'](actor_inputs)
+        critic_eval_inputs = T.cat((actor_inputs, new_actions), dim=1).to(self.device)
+        actor_loss = -self.network_dict['critic'](critic_eval_inputs).mean()
+        actor_loss.backward()
+        self.actor_optimizer.step()
+
+        self._soft_update_networks(['actor', 'critic'])
+        return critic_loss.detach(), actor_loss.detach()
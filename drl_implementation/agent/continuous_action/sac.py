@@ -3,7 +3,7 @@ import numpy as np
 import torch as T
 import torch.nn.functional as F
 from torch.optim.adam import Adam
-from ..utils.networks_mlp import StochasticActor, Critic
+from ..utils.networks_mlp import StochasticActor, Critic, CriticEnsemble
 from ..agent_base import Agent
 
 
@@ -13,7 +13,7 @@ class SAC(Agent):
         self.env = env
         self.env.seed(seed)
         obs = self.env.reset()
-        algo_params.update({'state_dim': obs.shape[0],
+        algo_params.update({'state_dim': obs.shape[-1],
                             'action_dim': self.env.action_space.shape[0],
                             'action_max': self.env.action_space.high,
                             'action_scaling': self.env.action_space.high[0],
@@ -34,19 +34,33 @@ class SAC(Agent):
         # torch
         self.network_dict.update({
             'actor': StochasticActor(self.state_dim, self.action_dim, log_std_min=-6, log_std_max=1, action_scaling=self.action_scaling).to(self.device),
-            'critic_1': Critic(self.state_dim + self.action_dim, 1).to(self.device),
-            'critic_1_target': Critic(self.state_dim + self.action_dim, 1).to(self.device),
-            'critic_2': Critic(self.state_dim + self.action_dim, 1).to(self.device),
-            'critic_2_target': Critic(self.state_dim + self.action_dim, 1).to(self.device),
             'alpha': algo_params['alpha'],
             'log_alpha': T.tensor(np.log(algo_params['alpha']), requires_grad=True, device=self.device),
         })
-        self.network_keys_to_save = ['actor', 'critic_1_target']
         self.actor_optimizer = Adam(self.network_dict['actor'].parameters(), lr=self.actor_learning_rate)
-        self.critic_1_optimizer = Adam(self.network_dict['critic_1'].parameters(), lr=self.critic_learning_rate)
-        self.critic_2_optimizer = Adam(self.network_dict['critic_2'].parameters(), lr=self.critic_learning_rate)
-        self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'], tau=1)
-        self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'], tau=1)
+        self.acting_network_key = 'actor'
+        if self.fused_critics:
+            self.network_dict.update({
+                'critic': CriticEnsemble(self.state_dim + self.action_dim, 1, self.num_critics).to(self.device),
+                'critic_target': CriticEnsemble(self.state_dim + self.action_dim, 1, self.num_critics).to(self.device)
+            })
+            self.critic_keys = ['critic']
+            self.network_keys_to_save = ['actor', 'critic_target']
+            self.critic_optimizer = Adam(self.network_dict['critic'].parameters(), lr=self.critic_learning_rate)
+            self._soft_update(self.network_dict['critic'], self.network_dict['critic_target'], tau=1)
+        else:
+            self.network_dict.update({
+                'critic_1': Critic(self.state_dim + self.action_dim, 1).to(self.device),
+                'critic_1_target': Critic(self.state_dim + self.action_dim, 1).to(self.device),
+                'critic_2': Critic(self.state_dim + self.action_dim, 1).to(self.device),
+                'critic_2_target': Critic(self.state_dim + self.action_dim, 1).to(self.device)
+            })
+            self.critic_keys = ['critic_1', 'critic_2']
+            self.network_keys_to_save = ['actor', 'critic_1_target']
+            self.critic_1_optimizer = Adam(self.network_dict['critic_1'].parameters(), lr=self.critic_learning_rate)
+            self.critic_2_optimizer = Adam(self.network_dict['critic_2'].parameters(), lr=self.critic_learning_rate)
+            self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'], tau=1)
+            self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'], tau=1)
         self.target_entropy = -self.action_dim
         self.alpha_optimizer = Adam([self.network_dict['log_alpha']], lr=self.actor_learning_rate)
         # training args
@@ -73,21 +87,33 @@ class SAC(Agent):
             print("Start training...")
 
         for ep in range(num_episode):
-            ep_return = self._interact(render, test, sleep=sleep)
+            ep_return = np.mean(self._interact(render, test, sleep=sleep))
             self.statistic_dict['episode_return'].append(ep_return)
             print("Episode %i" % ep, "return %0.1f" % ep_return)
 
             if (ep % self.testing_gap == 0) and (ep != 0) and (not test):
-                ep_test_return = []
-                for test_ep in range(self.testing_episodes):
-                    ep_test_return.append(self._interact(render, test=True))
-                self.statistic_dict['episode_test_return'].append(sum(ep_test_return)/self.testing_episodes)
-                print("Episode %i" % ep, "test return %0.1f" % (sum(ep_test_return)/self.testing_episodes))
+                if self.eval_env_fn is not None:
+                    self._submit_evaluation(ep)
+                else:
+                    ep_test_return = []
+                    for test_ep in range(self.testing_episodes):
+                        ep_test_return.append(np.mean(self._interact(render, test=True)))
+                    self.statistic_dict['episode_test_return'].append(sum(ep_test_return)/self.testing_episodes)
+                    print("Episode %i" % ep, "test return %0.1f" % (sum(ep_test_return)/self.testing_episodes))
+
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('episode_test_return', tag_name='Episode')
 
             if (ep % self.saving_gap == 0) and (ep != 0) and (not test):
                 self._save_network(ep=ep)
 
         if not test:
+            self._stop_async_learner()
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('episode_test_return', tag_name='Episode', wait=True)
+                self._close_evaluation_service()
+            self._close_prefetcher()
+            self._flush_buffer()
             print("Finished training")
             print("Saving statistics...")
             self._plot_statistics(save_to_file=True)
@@ -95,6 +121,8 @@ class SAC(Agent):
             print("Finished testing")
 
     def _interact(self, render=False, test=False, sleep=0):
+        if self.vectorized:
+            return self._interact_vectorized(render, test, sleep=sleep)
         done = False
         obs = self.env.reset()
         ep_return = 0
@@ -112,18 +140,23 @@ class SAC(Agent):
             if not test:
                 self._remember(obs, action, new_obs, reward, 1 - int(done))
                 if self.observation_normalization:
-                    self.normalizer.store_history(new_obs)
-                    self.normalizer.update_mean()
-                if (self.env_step_count % self.update_interval == 0) and (self.env_step_count > self.warmup_step):
+                    with self.normalizer_lock:
+                        self.normalizer.store_history(new_obs)
+                        self.normalizer.update_mean()
+                if self.async_learner:
+                    self._collector_step()
+                elif (self.env_step_count % self.update_interval == 0) and (self.env_step_count > self.warmup_step):
                     self._learn()
                 self.env_step_count += 1
             obs = new_obs
         return ep_return
 
     def _select_action(self, obs, test=False):
+        if self.fast_inference:
+            return self._get_policy_inference()(obs, deterministic=test)
         inputs = self.normalizer(obs)
         inputs = T.as_tensor(inputs, dtype=T.float, device=self.device)
-        return self.network_dict['actor'].get_action(inputs, mean_pi=test).detach().cpu().numpy()
+        return self.network_dict[self.acting_network_key].get_action(inputs, mean_pi=test).detach().cpu().numpy()
 
     def _learn(self, steps=None):
         if len(self.buffer) < self.batch_size:
@@ -132,74 +165,79 @@ class SAC(Agent):
             steps = self.optimizer_steps
 
         for i in range(steps):
+            actor_inputs, actions, actor_inputs_, rewards, done, weights, inds = self._get_batch()
+            update_critic_targets = (self.optim_step_count % self.critic_target_update_interval == 0)
+            update_actor = (self.optim_step_count % self.actor_update_interval == 0)
+            critic_loss, actor_loss, policy_entropy = self._learn_step(actor_inputs, actions, actor_inputs_,
+                                                                       rewards, done, weights,
+                                                                       update_critic_targets, update_actor)
+
             if self.prioritised:
-                batch, weights, inds = self.buffer.sample(self.batch_size)
-                weights = T.tensor(weights).view(self.batch_size, 1).to(self.device)
+                assert inds is not None
+                self._update_priority(inds, critic_loss)
+
+            self.statistic_dict['critic_loss'].append(critic_loss.mean())
+            if update_actor:
+                self.statistic_dict['actor_loss'].append(actor_loss.mean())
+                self.statistic_dict['alpha'].append(self.network_dict['alpha'].detach())
+                self.statistic_dict['policy_entropy'].append(policy_entropy)
+
+            self.optim_step_count += 1
+
+    def _optimize(self, actor_inputs, actions, actor_inputs_, rewards, done, weights,
+                  update_critic_targets, update_actor):
+        # one update of the critics and, if asked, of the critic targets, the actor and alpha,
+        #   compiled with compile_learner
+        critic_inputs = T.cat((actor_inputs, actions), dim=1)
+
+        with T.no_grad():
+            actions_, log_probs_ = self.network_dict['actor'].get_action(actor_inputs_, probs=True)
+            critic_inputs_ = T.cat((actor_inputs_, actions_), dim=1)
+            if self.fused_critics:
+                value_ = self.network_dict['critic_target'](critic_inputs_).min(dim=0)[0]
             else:
-                batch = self.buffer.sample(self.batch_size)
-                weights = T.ones(size=(self.batch_size, 1)).to(self.device)
-                inds = None
-
-            actor_inputs = self.normalizer(batch.state)
-            actor_inputs = T.as_tensor(actor_inputs, dtype=T.float32, device=self.device)
-            actions = T.as_tensor(batch.action, dtype=T.float32, device=self.device)
-            critic_inputs = T.cat((actor_inputs, actions), dim=1)
-            actor_inputs_ = self.normalizer(batch.next_state)
-            actor_inputs_ = T.as_tensor(actor_inputs_, dtype=T.float32, device=self.device)
-            rewards = T.as_tensor(batch.reward, dtype=T.float32, device=self.device).unsqueeze(1)
-            done = T.as_tensor(batch.done, dtype=T.float32, device=self.device).unsqueeze(1)
-
-            if self.discard_time_limit:
-                done = done * 0 + 1
-
-            with T.no_grad():
-                actions_, log_probs_ = self.network_dict['actor'].get_action(actor_inputs_, probs=True)
-                critic_inputs_ = T.cat((actor_inputs_, actions_), dim=1)
                 value_1_ = self.network_dict['critic_1_target'](critic_inputs_)
                 value_2_ = self.network_dict['critic_2_target'](critic_inputs_)
-                value_ = T.min(value_1_, value_2_) - (self.network_dict['alpha'] * log_probs_)
-                value_target = rewards + done * self.gamma * value_
+                value_ = T.min(value_1_, value_2_)
+            value_ = value_ - (self.network_dict['alpha'] * log_probs_)
+            value_target = rewards + done * self.gamma * value_
 
+        if self.fused_critics:
+            critic_loss_1 = self._fused_critic_step(critic_inputs, value_target, weights)
+        else:
             self.critic_1_optimizer.zero_grad()
             value_estimate_1 = self.network_dict['critic_1'](critic_inputs)
             critic_loss_1 = F.mse_loss(value_estimate_1, value_target.detach(), reduction='none')
             (critic_loss_1 * weights).mean().backward()
             self.critic_1_optimizer.step()
 
-            if self.prioritised:
-                assert inds is not None
-                self.buffer.update_priority(inds, np.abs(critic_loss_1.cpu().detach().numpy()))
-
             self.critic_2_optimizer.zero_grad()
             value_estimate_2 = self.network_dict['critic_2'](critic_inputs)
             critic_loss_2 = F.mse_loss(value_estimate_2, value_target.detach(), reduction='none')
             (critic_loss_2 * weights).mean().backward()
             self.critic_2_optimizer.step()
 
-            self.statistic_dict['critic_loss'].append(critic_loss_1.detach().mean())
-
-            if self.optim_step_count % self.critic_target_update_interval == 0:
-                self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'])
-                self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'])
+        if update_critic_targets:
+            self._soft_update_networks(self.critic_keys)
 
-            if self.optim_step_count % self.actor_update_interval == 0:
-                self.actor_optimizer.zero_grad()
-                new_actions, new_log_probs = self.network_dict['actor'].get_action(actor_inputs, probs=True)
-                critic_eval_inputs = T.cat((actor_inputs, new_actions), dim=1)
+        actor_loss, policy_entropy = None, None
+        if update_actor:
+            self.actor_optimizer.zero_grad()
+            new_actions, new_log_probs = self.network_dict['actor'].get_action(actor_inputs, probs=True)
+            critic_eval_inputs = T.cat((actor_inputs, new_actions), dim=1)
+            if self.fused_critics:
+                new_values = self.network_dict['critic'](critic_eval_inputs).min(dim=0)[0]
+            else:
                 new_values = T.min(self.network_dict['critic_1'](critic_eval_inputs),
                                    self.network_dict['critic_2'](critic_eval_inputs))
-                actor_loss = (self.network_dict['alpha']*new_log_probs - new_values).mean()
-                actor_loss.backward()
-                self.actor_optimizer.step()
-
-                self.alpha_optimizer.zero_grad()
-                alpha_loss = (self.network_dict['log_alpha'] * (-new_log_probs - self.target_entropy).detach()).mean()
-                alpha_loss.backward()
-                self.alpha_optimizer.step()
-                self.network_dict['alpha'] = self.network_dict['log_alpha'].exp()
-
-                self.statistic_dict['actor_loss'].append(actor_loss.detach().mean())
-                self.statistic_dict['alpha'].append(self.network_dict['alpha'].detach())
-                self.statistic_dict['policy_entropy'].append(-new_log_probs.detach().mean())
-
-            self.optim_step_count += 1
+            actor_loss = (self.network_dict['alpha']*new_log_probs - new_values).mean()
+            actor_loss.backward()
+            self.actor_optimizer.step()
+
+            self.alpha_optimizer.zero_grad()
+            alpha_loss = (self.network_dict['log_alpha'] * (-new_log_probs - self.target_entropy).detach()).mean()
+            alpha_loss.backward()
+            self.alpha_optimizer.step()
+            self.network_dict['alpha'] = self.network_dict['log_alpha'].exp()
+            actor_loss, policy_entropy = actor_loss.detach(), -new_log_probs.detach().mean()
+        return critic_loss_1.detach(), actor_loss, policy_entropy
@@ -3,7 +3,7 @@ import numpy as np
 import torch as T
 import torch.nn.functional as F
 from torch.optim.adam import Adam
-from ..utils.networks_mlp import StochasticActor, Critic
+from ..utils.networks_mlp import StochasticActor, Critic, CriticEnsemble
 from ..agent_base import Agent
 
 
@@ -13,8 +13,8 @@ class GoalConditionedSAC(Agent):
         self.env = env
         self.env.seed(seed)
         obs = self.env.reset()
-        algo_params.update({'state_dim': obs['observation'].shape[0],
-                            'goal_dim': obs['desired_goal'].shape[0],
+        algo_params.update({'state_dim': obs['observation'].shape[-1],
+                            'goal_dim': obs['desired_goal'].shape[-1],
                             'action_dim': self.env.action_space.shape[0],
                             'action_max': self.env.action_space.high,
                             'action_scaling': self.env.action_space.high[0],
@@ -38,19 +38,35 @@ class GoalConditionedSAC(Agent):
         self.network_dict.update({
             'actor': StochasticActor(self.state_dim + self.goal_dim, self.action_dim, log_std_min=-6, log_std_max=1,
                                      action_scaling=self.action_scaling).to(self.device),
-            'critic_1': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device),
-            'critic_1_target': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device),
-            'critic_2': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device),
-            'critic_2_target': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device),
             'alpha': algo_params['alpha'],
             'log_alpha': T.tensor(np.log(algo_params['alpha']), requires_grad=True, device=self.device),
         })
-        self.network_keys_to_save = ['actor', 'critic_1_target']
         self.actor_optimizer = Adam(self.network_dict['actor'].parameters(), lr=self.actor_learning_rate)
-        self.critic_1_optimizer = Adam(self.network_dict['critic_1'].parameters(), lr=self.critic_learning_rate)
-        self.critic_2_optimizer = Adam(self.network_dict['critic_2'].parameters(), lr=self.critic_learning_rate)
-        self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'], tau=1)
-        self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'], tau=1)
+        self.acting_network_key = 'actor'
+        if self.fused_critics:
+            self.network_dict.update({
+                'critic': CriticEnsemble(self.state_dim + self.goal_dim + self.action_dim, 1,
+                                         self.num_critics).to(self.device),
+                'critic_target': CriticEnsemble(self.state_dim + self.goal_dim + self.action_dim, 1,
+                                                self.num_critics).to(self.device)
+            })
+            self.critic_keys = ['critic']
+            self.network_keys_to_save = ['actor', 'critic_target']
+            self.critic_optimizer = Adam(self.network_dict['critic'].parameters(), lr=self.critic_learning_rate)
+            self._soft_update(self.network_dict['critic'], self.network_dict['critic_target'], tau=1)
+        else:
+            self.network_dict.update({
+                'critic_1': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device),
+                'critic_1_target': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device),
+                'critic_2': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device),
+                'critic_2_target': Critic(self.state_dim + self.goal_dim + self.action_dim, 1).to(self.device)
+            })
+            self.critic_keys = ['critic_1', 'critic_2']
+            self.network_keys_to_save = ['actor', 'critic_1_target']
+            self.critic_1_optimizer = Adam(self.network_dict['critic_1'].parameters(), lr=self.critic_learning_rate)
+            self.critic_2_optimizer = Adam(self.network_dict['critic_2'].parameters(), lr=self.critic_learning_rate)
+            self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'], tau=1)
+            self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'], tau=1)
         self.target_entropy = -self.action_dim
         self.alpha_optimizer = Adam([self.network_dict['log_alpha']], lr=self.actor_learning_rate)
         # training args
@@ -83,10 +99,9 @@ class GoalConditionedSAC(Agent):
                 cycle_return = 0
                 cycle_success = 0
                 for ep in range(self.training_episodes):
-                    ep_return = self._interact(render, test, sleep=sleep)
-                    cycle_return += ep_return
-                    if ep_return > -50:
-                        cycle_success += 1
+                    ep_returns = np.atleast_1d(self._interact(render, test, sleep=sleep))
+                    cycle_return += ep_returns.mean()
+                    cycle_success += np.mean(ep_returns > -50)
 
                 self.statistic_dict['cycle_return'].append(cycle_return / self.training_episodes)
                 self.statistic_dict['cycle_success_rate'].append(cycle_success / self.training_episodes)
@@ -95,21 +110,32 @@ class GoalConditionedSAC(Agent):
                       "success rate %0.1f" % (cycle_success / self.training_episodes))
 
             if (epo % self.testing_gap == 0) and (epo != 0) and (not test):
-                test_return = 0
-                test_success = 0
-                for test_ep in range(self.testing_episodes):
-                    ep_test_return = self._interact(render, test=True)
-                    test_return += ep_test_return
-                    if ep_test_return > -50:
-                        test_success += 1
-                self.statistic_dict['epoch_test_return'].append(test_return / self.testing_episodes)
-                self.statistic_dict['epoch_test_success_rate'].append(test_success / self.testing_episodes)
-                print("Epoch %i" % epo, "test avg. return %0.1f" % (test_return / self.testing_episodes))
+                if self.eval_env_fn is not None:
+                    self._submit_evaluation(epo)
+                else:
+                    test_return = 0
+                    test_success = 0
+                    for test_ep in range(self.testing_episodes):
+                        ep_test_returns = np.atleast_1d(self._interact(render, test=True))
+                        test_return += ep_test_returns.mean()
+                        test_success += np.mean(ep_test_returns > -50)
+                    self.statistic_dict['epoch_test_return'].append(test_return / self.testing_episodes)
+                    self.statistic_dict['epoch_test_success_rate'].append(test_success / self.testing_episodes)
+                    print("Epoch %i" % epo, "test avg. return %0.1f" % (test_return / self.testing_episodes))
+
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('epoch_test_return', 'epoch_test_success_rate', -50, tag_name='Epoch')
 
             if (epo % self.saving_gap == 0) and (epo != 0) and (not test):
                 self._save_network(ep=epo)
 
         if not test:
+            self._stop_async_learner()
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('epoch_test_return', 'epoch_test_success_rate', -50, tag_name='Epoch', wait=True)
+                self._close_evaluation_service()
+            self._close_prefetcher()
+            self._flush_buffer()
             print("Finished training")
             print("Saving statistics...")
             self._plot_statistics(
@@ -124,6 +150,8 @@ class GoalConditionedSAC(Agent):
             print("Finished testing")
 
     def _interact(self, render=False, test=False, sleep=0):
+        if self.vectorized:
+            return self._interact_vectorized(render, test, sleep=sleep)
         done = False
         obs = self.env.reset()
         ep_return = 0
@@ -141,26 +169,34 @@ class GoalConditionedSAC(Agent):
                                new_obs['observation'], new_obs['achieved_goal'], reward, 1 - int(done),
                                new_episode=new_episode)
                 if self.observation_normalization:
-                    self.normalizer.store_history(np.concatenate((new_obs['observation'],
-                                                                  new_obs['achieved_goal']), axis=0))
+                    with self.normalizer_lock:
+                        self.normalizer.store_history(np.concatenate((new_obs['observation'],
+                                                                      new_obs['achieved_goal']), axis=0))
             obs = new_obs
             new_episode = False
 
         if not test:
-            self.normalizer.update_mean()
-            self._learn()
+            with self.normalizer_lock:
+                self.normalizer.update_mean()
+            if self.async_learner:
+                self._collector_step()
+            else:
+                self._learn()
         return ep_return
 
     def _select_action(self, obs, test=False):
-        inputs = np.concatenate((obs['observation'], obs['desired_goal']), axis=0)
+        inputs = np.concatenate((obs['observation'], obs['desired_goal']), axis=-1)
+        if self.fast_inference:
+            return self._get_policy_inference()(inputs, deterministic=test)
         inputs = self.normalizer(inputs)
         inputs = T.as_tensor(inputs, dtype=T.float).to(self.device)
-        return self.network_dict['actor'].get_action(inputs, mean_pi=test).detach().cpu().numpy()
+        return self.network_dict[self.acting_network_key].get_action(inputs, mean_pi=test).detach().cpu().numpy()
 
     def _learn(self, steps=None):
-        if self.hindsight:
-            self.buffer.modify_episodes()
-        self.buffer.store_episodes()
+        with self.buffer_lock:
+            if self.hindsight:
+                self.buffer.modify_episodes()
+            self.buffer.store_episodes()
         if len(self.buffer) < self.batch_size:
             return
         if steps is None:
@@ -171,69 +207,56 @@ class GoalConditionedSAC(Agent):
         alphas = T.zeros(1, device=self.device)
         policy_entropies = T.zeros(1, device=self.device)
         for i in range(steps):
-            if self.prioritised:
-                batch, weights, inds = self.buffer.sample(self.batch_size)
-                weights = T.as_tensor(weights, device=self.device).view(self.batch_size, 1)
-            else:
-                batch = self.buffer.sample(self.batch_size)
-                weights = T.ones(size=(self.batch_size, 1), device=self.device)
-                inds = None
-
-            actor_inputs = np.concatenate((batch.state, batch.desired_goal), axis=1)
-            actor_inputs = self.normalizer(actor_inputs)
-            actor_inputs = T.as_tensor(actor_inputs, dtype=T.float32, device=self.device)
-            actions_np = np.array(batch.action)
-            actions = T.as_tensor(actions_np, dtype=T.float32, device=self.device)
+            actor_inputs, actions, actor_inputs_, rewards, done, weights, inds = self._get_batch()
             critic_inputs = T.cat((actor_inputs, actions), dim=1)
-            actor_inputs_ = np.concatenate((batch.next_state, batch.desired_goal), axis=1)
-            actor_inputs_ = self.normalizer(actor_inputs_)
-            actor_inputs_ = T.as_tensor(actor_inputs_, dtype=T.float32, device=self.device)
-            rewards_np = np.array(batch.reward)
-            rewards = T.as_tensor(rewards_np, dtype=T.float32, device=self.device).unsqueeze(1)
-            done_np = np.array(batch.done)
-            done = T.as_tensor(done_np, dtype=T.float32, device=self.device).unsqueeze(1)
-
-            if self.discard_time_limit:
-                done = done * 0 + 1
 
             with T.no_grad():
                 actions_, log_probs_ = self.network_dict['actor'].get_action(actor_inputs_, probs=True)
                 critic_inputs_ = T.cat((actor_inputs_, actions_), dim=1)
-                value_1_ = self.network_dict['critic_1_target'](critic_inputs_)
-                value_2_ = self.network_dict['critic_2_target'](critic_inputs_)
-                value_ = T.min(value_1_, value_2_) - (self.network_dict['alpha'] * log_probs_)
+                if self.fused_critics:
+                    value_ = self.network_dict['critic_target'](critic_inputs_).min(dim=0)[0]
+                else:
+                    value_1_ = self.network_dict['critic_1_target'](critic_inputs_)
+                    value_2_ = self.network_dict['critic_2_target'](critic_inputs_)
+                    value_ = T.min(value_1_, value_2_)
+                value_ = value_ - (self.network_dict['alpha'] * log_probs_)
                 value_target = rewards + done * self.gamma * value_
                 value_target = T.clamp(value_target, -self.clip_value, 0.0)
 
-            self.critic_1_optimizer.zero_grad()
-            value_estimate_1 = self.network_dict['critic_1'](critic_inputs)
-            critic_loss_1 = F.mse_loss(value_estimate_1, value_target.detach(), reduction='none')
-            (critic_loss_1 * weights).mean().backward()
-            self.critic_1_optimizer.step()
+            if self.fused_critics:
+                critic_loss_1 = self._fused_critic_step(critic_inputs, value_target, weights)
+            else:
+                self.critic_1_optimizer.zero_grad()
+                value_estimate_1 = self.network_dict['critic_1'](critic_inputs)
+                critic_loss_1 = F.mse_loss(value_estimate_1, value_target.detach(), reduction='none')
+                (critic_loss_1 * weights).mean().backward()
+                self.critic_1_optimizer.step()
+
+                self.critic_2_optimizer.zero_grad()
+                value_estimate_2 = self.network_dict['critic_2'](critic_inputs)
+                critic_loss_2 = F.mse_loss(value_estimate_2, value_target.detach(), reduction='none')
+                (critic_loss_2 * weights).mean().backward()
+                self.critic_2_optimizer.step()
 
             if self.prioritised:
                 assert inds is not None
-                self.buffer.update_priority(inds, np.abs(critic_loss_1.cpu().detach().numpy()))
-
-            self.critic_2_optimizer.zero_grad()
-            value_estimate_2 = self.network_dict['critic_2'](critic_inputs)
-            critic_loss_2 = F.mse_loss(value_estimate_2, value_target.detach(), reduction='none')
-            (critic_loss_2 * weights).mean().backward()
-            self.critic_2_optimizer.step()
+                self._update_priority(inds, critic_loss_1)
 
             critic_losses += critic_loss_1.detach().mean()
 
             if self.optim_step_count % self.critic_target_update_interval == 0:
-                self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'])
-                self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'])
+                self._soft_update_networks(self.critic_keys)
 
             if self.optim_step_count % self.actor_update_interval == 0:
                 self.actor_optimizer.zero_grad()
                 new_actions, new_log_probs, entropy = self.network_dict['actor'].get_action(actor_inputs, probs=True,
                                                                                             entropy=True)
                 critic_eval_inputs = T.cat((actor_inputs, new_actions), dim=1).to(self.device)
-                new_values = T.min(self.network_dict['critic_1'](critic_eval_inputs),
-                                   self.network_dict['critic_2'](critic_eval_inputs))
+                if self.fused_critics:
+                    new_values = self.network_dict['critic'](critic_eval_inputs).min(dim=0)[0]
+                else:
+                    new_values = T.min(self.network_dict['critic_1'](critic_eval_inputs),
+                                       self.network_dict['critic_2'](critic_eval_inputs))
                 actor_loss = (self.network_dict['alpha'] * new_log_probs - new_values).mean()
                 actor_loss.backward()
                 self.actor_optimizer.step()
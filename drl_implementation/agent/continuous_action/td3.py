@@ -3,7 +3,7 @@ import numpy as np
 import torch as T
 import torch.nn.functional as F
 from torch.optim.adam import Adam
-from ..utils.networks_mlp import Actor, Critic
+from ..utils.networks_mlp import Actor, Critic, CriticEnsemble
 from ..agent_base import Agent
 from ..utils.exploration_strategy import GaussianNoise
 
@@ -14,7 +14,7 @@ class TD3(Agent):
         self.env = env
         self.env.seed(seed)
         obs = self.env.reset()
-        algo_params.update({'state_dim': obs.shape[0],
+        algo_params.update({'state_dim': obs.shape[-1],
                             'action_dim': self.env.action_space.shape[0],
                             'action_max': self.env.action_space.high,
                             'action_scaling': self.env.action_space.high[0],
@@ -35,19 +35,33 @@ class TD3(Agent):
         # torch
         self.network_dict.update({
             'actor': Actor(self.state_dim, self.action_dim, action_scaling=self.action_scaling).to(self.device),
-            'actor_target': Actor(self.state_dim, self.action_dim, action_scaling=self.action_scaling).to(self.device),
-            'critic_1': Critic(self.state_dim + self.action_dim, 1).to(self.device),
-            'critic_1_target': Critic(self.state_dim + self.action_dim, 1).to(self.device),
-            'critic_2': Critic(self.state_dim + self.action_dim, 1).to(self.device),
-            'critic_2_target': Critic(self.state_dim + self.action_dim, 1).to(self.device)
+            'actor_target': Actor(self.state_dim, self.action_dim, action_scaling=self.action_scaling).to(self.device)
         })
-        self.network_keys_to_save = ['actor_target', 'critic_1_target']
         self.actor_optimizer = Adam(self.network_dict['actor'].parameters(), lr=self.actor_learning_rate)
+        self.acting_network_key = 'actor_target'
         self._soft_update(self.network_dict['actor'], self.network_dict['actor_target'], tau=1)
-        self.critic_1_optimizer = Adam(self.network_dict['critic_1'].parameters(), lr=self.critic_learning_rate)
-        self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'], tau=1)
-        self.critic_2_optimizer = Adam(self.network_dict['critic_2'].parameters(), lr=self.critic_learning_rate)
-        self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'], tau=1)
+        if self.fused_critics:
+            self.network_dict.update({
+                'critic': CriticEnsemble(self.state_dim + self.action_dim, 1, self.num_critics).to(self.device),
+                'critic_target': CriticEnsemble(self.state_dim + self.action_dim, 1, self.num_critics).to(self.device)
+            })
+            self.critic_keys = ['critic']
+            self.network_keys_to_save = ['actor_target', 'critic_target']
+            self.critic_optimizer = Adam(self.network_dict['critic'].parameters(), lr=self.critic_learning_rate)
+            self._soft_update(self.network_dict['critic'], self.network_dict['critic_target'], tau=1)
+        else:
+            self.network_dict.update({
+                'critic_1': Critic(self.state_dim + self.action_dim, 1).to(self.device),
+                'critic_1_target': Critic(self.state_dim + self.action_dim, 1).to(self.device),
+                'critic_2': Critic(self.state_dim + self.action_dim, 1).to(self.device),
+                'critic_2_target': Critic(self.state_dim + self.action_dim, 1).to(self.device)
+            })
+            self.critic_keys = ['critic_1', 'critic_2']
+            self.network_keys_to_save = ['actor_target', 'critic_1_target']
+            self.critic_1_optimizer = Adam(self.network_dict['critic_1'].parameters(), lr=self.critic_learning_rate)
+            self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'], tau=1)
+            self.critic_2_optimizer = Adam(self.network_dict['critic_2'].parameters(), lr=self.critic_learning_rate)
+            self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'], tau=1)
         # behavioural policy args (exploration)
         self.exploration_strategy = GaussianNoise(self.action_dim, self.action_max, mu=0, sigma=0.1)
         # training args
@@ -73,21 +87,33 @@ class TD3(Agent):
             print("Start training...")
 
         for ep in range(num_episode):
-            ep_return = self._interact(render, test, sleep=sleep)
+            ep_return = np.mean(self._interact(render, test, sleep=sleep))
             self.statistic_dict['episode_return'].append(ep_return)
             print("Episode %i" % ep, "return %0.1f" % ep_return)
 
             if (ep % self.testing_gap == 0) and (ep != 0) and (not test):
-                ep_test_return = []
-                for test_ep in range(self.testing_episodes):
-                    ep_test_return.append(self._interact(render, test=True))
-                self.statistic_dict['episode_test_return'].append(sum(ep_test_return)/self.testing_episodes)
-                print("Episode %i" % ep, "test return %0.1f" % (sum(ep_test_return)/self.testing_episodes))
+                if self.eval_env_fn is not None:
+                    self._submit_evaluation(ep)
+                else:
+                    ep_test_return = []
+                    for test_ep in range(self.testing_episodes):
+                        ep_test_return.append(np.mean(self._interact(render, test=True)))
+                    self.statistic_dict['episode_test_return'].append(sum(ep_test_return)/self.testing_episodes)
+                    print("Episode %i" % ep, "test return %0.1f" % (sum(ep_test_return)/self.testing_episodes))
+
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('episode_test_return', tag_name='Episode')
 
             if (ep % self.saving_gap == 0) and (ep != 0) and (not test):
                 self._save_network(ep=ep)
 
         if not test:
+            self._stop_async_learner()
+            if self.eval_env_fn is not None:
+                self._collect_evaluations('episode_test_return', tag_name='Episode', wait=True)
+                self._close_evaluation_service()
+            self._close_prefetcher()
+            self._flush_buffer()
             print("Finished training")
             print("Saving statistics...")
             self._plot_statistics(save_to_file=True)
@@ -95,6 +121,8 @@ class TD3(Agent):
             print("Finished testing")
 
     def _interact(self, render=False, test=False, sleep=0):
+        if self.vectorized:
+            return self._interact_vectorized(render, test, sleep=sleep)
         done = False
         obs = self.env.reset()
         ep_return = 0
@@ -112,19 +140,31 @@ class TD3(Agent):
             if not test:
                 self._remember(obs, action, new_obs, reward, 1 - int(done))
                 if self.observation_normalization:
-                    self.normalizer.store_history(new_obs)
-                    self.normalizer.update_mean()
-                if (self.env_step_count % self.update_interval == 0) and (self.env_step_count > self.warmup_step):
+                    with self.normalizer_lock:
+                        self.normalizer.store_history(new_obs)
+                        self.normalizer.update_mean()
+                if self.async_learner:
+                    self._collector_step()
+                elif (self.env_step_count % self.update_interval == 0) and (self.env_step_count > self.warmup_step):
                     self._learn()
             obs = new_obs
             self.env_step_count += 1
         return ep_return
 
+    def _vectorized_step(self, obs, actions, new_obs, rewards, dones, active, test=False):
+        super(TD3, self)._vectorized_step(obs, actions, new_obs, rewards, dones, active, test=test)
+        if test:
+            # the test steps are counted as well, as in _interact()
+            self.env_step_count += int(active.sum())
+
     def _select_action(self, obs, test=False):
-        obs = self.normalizer(obs)
-        with T.no_grad():
-            inputs = T.as_tensor(obs, dtype=T.float, device=self.device)
-            action = self.network_dict['actor_target'](inputs).detach().cpu().numpy()
+        if self.fast_inference:
+            action = self._get_policy_inference()(obs)
+        else:
+            obs = self.normalizer(obs)
+            with T.no_grad():
+                inputs = T.as_tensor(obs, dtype=T.float, device=self.device)
+                action = self.network_dict[self.acting_network_key](inputs).detach().cpu().numpy()
         if test:
             # evaluate
             return np.clip(action, -self.action_max, self.action_max)
@@ -139,68 +179,69 @@ class TD3(Agent):
             steps = self.optimizer_steps
 
         for i in range(steps):
+            actor_inputs, actions, actor_inputs_, rewards, done, weights, inds = self._get_batch()
+            update_actor = (self.optim_step_count % self.actor_update_interval == 0)
+            critic_loss, actor_loss = self._learn_step(actor_inputs, actions, actor_inputs_, rewards, done, weights,
+                                                       update_actor)
+
             if self.prioritised:
-                batch, weights, inds = self.buffer.sample(self.batch_size)
-                weights = T.as_tensor(weights, device=self.device).view(self.batch_size, 1)
-            else:
-                batch = self.buffer.sample(self.batch_size)
-                weights = T.ones(size=(self.batch_size, 1), device=self.device)
-                inds = None
-
-            actor_inputs = self.normalizer(batch.state)
-            actor_inputs = T.as_tensor(actor_inputs, dtype=T.float32, device=self.device)
-            actions = T.as_tensor(batch.action, dtype=T.float32, device=self.device)
-            critic_inputs = T.cat((actor_inputs, actions), dim=1)
-            actor_inputs_ = self.normalizer(batch.next_state)
-            actor_inputs_ = T.as_tensor(actor_inputs_, dtype=T.float32, device=self.device)
-            rewards = T.as_tensor(batch.reward, dtype=T.float32, device=self.device).unsqueeze(1)
-            done = T.as_tensor(batch.done, dtype=T.float32, device=self.device).unsqueeze(1)
-
-            if self.discard_time_limit:
-                done = done * 0 + 1
+                assert inds is not None
+                self._update_priority(inds, critic_loss)
 
-            with T.no_grad():
-                actions_ = self.network_dict['actor_target'](actor_inputs_)
-                # add noise
-                noise = (T.randn_like(actions_, device=self.device) * self.target_noise)
-                actions_ += noise.clamp(-self.noise_clip, self.noise_clip)
-                actions_ = actions_.clamp(-self.action_max[0], self.action_max[0])
-                critic_inputs_ = T.cat((actor_inputs_, actions_), dim=1)
+            self.statistic_dict['critic_loss'].append(critic_loss.mean())
+            if update_actor:
+                self.statistic_dict['actor_loss'].append(actor_loss.mean())
+
+            self.optim_step_count += 1
+
+    def _optimize(self, actor_inputs, actions, actor_inputs_, rewards, done, weights, update_actor):
+        # one update of the critics and, if update_actor, of the actor and the target networks,
+        #   compiled with compile_learner
+        critic_inputs = T.cat((actor_inputs, actions), dim=1)
+
+        with T.no_grad():
+            actions_ = self.network_dict['actor_target'](actor_inputs_)
+            # add noise
+            noise = (T.randn_like(actions_, device=self.device) * self.target_noise)
+            actions_ += noise.clamp(-self.noise_clip, self.noise_clip)
+            actions_ = actions_.clamp(-self.action_max[0], self.action_max[0])
+            critic_inputs_ = T.cat((actor_inputs_, actions_), dim=1)
+            if self.fused_critics:
+                value_ = self.network_dict['critic_target'](critic_inputs_).min(dim=0)[0]
+            else:
                 value_1_ = self.network_dict['critic_1_target'](critic_inputs_)
                 value_2_ = self.network_dict['critic_2_target'](critic_inputs_)
                 value_ = T.min(value_1_, value_2_)
-                value_target = rewards + done * self.gamma * value_
+            value_target = rewards + done * self.gamma * value_
 
+        if self.fused_critics:
+            critic_loss_1 = self._fused_critic_step(critic_inputs, value_target, weights)
+        else:
             self.critic_1_optimizer.zero_grad()
             value_estimate_1 = self.network_dict['critic_1'](critic_inputs)
             critic_loss_1 = F.mse_loss(value_estimate_1, value_target.detach(), reduction='none')
             (critic_loss_1 * weights).mean().backward()
             self.critic_1_optimizer.step()
 
-            if self.prioritised:
-                assert inds is not None
-                self.buffer.update_priority(inds, np.abs(critic_loss_1.cpu().detach().numpy()))
-
             self.critic_2_optimizer.zero_grad()
             value_estimate_2 = self.network_dict['critic_2'](critic_inputs)
             critic_loss_2 = F.mse_loss(value_estimate_2, value_target.detach(), reduction='none')
             (critic_loss_2 * weights).mean().backward()
             self.critic_2_optimizer.step()
 
-            self.statistic_dict['critic_loss'].append(critic_loss_1.detach().mean())
-
-            if self.optim_step_count % self.actor_update_interval == 0:
-                self.actor_optimizer.zero_grad()
-                new_actions = self.network_dict['actor'](actor_inputs)
-                critic_eval_inputs = T.cat((actor_inputs, new_actions), dim=1)
-                actor_loss = -self.network_dict['critic_1'](critic_eval_inputs).mean()
-                actor_loss.backward()
-                self.actor_optimizer.step()
-
-                self._soft_update(self.network_dict['actor'], self.network_dict['actor_target'])
-                self._soft_update(self.network_dict['critic_1'], self.network_dict['critic_1_target'])
-                self._soft_update(self.network_dict['critic_2'], self.network_dict['critic_2_target'])
-
-                self.statistic_dict['actor_loss'].append(actor_loss.detach().mean())
-
-            self.optim_step_count += 1
+        actor_loss = None
+        if update_actor:
+            self.actor_optimizer.zero_grad()
+            new_actions = self.network_dict['actor'](actor_inputs)
+            critic_eval_inputs = T.cat((actor_inputs, new_actions), dim=1)
+            if self.fused_critics:
+                new_values = self.network_dict['critic'](critic_eval_inputs)[0]
+            else:
+                new_values = self.network_dict['critic_1'](critic_eval_inputs)
+            actor_loss = -new_values.mean()
+            actor_loss.backward()
+            self.actor_optimizer.step()
+
+            self._soft_update_networks(['actor'] + self.critic_keys)
+            actor_loss = actor_loss.detach()
+        return critic_loss_1.detach(), actor_loss
@@ -1,15 +1,17 @@
 import os
-import time
 import torch as T
 import numpy as np
 import json
 import queue
+import threading
 import importlib
 import multiprocessing as mp
 from collections import namedtuple
 from .utils.plot import smoothed_plot
-from .utils.replay_buffer import ReplayBuffer, PrioritisedReplayBuffer
-from .utils.normalizer import Normalizer
+from .utils.replay_buffer import ArrayReplayBuffer, PrioritisedArrayReplayBuffer
+from .utils.normalizer import RunningNormalizer
+from .utils.target_update import soft_update
+from .utils.shared_buffers import SharedParameterStore, SharedBatchRing
 # T.multiprocessing.set_start_method('spawn')
 t = namedtuple("transition", ('state', 'action', 'next_state', 'reward', 'done'))
 
@@ -56,9 +58,9 @@ class Agent(object):
             # todo: observation in distributed training should be synced as well
             self.observation_normalization = algo_params['observation_normalization']
             # if not using obs normalization, the normalizer is just a scale multiplier, returns inputs*scale
-            self.normalizer = Normalizer(self.state_dim,
-                                         algo_params['init_input_means'], algo_params['init_input_vars'],
-                                         activated=self.observation_normalization)
+            self.normalizer = RunningNormalizer(self.state_dim,
+                                                algo_params['init_input_means'], algo_params['init_input_vars'],
+                                                activated=self.observation_normalization)
 
         self.gamma = algo_params['discount_factor']
         self.tau = algo_params['tau']
@@ -79,15 +81,11 @@ class Agent(object):
             tau = self.tau
 
         if not from_params:
-            for target_param, param in zip(target.parameters(), source.parameters()):
-                target_param.data.copy_(
-                    target_param.data * (1.0 - tau) + param.data * tau
-                )
+            sources = list(source.parameters())
         else:
-            for target_param, param in zip(target.parameters(), source):
-                target_param.data.copy_(
-                    target_param.data * (1.0 - tau) + T.tensor(param).float().to(self.device) * tau
-                )
+            # arrays or tensors of parameters, e.g., from the parameter store
+            sources = [T.as_tensor(param, dtype=T.float32, device=self.device) for param in source]
+        soft_update(list(target.parameters()), sources, tau)
 
     def _save_network(self, keys=None, ep=None):
         if ep is None:
@@ -177,6 +175,20 @@ class Worker(Agent):
         self.worker_id = i
         self.worker_update_gap = algo_params['worker_update_gap']  # in episodes
         self.env_step_count = 0
+        self.learner_steps = algo_params['learner_steps']
+        # transitions are sent to the replay process in chunks of fixed size, see _remember()
+        self.chunk_size = 64
+        if 'worker_chunk_size' in algo_params.keys():
+            self.chunk_size = algo_params['worker_chunk_size']
+        # 'block': wait for room in the replay queue, 'drop': discard the chunk if the queue is full
+        self.replay_queue_policy = 'block'
+        if 'replay_queue_policy' in algo_params.keys():
+            self.replay_queue_policy = algo_params['replay_queue_policy']
+        assert self.replay_queue_policy in ['block', 'drop']
+        self.chunk = None
+        self.chunk_priorities = None
+        self.chunk_length = 0
+        self.dropped_transitions = 0
         super(Worker, self).__init__(algo_params, path=path, seed=seed)
 
     def run(self, render=False, test=False, load_network_ep=None, sleep=0):
@@ -189,19 +201,71 @@ class Worker(Agent):
         raise NotImplementedError
 
     def _remember(self, batch):
-        try:
-            self.queues['replay_queue'].put_nowait(batch)
-        except queue.Full:
-            pass
+        # $batch: the fields of a transition, or a dict of a 'transition' and its 'priority'
+        priority = None
+        if isinstance(batch, dict):
+            priority = batch['priority']
+            batch = batch['transition']
+        if self.chunk is None:
+            # new arrays for every chunk, as the queue pickles a chunk after put() returns
+            self.chunk = [np.empty((self.chunk_size,) + np.shape(field), dtype=np.asarray(field).dtype)
+                          for field in batch]
+            self.chunk_priorities = np.zeros(self.chunk_size)
+        for column, field in zip(self.chunk, batch):
+            column[self.chunk_length] = field
+        if priority is not None:
+            self.chunk_priorities[self.chunk_length] = priority
+        self.chunk_length += 1
+        if self.chunk_length == self.chunk_size:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        # sends the transitions remembered so far, also called when the worker finishes
+        if self.chunk_length == 0:
+            return
+        chunk = ([column[:self.chunk_length] for column in self.chunk], self.chunk_priorities[:self.chunk_length])
+        num_transitions = self.chunk_length
+        self.chunk = None
+        self.chunk_length = 0
+        if self.replay_queue_policy == 'drop':
+            try:
+                self.queues['replay_queue'].put_nowait(chunk)
+                sent = True
+            except queue.Full:
+                sent = False
+        else:
+            # backpressure: wait for the replay process, unless it has stopped consuming
+            sent = False
+            while not sent:
+                try:
+                    self.queues['replay_queue'].put(chunk, timeout=1.0)
+                    sent = True
+                except queue.Full:
+                    if self.queues['learner_step_count'].value >= self.learner_steps:
+                        break
+        if sent:
+            with self.queues['sent_transitions'].get_lock():
+                self.queues['sent_transitions'].value += num_transitions
+        else:
+            self.dropped_transitions += num_transitions
+            with self.queues['dropped_transitions'].get_lock():
+                self.queues['dropped_transitions'].value += num_transitions
 
     def _download_actor_networks(self, keys, tau=1.0):
-        try:
-            source = self.queues['network_queue'].get_nowait()
-        except queue.Empty:
+        # the flat parameter vector is only copied when the learner has uploaded a new version
+        sizes = [param.numel() for key in keys for param in self.network_dict[key].parameters()]
+        flat_params = self.queues['parameter_store'].read(sizes=sizes)
+        if flat_params is None:
             return False
         print("Worker No. %i downloading network" % self.worker_id)
+        flat_params = T.as_tensor(flat_params, device=self.device)
+        offset = 0
         for key in keys:
-            self._soft_update(source[key], self.network_dict[key], tau=tau, from_params=True)
+            source = []
+            for param in self.network_dict[key].parameters():
+                source.append(flat_params[offset:offset + param.numel()].view_as(param))
+                offset += param.numel()
+            self._soft_update(source, self.network_dict[key], tau=tau, from_params=True)
         return True
 
 
@@ -226,21 +290,125 @@ class Learner(Agent):
     def _learn(self, steps=None):
         raise NotImplementedError
 
+    def _get_batch(self, timeout=None):
+        # the columns of a batch of the replay process copied to the device, None if no batch is ready in time,
+        #       its slot of the batch ring is given back to the replay process by the copy, see SharedBatchRing.take()
+        return self.queues['batch_ring'].take(self.device, timeout=timeout)
+
     def _upload_learner_networks(self, keys):
         print("Learner uploading network")
-        params = dict.fromkeys(keys)
-        for key in keys:
-            params[key] = [p.data.cpu().detach().numpy() for p in self.network_dict[key].parameters()]
-        # delete an old net and upload a new one
-        try:
-            data = self.queues['network_queue'].get_nowait()
-            del data
-        except queue.Empty:
-            pass
+        # the parameters of the networks are written as one flat vector, in the order of the keys,
+        #       overwriting the previous version, see .utils.shared_buffers.SharedParameterStore
+        self.queues['parameter_store'].write(p for key in keys for p in self.network_dict[key].parameters())
+
+
+class ReplayServer(object):
+    """
+    Serves the replay buffer of the distributed agents in the replay process, with three threads sharing it under a lock:
+        the ingest thread stores the chunks of the workers, the priority thread applies the updates of the learner,
+        and the sampler thread keeps the $ready_batches slots of the batch ring filled with sampled batches.
+    Each thread blocks on its queue (or on the buffer being large enough) instead of polling,
+        the $timeout of the waits only bounds the time taken to stop once the learner has finished.
+    After that, the ingest thread keeps storing the chunks of the workers until each of the $num_workers
+        has sent None, so that no sent transition is discarded, or until none has arrived for $shutdown_timeout seconds.
+    """
+    def __init__(self, buffer, queues, batch_size, learner_steps, num_workers=0, prioritised=False,
+                 store_with_given_priority=False, timeout=0.1, shutdown_timeout=30.0):
+        self.buffer = buffer
+        self.queues = queues
+        self.batch_size = batch_size
+        self.learner_steps = learner_steps
+        self.num_workers = num_workers
+        self.shutdown_timeout = shutdown_timeout
+        self.prioritised = prioritised
+        self.store_with_given_priority = store_with_given_priority
+        self.timeout = timeout
+        self.ring = queues['batch_ring']
+        self.ready_batches = self.ring.num_slots
+        self.buffer_lock = threading.Lock()
+        # set once the buffer holds a batch
+        self.buffer_filled = threading.Event()
+        self.stop_event = threading.Event()
+        self.error = None
+
+    def run(self):
+        targets = [self._ingest, self._sample]
+        if self.prioritised:
+            targets.append(self._update_priorities)
+        threads = [threading.Thread(target=self._serve, args=(target,), daemon=True) for target in targets]
+        for thread in threads:
+            thread.start()
+        while not self.stop_event.wait(self.timeout):
+            if self.queues['learner_step_count'].value >= self.learner_steps:
+                self.stop_event.set()
+        for thread in threads:
+            thread.join()
+        self.ring.close()
+        if self.error is not None:
+            raise RuntimeError("a replay server thread failed") from self.error
+
+    def _serve(self, target):
+        # the first error stops all the threads, it is raised by run()
         try:
-            self.queues['network_queue'].put(params)
-        except queue.Full:
-            pass
+            target()
+        except BaseException as e:
+            self.error = e
+            self.stop_event.set()
+
+    def _ingest(self):
+        finished_workers = 0
+        idle_time = 0.0
+        while finished_workers < self.num_workers or (not self.stop_event.is_set()):
+            try:
+                chunk = self.queues['replay_queue'].get(timeout=self.timeout)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    idle_time += self.timeout
+                    if (self.error is not None) or (idle_time >= self.shutdown_timeout):
+                        break
+                continue
+            idle_time = 0.0
+            if chunk is None:
+                finished_workers += 1
+                continue
+            columns, priorities = chunk
+            # one bulk write of a chunk of transitions, into the buffer and its priority trees
+            with self.buffer_lock:
+                if self.prioritised and self.store_with_given_priority:
+                    self.buffer.store_experiences(*columns, priorities=priorities)
+                else:
+                    self.buffer.store_experiences(*columns)
+                if len(self.buffer) >= self.batch_size:
+                    self.buffer_filled.set()
+
+    def _update_priorities(self):
+        while not self.stop_event.is_set():
+            try:
+                inds, priorities = self.queues['priority_queue'].get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            with self.buffer_lock:
+                self.buffer.update_priority(inds, priorities)
+
+    def _sample(self):
+        while not self.stop_event.is_set():
+            if not self.buffer_filled.wait(self.timeout):
+                continue
+            # wait for the learner to release a slot before sampling
+            slot = self.ring.acquire(timeout=self.timeout)
+            if slot is None:
+                continue
+            with self.buffer_lock:
+                if self.prioritised:
+                    batch, weights, inds = self.buffer.sample(batch_size=self.batch_size)
+                    batch = tuple(batch) + (weights, inds)
+                else:
+                    batch = self.buffer.sample(batch_size=self.batch_size)
+            # the sampled rows are copied into the slot outside the lock
+            views = self.ring.views(slot)
+            for name, column in zip(self.ring.columns, batch):
+                views[name][:] = column
+            self.ring.commit(slot)
 
 
 class CentralProcessor(object):
@@ -270,12 +438,33 @@ class CentralProcessor(object):
         # create a random number generator and seed it
         self.rng = np.random.default_rng(seed=0)
 
+        # the sampled batches are written into preallocated shared-memory slots, of the shapes of the env,
+        #       see .utils.shared_buffers.SharedBatchRing
+        env = self.env_source.make(self.env_name)
+        obs = np.asarray(env.reset())
+        action_shape = env.action_space.shape
+        env.close()
+        # non-image states are sent as float32, the precision of the learner
+        state_dtype = obs.dtype if obs.dtype == np.uint8 else np.float32
+        batch_columns = [('state', obs.shape, state_dtype), ('action', action_shape, np.float32),
+                         ('next_state', obs.shape, state_dtype), ('reward', (), np.float32), ('done', (), np.float32)]
+        if algo_params['prioritised']:
+            batch_columns += [('weights', (), np.float32), ('inds', (), np.int64)]
+
+        # number of sampled batches kept ready for the learner, see ReplayServer
+        ready_batches = algo_params['batch_queue_size']
+        if 'ready_batches' in algo_params.keys():
+            ready_batches = algo_params['ready_batches']
+
         # multiprocessing queues
         self.queues = {
             'replay_queue': mp.Queue(maxsize=algo_params['replay_queue_size']),
-            'batch_queue': mp.Queue(maxsize=algo_params['batch_queue_size']),
-            'network_queue': T.multiprocessing.Queue(maxsize=self.num_workers),
+            'batch_ring': SharedBatchRing(ready_batches, self.batch_size, batch_columns),
+            'parameter_store': SharedParameterStore(),
             'learner_step_count': mp.Value('i', 0),
+            # number of transitions sent by the workers and dropped when the replay queue was full (counted in chunks)
+            'sent_transitions': mp.Value('q', 0),
+            'dropped_transitions': mp.Value('q', 0),
             'global_episode_count': mp.Value('i', 0),
         }
 
@@ -283,17 +472,18 @@ class CentralProcessor(object):
         # prioritised replay
         self.prioritised = algo_params['prioritised']
         self.store_with_given_priority = algo_params['store_with_given_priority']
-        # non-goal-conditioned replay buffer
+        # non-goal-conditioned replay buffer, array-backed so that a chunk of the workers is stored
+        #       with one or two slice copies per field, see ReplayServer
         tr = transition_tuple
         if transition_tuple is None:
             tr = t
         if not self.prioritised:
-            self.buffer = ReplayBuffer(algo_params['memory_capacity'], tr, seed=seed)
+            self.buffer = ArrayReplayBuffer(algo_params['memory_capacity'], tr, seed=seed)
         else:
             self.queues.update({
                 'priority_queue': mp.Queue(maxsize=algo_params['priority_queue_size'])
             })
-            self.buffer = PrioritisedReplayBuffer(algo_params['memory_capacity'], tr, rng=self.rng)
+            self.buffer = PrioritisedArrayReplayBuffer(algo_params['memory_capacity'], tr, rng=self.rng)
 
     def run(self):
         def worker_process(i, seed):
@@ -301,7 +491,10 @@ class CentralProcessor(object):
             path = os.path.join(self.path, "worker_%i" % i)
             worker = self.worker(self.algo_params, env, self.queues, path=path, seed=seed, i=i)
             worker.run()
-            self.empty_queue('replay_queue')
+            worker._flush_chunk()
+            # tells the replay server that this worker will send no more chunks
+            self.queues['replay_queue'].put(None)
+            self.queues['parameter_store'].close()
 
         def learner_process():
             env = self.env_source.make(self.env_name)
@@ -310,45 +503,14 @@ class CentralProcessor(object):
             learner.run()
             if self.prioritised:
                 self.empty_queue('priority_queue')
-            self.empty_queue('network_queue')
+            # unlinks the parameter segment, the workers that have attached keep their mapping
+            self.queues['parameter_store'].close()
 
         def update_buffer():
-            while self.queues['learner_step_count'].value < self.learner_steps:
-                num_transitions_in_queue = self.queues['replay_queue'].qsize()
-                for n in range(num_transitions_in_queue):
-                    data = self.queues['replay_queue'].get()
-                    if self.prioritised:
-                        if self.store_with_given_priority:
-                            self.buffer.store_experience_with_given_priority(data['priority'], *data['transition'])
-                        else:
-                            self.buffer.store_experience(*data)
-                    else:
-                        self.buffer.store_experience(*data)
-                if self.batch_size > len(self.buffer):
-                    continue
-
-                if self.prioritised:
-                    try:
-                        inds, priorities = self.queues['priority_queue'].get_nowait()
-                        self.buffer.update_priority(inds, priorities)
-                    except queue.Empty:
-                        pass
-                    try:
-                        batch, weights, inds = self.buffer.sample(batch_size=self.batch_size)
-                        state, action, next_state, reward, done = batch
-                        self.queues['batch_queue'].put_nowait((state, action, next_state, reward, done, weights, inds))
-                    except queue.Full:
-                        continue
-                else:
-                    try:
-                        batch = self.buffer.sample(batch_size=self.batch_size)
-                        state, action, next_state, reward, done = batch
-                        self.queues['batch_queue'].put_nowait((state, action, next_state, reward, done))
-                    except queue.Full:
-                        time.sleep(0.1)
-                        continue
-
-            self.empty_queue('batch_queue')
+            server = ReplayServer(self.buffer, self.queues, self.batch_size, self.learner_steps,
+                                  num_workers=self.num_workers, prioritised=self.prioritised,
+                                  store_with_given_priority=self.store_with_given_priority)
+            server.run()
 
         processes = []
         p = T.multiprocessing.Process(target=update_buffer)
@@ -364,6 +526,8 @@ class CentralProcessor(object):
             p.start()
         for p in processes:
             p.join()
+        print("Transitions sent by the workers: %i, dropped: %i" % (self.queues['sent_transitions'].value,
+                                                                   self.queues['dropped_transitions'].value))
 
     def empty_queue(self, queue_name):
         while True:
@@ -34,11 +34,13 @@ class FrameStack(gym.Wrapper):
 
 
 class PixelPybulletGym(gym.Wrapper):
-    def __init__(self, env, image_size, crop_size, channel_first=True):
+    def __init__(self, env, image_size, crop_size, channel_first=True, uint8_obs=False):
         gym.Wrapper.__init__(self, env)
         self.image_size = image_size
         self.crop_size = crop_size
         self.channel_first = channel_first
+        # return uint8 images instead of the float64 ones from skimage resize, see .replay_buffer.PixelReplayBuffer
+        self.uint8_obs = uint8_obs
         self.vertical_boundary = int((env.env._render_height - self.crop_size) / 2)
         self.horizontal_boundary = int((env.env._render_width - self.crop_size) / 2)
         self._max_episode_steps = env._max_episode_steps
@@ -56,6 +58,8 @@ class PixelPybulletGym(gym.Wrapper):
         obs = self.render(mode="rgb_array")
         obs = obs[self.vertical_boundary:-self.vertical_boundary, self.horizontal_boundary:-self.horizontal_boundary, :]
         obs = resize(obs, (self.image_size, self.image_size))
+        if self.uint8_obs:
+            obs = np.round(obs * 255).astype(np.uint8)
         if self.channel_first:
             obs = obs.transpose((-1, 0, 1))
         return obs
@@ -0,0 +1,86 @@
+import copy
+import multiprocessing as mp
+import numpy as np
+import torch as T
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from .networks_mlp import StochasticActor
+
+# the environment of each worker process, made once by _init_worker()
+_worker_env = None
+
+
+def _init_worker(env_fn):
+    global _worker_env
+    T.set_num_threads(1)
+    _worker_env = env_fn()
+
+
+def _play_episodes(actor, normalizer, num_episodes, goal_conditioned, action_max, seed):
+    # the test-time action selection of the agents: clipped actions of an Actor, tanh(mean) of a StochasticActor
+    env = _worker_env
+    env.seed(seed)
+    returns = []
+    for _ in range(num_episodes):
+        obs = env.reset()
+        done = False
+        ep_return = 0
+        while not done:
+            if goal_conditioned:
+                inputs = np.concatenate((obs['observation'], obs['desired_goal']), axis=-1)
+            else:
+                inputs = obs
+            inputs = T.as_tensor(normalizer(inputs), dtype=T.float)
+            with T.no_grad():
+                if isinstance(actor, StochasticActor):
+                    action = actor.get_action(inputs, mean_pi=True).numpy()
+                else:
+                    action = np.clip(actor(inputs).numpy(), -action_max, action_max)
+            obs, reward, done, info = env.step(action)
+            ep_return += reward
+        returns.append(ep_return)
+    return returns
+
+
+class EvaluationService(object):
+    """
+    Plays test episodes in a pool of $num_workers processes, each with its own environment made by $env_fn,
+        which must be picklable for the 'spawn' and 'forkserver' start methods (e.g., a module-level function).
+    submit() sends CPU copies of an actor and a normalizer and returns at once, the episodes being split across the workers,
+        so that training can continue while they are played.
+    results() returns the (tag, episode returns) of the finished submissions, in submission order.
+    """
+    def __init__(self, env_fn, num_workers=2, goal_conditioned=False, action_max=1, seed=0, start_method=None):
+        self.num_workers = num_workers
+        self.goal_conditioned = goal_conditioned
+        self.action_max = action_max
+        self.rng = np.random.default_rng(seed=seed)
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context(start_method),
+                                            initializer=_init_worker, initargs=(env_fn,))
+        self.pending = deque()
+
+    def submit(self, tag, actor, normalizer, num_episodes):
+        actor = copy.deepcopy(actor).cpu()
+        normalizer = copy.deepcopy(normalizer)
+        chunks = [len(inds) for inds in np.array_split(np.arange(num_episodes), self.num_workers) if len(inds) > 0]
+        futures = [self.executor.submit(_play_episodes, actor, normalizer, chunk, self.goal_conditioned,
+                                        self.action_max, int(self.rng.integers(2 ** 31)))
+                   for chunk in chunks]
+        self.pending.append((tag, futures))
+
+    def results(self, wait=False):
+        # with $wait, blocks until all the submissions are finished
+        finished = []
+        while len(self.pending) > 0:
+            tag, futures = self.pending[0]
+            if (not wait) and (not all(future.done() for future in futures)):
+                break
+            returns = []
+            for future in futures:
+                returns += future.result()
+            finished.append((tag, returns))
+            self.pending.popleft()
+        return finished
+
+    def close(self):
+        self.executor.shutdown(wait=True)
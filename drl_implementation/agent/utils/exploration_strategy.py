@@ -74,7 +74,7 @@ class OUNoise(object):
 
     def __call__(self, action):
         x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * self.rng.standard_normal(len(x))
+        dx = self.theta * (self.mu - x) + self.sigma * self.rng.standard_normal(np.shape(action))
         self.state = x + dx
         return np.clip(action + self.state, -self.action_max, self.action_max)
 
@@ -93,7 +93,8 @@ class GaussianNoise(object):
         self.sigma = sigma
 
     def __call__(self, action):
-        noise = self.scale*self.rng.normal(loc=self.mu, scale=self.sigma, size=(self.action_dim,))
+        # $action can be a batch of actions, e.g., one per environment of a vector env
+        noise = self.scale*self.rng.normal(loc=self.mu, scale=self.sigma, size=np.shape(action))
         return np.clip(action + noise, -self.action_max, self.action_max)
 
 
@@ -112,6 +113,12 @@ class EGreedyGaussian(object):
             self.rng = rng
 
     def __call__(self, action):
+        if np.ndim(action) > 1:
+            # a batch of actions, e.g., one per environment of a vector env
+            random = self.rng.uniform(0, 1, size=np.shape(action)[:-1] + (1,)) < self.chance
+            noise = self.scale*self.rng.normal(loc=self.mu, scale=self.sigma, size=np.shape(action))
+            return np.where(random, self.rng.uniform(-self.action_max, self.action_max, size=np.shape(action)),
+                            np.clip(action + noise, -self.action_max, self.action_max))
         chance = self.rng.uniform(0, 1)
         if chance < self.chance:
             return self.rng.uniform(-self.action_max, self.action_max, size=(self.action_dim,))
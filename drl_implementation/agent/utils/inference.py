@@ -0,0 +1,124 @@
+import time
+import numpy as np
+import torch as T
+from .networks_mlp import Actor, StochasticActor
+
+
+class PolicyInference(object):
+    """
+    A low-latency path for selecting the action of a single observation with an Actor or a StochasticActor on the CPU,
+        small batches (e.g., one observation per environment of a vector env) are supported as well.
+    The layers are copied into plain CPU tensors and run under torch.inference_mode with addmm into preallocated buffers.
+    The inputs are normalized in a preallocated array with the current statistics of the normalizer, read on every call,
+        as the statistics change with nearly every environment step while the actor does not.
+    The layers are too small for the intra-op thread pool to matter, which is left as it is,
+        unless $num_threads is given: it is then set once here, for the whole process (torch.set_num_threads).
+    The copies are only refreshed when the parameters of the actor (their in-place version counters) have changed.
+    The latency of every call is counted in a histogram of log-spaced bins, see latency_histogram().
+    """
+    def __init__(self, actor, normalizer, num_threads=None, latency_bins=None):
+        self.normalizer = normalizer
+        if num_threads is not None:
+            T.set_num_threads(num_threads)
+        self.set_actor(actor)
+        self._allocate(1)
+
+        if latency_bins is None:
+            # 1 us to 1 s
+            latency_bins = np.logspace(-6, 0, 61)
+        self.latency_bins = latency_bins
+        self.latency_counts = np.zeros(len(latency_bins) + 1, dtype=np.int64)
+
+    def set_actor(self, actor):
+        # the weights are copied again on the next call
+        assert isinstance(actor, (Actor, StochasticActor))
+        self.actor = actor
+        self.stochastic = isinstance(actor, StochasticActor)
+        self.params = list(actor.parameters())
+        if self.stochastic:
+            self.layers = [actor.fc1, actor.fc2, actor.fc3, actor.mean, actor.log_std]
+        else:
+            self.layers = [actor.fc1, actor.fc2, actor.fc3, actor.pi]
+        self.weights = None
+        self.signature = None
+
+    def _allocate(self, batch_size):
+        self.inputs = T.zeros(batch_size, self.layers[0].in_features)
+        self.inputs_np = self.inputs.numpy()
+        self.std = np.zeros(self.layers[0].in_features)
+        self.buffers = [T.zeros(batch_size, layer.out_features) for layer in self.layers]
+        self.outputs_np = self.buffers[3].numpy()
+        if self.stochastic:
+            self.noise = T.zeros(batch_size, self.actor.action_dim)
+
+    def _signature(self):
+        # version counters only increase, so their sum changes whenever one of them does
+        return sum(param._version for param in self.params)
+
+    def refresh(self):
+        with T.no_grad():
+            self.weights = [(layer.weight.detach().t().to('cpu', copy=True).contiguous(),
+                             layer.bias.detach().to('cpu', copy=True).view(1, -1)) for layer in self.layers]
+        self.signature = self._signature()
+
+    def _normalize(self, obs):
+        # writes normalizer(obs) into the input buffer, without allocating
+        normalizer = self.normalizer
+        if normalizer.activated:
+            np.subtract(obs, normalizer.history_mean, out=self.inputs_np)
+            np.add(normalizer.history_var, normalizer.epsilon, out=self.std)
+            np.divide(self.inputs_np, self.std, out=self.inputs_np)
+            np.clip(self.inputs_np, normalizer.input_clip_range[0], normalizer.input_clip_range[1], out=self.inputs_np)
+        else:
+            self.inputs_np[:] = obs
+        if normalizer.scale_factor != 1:
+            self.inputs_np *= normalizer.scale_factor
+
+    def __call__(self, obs, deterministic=False):
+        """
+        Returns the action(s) as a numpy array, deterministic only matters for a StochasticActor,
+            for which it returns tanh(mean) like StochasticActor.get_action(mean_pi=True).
+        """
+        start = time.perf_counter()
+        if self._signature() != self.signature:
+            self.refresh()
+
+        obs = np.asarray(obs)
+        batch_size = 1 if obs.ndim == 1 else obs.shape[0]
+        if batch_size != self.inputs.shape[0]:
+            self._allocate(batch_size)
+        self._normalize(obs)
+        with T.inference_mode():
+            x = self.inputs
+            for (weight, bias), buffer in zip(self.weights[:3], self.buffers[:3]):
+                T.addmm(bias, x, weight, out=buffer)
+                x = buffer.relu_()
+            weight, bias = self.weights[3]
+            out = T.addmm(bias, x, weight, out=self.buffers[3])
+            if not self.stochastic:
+                out.tanh_().mul_(self.actor.action_scaling)
+            elif deterministic:
+                out.tanh_()
+            else:
+                weight, bias = self.weights[4]
+                std = T.addmm(bias, x, weight, out=self.buffers[4])
+                std.clamp_(self.actor.log_std_min, self.actor.log_std_max).exp_()
+                out.addcmul_(self.noise.normal_(), std).tanh_().mul_(self.actor.action_scaling)
+        action = self.outputs_np[0].copy() if obs.ndim == 1 else self.outputs_np.copy()
+        self.latency_counts[np.searchsorted(self.latency_bins, time.perf_counter() - start)] += 1
+        return action
+
+    def latency_histogram(self):
+        """
+        Returns the call counts and the bin edges in seconds,
+            counts[0] is below edges[0], counts[i] is in [edges[i-1], edges[i]) and counts[-1] is above edges[-1].
+        """
+        return self.latency_counts.copy(), self.latency_bins.copy()
+
+    def latency_percentile(self, q):
+        # upper bin edge of the q-th percentile (0-100) of the latencies, in seconds
+        counts = np.cumsum(self.latency_counts)
+        if counts[-1] == 0:
+            return None
+        ind = int(np.searchsorted(counts, q / 100 * counts[-1]))
+        return self.latency_bins[min(ind, len(self.latency_bins) - 1)]
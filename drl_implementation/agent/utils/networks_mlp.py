@@ -105,6 +105,39 @@ class Critic(nn.Module):
         return T.argmax(values).item()
 
 
+class CriticEnsemble(nn.Module):
+    """
+    $num_critics critics of the same architecture as Critic, with their weights stacked along a leading dimension.
+    All the critics are evaluated together by one batched matmul per layer,
+        so they are trained with one forward pass, one backward pass and one optimizer.
+    Inputs of shape (batch, input_dim) are given to every critic, inputs of shape (num_critics, batch, input_dim) are split,
+        the outputs have the shape (num_critics, batch, output_dim).
+    """
+    def __init__(self, input_dim, output_dim, num_critics=2, fc1_size=256, fc2_size=256, fc3_size=256):
+        super(CriticEnsemble, self).__init__()
+        self.num_critics = num_critics
+        sizes = [input_dim, fc1_size, fc2_size, fc3_size, output_dim]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for in_size, out_size in zip(sizes[:-1], sizes[1:]):
+            weight = T.empty(num_critics, in_size, out_size)
+            for i in range(num_critics):
+                # same initialisation as orthogonal_init on a (out_size, in_size) nn.Linear weight
+                weight[i] = nn.init.orthogonal_(T.empty(out_size, in_size)).t()
+            self.weights.append(nn.Parameter(weight))
+            self.biases.append(nn.Parameter(T.zeros(num_critics, 1, out_size)))
+
+    def forward(self, inputs):
+        x = inputs
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(self.num_critics, -1, -1)
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = T.baddbmm(bias, x, weight)
+            if i < len(self.weights) - 1:
+                x = F.relu(x)
+        return x
+
+
 def orthogonal_init(m):
     if isinstance(m, nn.Linear):
         nn.init.orthogonal_(m.weight.data)
@@ -1,4 +1,6 @@
 import numpy as np
+import torch as T
+import torch.nn as nn
 
 
 class Normalizer(object):
@@ -21,6 +23,8 @@ class Normalizer(object):
             clip_range = 1e3
         self.input_clip_range = (-clip_range*np.ones(self.input_dims), clip_range*np.ones(self.input_dims))
         self.scale_factor = scale_factor
+        # incremented whenever the statistics change, see TorchNormalizer
+        self.version = 0
 
     def store_history(self, *args):
         self.history.append(*args)
@@ -44,6 +48,7 @@ class Normalizer(object):
 
         self.sample_count += new_sample_num
         self.history.clear()
+        self.version += 1
 
     # pre-process inputs, currently using max-min-normalization
     def __call__(self, inputs):
@@ -51,3 +56,104 @@ class Normalizer(object):
             inputs = (inputs - self.history_mean) / (self.history_var+self.epsilon)
             inputs = np.clip(inputs, self.input_clip_range[0], self.input_clip_range[1])
         return self.scale_factor*inputs
+
+
+class RunningNormalizer(Normalizer):
+    """
+    A drop-in replacement for Normalizer that keeps running statistics instead of a history list.
+    The sample count, mean and sum of squared deviations (M2) are merged in place with every new batch,
+        using the parallel formula of Chan et al.: http://i.stanford.edu/pub/cstr/reports/cs/tr/79/773/CS-TR-79-773.pdf
+    As in Normalizer, history_var holds the standard deviation, which is also what gets saved as input_vars.npy.
+    """
+    def __init__(self, input_dims, init_mean, init_var,
+                 scale_factor=1, epsilon=1e-3, clip_range=None, activated=False):
+        Normalizer.__init__(self, input_dims, init_mean, init_var,
+                            scale_factor=scale_factor, epsilon=epsilon, clip_range=clip_range, activated=activated)
+        self.history = None
+        self.history_mean = np.array(self.history_mean, dtype=float)
+        self.history_var = np.array(self.history_var, dtype=float)
+        self.m2 = np.zeros(self.input_dims)
+
+    def update(self, batch):
+        # batch: an array of one or more inputs, of shape (..., input_dims)
+        batch = np.asarray(batch, dtype=float).reshape(-1, self.input_dims)
+        batch_count = batch.shape[0]
+        if batch_count == 0:
+            return
+        batch_mean = batch.mean(axis=0)
+        batch_m2 = np.square(batch - batch_mean).sum(axis=0)
+
+        total_count = self.sample_count + batch_count
+        delta = batch_mean - self.history_mean
+        self.history_mean += delta * (batch_count / total_count)
+        self.m2 += batch_m2 + np.square(delta) * (self.sample_count * batch_count / total_count)
+        self.sample_count = total_count
+        np.sqrt(self.m2 / total_count, out=self.history_var)
+        self.version += 1
+
+    def store_history(self, *args):
+        self.update(*args)
+
+    def update_mean(self):
+        # the statistics are updated by store_history() already
+        pass
+
+
+class TorchNormalizer(nn.Module):
+    """
+    The torch counterpart of Normalizer, keeping the statistics as buffers on the device of the learner.
+    Raw batches are moved to the device once and normalized in place, sync() copies the statistics of a numpy normalizer
+        and only needs to be called when its version has changed.
+    Only the first $input_dims features are normalized, so observations concatenated with actions can be passed as well.
+    """
+    def __init__(self, input_dims):
+        super(TorchNormalizer, self).__init__()
+        self.input_dims = input_dims
+        self.register_buffer('mean', T.zeros(input_dims))
+        self.register_buffer('inv_std', T.ones(input_dims))
+        self.register_buffer('clip_low', -1e3 * T.ones(input_dims))
+        self.register_buffer('clip_high', 1e3 * T.ones(input_dims))
+        self.activated = False
+        self.scale_factor = 1
+        self.version = -1
+
+    def sync(self, normalizer):
+        with T.no_grad():
+            self.mean.copy_(T.as_tensor(normalizer.history_mean))
+            self.inv_std.copy_(T.as_tensor(1 / (normalizer.history_var + normalizer.epsilon)))
+            self.clip_low.copy_(T.as_tensor(normalizer.input_clip_range[0]))
+            self.clip_high.copy_(T.as_tensor(normalizer.input_clip_range[1]))
+        self.activated = normalizer.activated
+        self.scale_factor = normalizer.scale_factor
+        self.version = normalizer.version
+
+    def forward(self, inputs):
+        # normalizes inputs in place and returns them
+        x = inputs[..., :self.input_dims]
+        if self.activated:
+            x.sub_(self.mean).mul_(self.inv_std).clamp_(min=self.clip_low, max=self.clip_high)
+        if self.scale_factor != 1:
+            x.mul_(self.scale_factor)
+        return inputs
+
+    def fold_into(self, linear):
+        """
+        Returns a copy of $linear, the first layer of e.g. an Actor or a Critic, that takes raw inputs,
+            W x' + b with x' = (x - mean) * inv_std * scale becomes (W * inv_std * scale) x + (b - W (mean * inv_std * scale)).
+        This is exact as long as the inputs do not hit the clip range.
+        """
+        folded = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight.device)
+        with T.no_grad():
+            weight = linear.weight.detach().clone()
+            bias = linear.bias.detach().clone() if linear.bias is not None else T.zeros_like(folded.bias)
+            if self.activated:
+                scale = self.inv_std * self.scale_factor
+                shift = self.mean * scale
+            else:
+                scale = T.full_like(self.mean, self.scale_factor)
+                shift = T.zeros_like(self.mean)
+            bias -= weight[:, :self.input_dims] @ shift
+            weight[:, :self.input_dims] *= scale
+            folded.weight.copy_(weight)
+            folded.bias.copy_(bias)
+        return folded
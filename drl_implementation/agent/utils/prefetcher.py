@@ -0,0 +1,54 @@
+import queue
+import threading
+
+
+class BatchPrefetcher(object):
+    """
+    Prepares training batches on a background thread.
+    The thread keeps calling $sample_fn, which should return a batch ready for the learner (e.g., tensors on the device),
+        and puts the results in a queue of $num_batches slots, blocking whenever the queue is full.
+    Sampling and collation thus overlap with the gradient steps of the learner instead of preceding each of them.
+    Batches are up to $num_batches steps older than the buffer content and normalizer statistics at consumption time.
+    """
+    def __init__(self, sample_fn, num_batches=2):
+        assert num_batches > 0
+        self.sample_fn = sample_fn
+        self.queue = queue.Queue(maxsize=num_batches)
+        self._stop = threading.Event()
+        self._error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                batch = self.sample_fn()
+                while not self._stop.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            # hand the error over to the consumer
+            self._error = e
+            self._stop.set()
+
+    def get(self):
+        while True:
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._error is not None:
+                    raise RuntimeError("the prefetching thread failed") from self._error
+                if not self.thread.is_alive():
+                    raise RuntimeError("the prefetching thread has been closed")
+
+    def close(self):
+        self._stop.set()
+        self.thread.join()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
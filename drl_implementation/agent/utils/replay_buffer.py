@@ -1,7 +1,37 @@
+import os
+import json
 import random as R
 import numpy as np
 from .segment_tree import SumSegmentTree, MinSegmentTree
-from collections import namedtuple
+from .replay_dataset import save_dataset, load_dataset
+from collections import namedtuple, deque
+
+
+def array_layout(capacity, arg):
+    # the shape and dtype of the array storing a transition field, floating-point fields are stored as float32
+    arg = np.asarray(arg)
+    dtype = np.float32 if np.issubdtype(arg.dtype, np.floating) else arg.dtype
+    return (capacity,) + arg.shape, np.dtype(dtype)
+
+
+def store_rows(memory, capacity, position, rows):
+    """
+    Writes a list of transitions into a list used as a circular buffer of $capacity, starting at $position,
+        with at most two slice assignments.
+    Returns the storage positions of the transitions that are kept (the last $capacity ones) and the next position.
+    """
+    num = len(rows)
+    if num >= capacity:
+        # the buffer only holds the last $capacity rows, the oldest of them at the next position
+        position = (position + num) % capacity
+        rows = rows[num - capacity:]
+        memory[:] = rows[capacity - position:] + rows[:capacity - position]
+        return (position + np.arange(capacity)) % capacity, position
+    # the list grows by slicing past its end until it is full, position is then its length
+    first = min(num, capacity - position)
+    memory[position:position + first] = rows[:first]
+    memory[:num - first] = rows[first:]
+    return (position + np.arange(num)) % capacity, (position + num) % capacity
 
 
 class ReplayBuffer(object):
@@ -19,38 +49,29 @@ class ReplayBuffer(object):
         self.memory[self.position] = self.Transition(*args)
         self.position = (self.position + 1) % self.capacity
 
+    def store_experiences(self, *columns):
+        # each argument holds one field of several transitions, copied once so that no row refers to a shard file
+        rows = list(map(self.Transition._make, zip(*[np.array(column) for column in columns])))
+        _, self.position = store_rows(self.memory, self.capacity, self.position, rows)
+
     def sample(self, batch_size):
         batch = R.sample(self.memory, batch_size)  # uniform sampling
         return self.Transition(*zip(*batch))
 
-    def save_as_npy(self, start=None, end=None):
-        assert self.saving_path is not None
-        if start is None:
-            batch = self.Transition(*zip(*self.memory))
-        else:
-            assert end is not None
-            batch = self.Transition(*zip(*self.memory[start:end]))
+    def get_experiences(self, start, end):
+        # transitions [start, end) in storage order, as one array per field
+        batch = self.Transition(*zip(*self.memory[start:end]))
+        return self.Transition(*[np.array(column) for column in batch])
 
-        np.save(self.saving_path + '/state', np.array(batch.state))
-        np.save(self.saving_path + '/action', np.array(batch.action))
-        np.save(self.saving_path + '/next_state', np.array(batch.next_state))
-        np.save(self.saving_path + '/reward', np.array(batch.reward))
-        np.save(self.saving_path + '/done', np.array(batch.done))
+    def save_as_npy(self, start=None, end=None, shard_size=100000):
+        # transitions [start, end) of the storage, all of them by default, as a dataset in saving_path,
+        #   see .replay_dataset
+        assert self.saving_path is not None
+        save_dataset(self, self.saving_path, shard_size=shard_size, start=0 if start is None else start, end=end)
 
-    def load_from_npy(self):
+    def load_from_npy(self, mmap=False, max_transitions=None):
         assert self.saving_path is not None
-        state = np.load(self.saving_path + '/state.npy')
-        action = np.load(self.saving_path + '/action.npy')
-        next_state = np.load(self.saving_path + '/next_state.npy')
-        reward = np.load(self.saving_path + '/reward.npy')
-        done = np.load(self.saving_path + '/done.npy')
-
-        for i in range(state.shape[0]):
-            self.store_experience(state[i],
-                                  action[i],
-                                  next_state[i],
-                                  reward[i],
-                                  done[i])
+        return load_dataset(self, self.saving_path, mmap=mmap, max_transitions=max_transitions)
 
     def clear_memory(self):
         self.memory.clear()
@@ -64,6 +85,205 @@ class ReplayBuffer(object):
         return len(self.memory)
 
 
+class ArrayReplayBuffer(object):
+    """
+    A uniform replay buffer that stores each transition field in a preallocated numpy array.
+    The arrays are allocated when the first transition comes in, using its field shapes,
+        floating-point fields are stored as float32 as the agents convert them to float32 tensors anyway.
+    Sampled batches are returned as a transition namedtuple of (batch_size, dim) arrays,
+        gathered with one fancy-indexing operation per field.
+    """
+    def __init__(self, capacity, tr_namedtuple, seed=0, saving_path=None):
+        self.rng = np.random.default_rng(seed=seed)
+        self.saving_path = saving_path
+        self.capacity = capacity
+        self.Transition = tr_namedtuple
+        self.memory = None  # a list of arrays, one per transition field, allocated on the first store
+        self.position = 0
+        self.size = 0
+
+    def _new_array(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def _allocate(self, *args):
+        self.memory = [self._new_array(name, *array_layout(self.capacity, arg))
+                       for name, arg in zip(self.Transition._fields, args)]
+
+    def store_experience(self, *args):
+        if self.memory is None:
+            self._allocate(*args)
+        for array, arg in zip(self.memory, args):
+            array[self.position] = arg
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def store_experiences(self, *columns):
+        # each argument holds one field of several transitions, copied as one or two contiguous slices
+        columns = [np.asarray(column) for column in columns]
+        num = columns[0].shape[0]
+        if num == 0:
+            return
+        if self.memory is None:
+            self._allocate(*[column[0] for column in columns])
+        if num > self.capacity:
+            # only the last $capacity transitions would survive
+            self.position = (self.position + num - self.capacity) % self.capacity
+            columns = [column[num - self.capacity:] for column in columns]
+            num = self.capacity
+        first = min(num, self.capacity - self.position)
+        for array, column in zip(self.memory, columns):
+            array[self.position:self.position + first] = column[:first]
+            array[:num - first] = column[first:num]
+        self.position = (self.position + num) % self.capacity
+        self.size = min(self.size + num, self.capacity)
+
+    def _gather(self, inds):
+        return self.Transition(*[array[inds] for array in self.memory])
+
+    def sample(self, batch_size):
+        inds = self.rng.integers(0, self.size, size=batch_size)  # uniform sampling
+        return self._gather(inds)
+
+    def get_experiences(self, start, end):
+        # transitions [start, end) in storage order, as one array per field
+        return self.Transition(*[array[start:end] for array in self.memory])
+
+    def save_as_npy(self, start=None, end=None, shard_size=100000):
+        # transitions [start, end) of the storage, all of them by default, as a dataset in saving_path,
+        #   see .replay_dataset
+        assert self.saving_path is not None
+        save_dataset(self, self.saving_path, shard_size=shard_size, start=0 if start is None else start, end=end)
+
+    def load_from_npy(self, mmap=False, max_transitions=None):
+        assert self.saving_path is not None
+        return load_dataset(self, self.saving_path, mmap=mmap, max_transitions=max_transitions)
+
+    def clear_memory(self):
+        self.position = 0
+        self.size = 0
+
+    @property
+    def full_memory(self):
+        return self.Transition(*[array[:self.size] for array in self.memory])
+
+    def __len__(self):
+        return self.size
+
+
+class PixelReplayBuffer(ArrayReplayBuffer):
+    """
+    A uniform replay buffer for stacked image observations, e.g., from .env_wrapper.FrameStack.
+    Every frame is stored once as uint8 in a circular frame store of $frame_capacity frames,
+        float frames are taken to be in [0, 1] (e.g., from skimage resize) unless their max is above 1.
+    The state and next_state fields only hold the absolute ids of their $frame_stack frames,
+        frames shared with the previous next_state or repeated within a stack (e.g., after a reset) are not stored again.
+    Stacks are rebuilt with one gather over the frame store when sampling and returned as uint8 arrays.
+    A transition whose frames have been overwritten is not sampled anymore,
+        by default the frame store leaves room for one extra frame (the reset frame) every 4 transitions.
+    """
+    def __init__(self, capacity, tr_namedtuple, frame_stack=3, frame_capacity=None, seed=0, saving_path=None):
+        ArrayReplayBuffer.__init__(self, capacity, tr_namedtuple, seed=seed, saving_path=saving_path)
+        self.frame_stack = frame_stack
+        if frame_capacity is None:
+            frame_capacity = capacity + capacity // 4 + frame_stack
+        self.frame_capacity = frame_capacity
+        self.frames = None  # (frame_capacity, C, H, W) uint8, allocated on the first store
+        self.frame_count = 0
+        self._state_field = self.Transition._fields.index('state')
+        self._next_state_field = self.Transition._fields.index('next_state')
+        self._last_next_state = None
+        self._last_next_ids = None
+
+    @staticmethod
+    def _to_uint8(stack):
+        if stack.dtype == np.uint8:
+            return stack
+        if stack.max() <= 1:
+            stack = stack * 255
+        return np.round(np.clip(stack, 0, 255)).astype(np.uint8)
+
+    def _store_frame(self, frame):
+        if self.frames is None:
+            self.frames = self._new_array('frames', (self.frame_capacity,) + frame.shape, np.uint8)
+        self.frames[self.frame_count % self.frame_capacity] = frame
+        self.frame_count += 1
+        return self.frame_count - 1
+
+    def _store_stack(self, stack, prev_stack=None, prev_ids=None):
+        # stores the frames of a (k*C, H, W) stack that are not already in the frame store, returns the k frame ids
+        stack = self._to_uint8(np.asarray(stack))
+        frames = stack.reshape((self.frame_stack, -1) + stack.shape[1:])
+        if prev_stack is not None:
+            prev_stack = self._to_uint8(np.asarray(prev_stack))
+            prev_frames = prev_stack.reshape((self.frame_stack, -1) + prev_stack.shape[1:])
+        ids = np.zeros(self.frame_stack, dtype=np.int64)
+        for j in range(self.frame_stack):
+            if (prev_stack is not None) and (j + 1 < self.frame_stack) and np.array_equal(frames[j], prev_frames[j + 1]):
+                # the stack has shifted by one frame
+                ids[j] = prev_ids[j + 1]
+            elif (j > 0) and np.array_equal(frames[j], frames[j - 1]):
+                ids[j] = ids[j - 1]
+            else:
+                ids[j] = self._store_frame(frames[j])
+        return ids
+
+    def store_experience(self, *args):
+        args = list(args)
+        state = args[self._state_field]
+        next_state = args[self._next_state_field]
+        if (self._last_next_state is not None) and \
+                ((state is self._last_next_state) or np.array_equal(state, self._last_next_state)):
+            # consecutive steps of an episode
+            state_ids = self._last_next_ids
+        else:
+            state_ids = self._store_stack(state)
+        next_state_ids = self._store_stack(next_state, state, state_ids)
+        self._last_next_state = next_state
+        self._last_next_ids = next_state_ids
+        args[self._state_field] = state_ids
+        args[self._next_state_field] = next_state_ids
+        ArrayReplayBuffer.store_experience(self, *args)
+
+    def store_experiences(self, *columns):
+        # frames are deduplicated against the previous transition, so rows are stored one by one
+        for row in zip(*columns):
+            self.store_experience(*row)
+
+    def _valid(self, inds):
+        oldest = self.frame_count - self.frame_capacity
+        return (self.memory[self._state_field][inds].min(axis=1) >= oldest) & \
+               (self.memory[self._next_state_field][inds].min(axis=1) >= oldest)
+
+    def _gather(self, inds):
+        batch = [array[inds] for array in self.memory]
+        for field in [self._state_field, self._next_state_field]:
+            stacks = self.frames[batch[field] % self.frame_capacity]  # (B, k, C, H, W)
+            batch[field] = stacks.reshape((stacks.shape[0], -1) + stacks.shape[3:])
+        return self.Transition(*batch)
+
+    def sample(self, batch_size):
+        inds = self.rng.integers(0, self.size, size=batch_size)
+        for _ in range(10):
+            invalid = np.flatnonzero(~self._valid(inds))
+            if invalid.size == 0:
+                break
+            inds[invalid] = self.rng.integers(0, self.size, size=invalid.size)
+        assert self._valid(inds).all(), "the frame store is too small for the buffer, increase frame_capacity"
+        return self._gather(inds)
+
+    def get_experiences(self, start, end):
+        return self._gather(np.arange(start, end))
+
+    def clear_memory(self):
+        ArrayReplayBuffer.clear_memory(self)
+        self._last_next_state = None
+        self._last_next_ids = None
+
+    @property
+    def full_memory(self):
+        return self.get_experiences(0, self.size)
+
+
 class EpisodeWiseReplayBuffer(object):
     def __init__(self, capacity, tr_namedtuple, seed=0):
         R.seed(seed)
@@ -186,17 +406,134 @@ class HindsightReplayBuffer(EpisodeWiseReplayBuffer):
         return goals
 
 
-class PrioritisedReplayBuffer(object):
-    def __init__(self, capacity, tr_namedtuple, alpha=0.5, beta=0.8, epsilon=1e-6, rng=None, saving_path=None):
-        self.saving_path = saving_path
+class LazyHindsightReplayBuffer(object):
+    """
+    A hindsight replay buffer that relabels desired goals at sample time instead of storing relabelled copies.
+    Each episode is stored once as contiguous rows of per-field numpy arrays, allocated from the first transition,
+        and every row remembers the [start, end) rows of its episode.
+    When sampling, each transition has its desired goal replaced by an achieved goal from the same episode
+        with probability k/(k+1), the proportion of relabelled transitions produced by HindsightReplayBuffer,
+        then the rewards (and terminal flags if terminate_on_achieve) of the relabelled rows are recomputed in one call.
+    Sampling strategies:
+        'future': the achieved goal of a later transition in the episode
+        'episode': the achieved goal of any transition in the episode
+        'final': the achieved goal of the last transition in the episode
+    """
+    def __init__(self, capacity, tr_namedtuple, store_goal_ind=False,
+                 sampling_strategy='future', sampled_goal_num=4, terminate_on_achieve=False,
+                 goal_distance_threshold=0.05, hindsight=True,
+                 seed=0):
+        self.sampling_strategy = sampling_strategy
+        assert self.sampling_strategy in ['final', 'episode', 'future']
+        self.k = sampled_goal_num
+        self.relabel_prob = 1 - 1 / (1 + self.k) if hindsight else 0.0
+        self.terminate_on_achieve = terminate_on_achieve
+        self.goal_distance_threshold = goal_distance_threshold
+        self.store_goal_ind = store_goal_ind
+        self.rng = np.random.default_rng(seed=seed)
+        self.capacity = capacity
+        self.Transition = tr_namedtuple
+        self._desired_goal_ind = self.Transition._fields.index('desired_goal')
+        self._achieved_goal_ind = self.Transition._fields.index('achieved_goal')
+        self._reward_ind = self.Transition._fields.index('reward')
+        self._done_ind = self.Transition._fields.index('done')
+        self.memory = None  # a list of arrays, one per transition field, allocated on the first store
+        self.ep_start = self._new_array('ep_start', (self.capacity,), np.int64)
+        self.ep_end = self._new_array('ep_end', (self.capacity,), np.int64)
+        self.position = 0
+        self.size = 0
+        self.new_episode = False
+        self.episodes = []
+        self.ep_position = -1
+
+    def store_experience(self, *args):
+        # $new_episode is a boolean value
+        if self.new_episode:
+            self.episodes.append([])
+            self.ep_position += 1
+        self.episodes[self.ep_position].append(args)
+
+    def modify_episodes(self):
+        # relabelling happens in self.sample()
+        pass
+
+    def _new_array(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def _allocate(self, transition):
+        self.memory = [self._new_array(name, *array_layout(self.capacity, arg))
+                       for name, arg in zip(self.Transition._fields, transition)]
+
+    def store_episodes(self):
+        if len(self.episodes) == 0:
+            return
+        if self.memory is None:
+            self._allocate(self.episodes[0][0])
+        for ep in self.episodes:
+            ep_len = len(ep)
+            assert ep_len <= self.capacity
+            # episodes never wrap around the end of the arrays
+            if self.position + ep_len > self.capacity:
+                self.position = 0
+            start, end = self.position, self.position + ep_len
+            # trim the old episodes partially overwritten by the new one
+            if start < self.size:
+                old_start = self.ep_start[start]
+                if old_start < start:
+                    self.ep_end[old_start:start] = start
+                old_end = self.ep_end[end - 1]
+                if old_end > end:
+                    self.ep_start[end:old_end] = end
+            for array, column in zip(self.memory, zip(*ep)):
+                array[start:end] = np.asarray(column)
+            self.ep_start[start:end] = start
+            self.ep_end[start:end] = end
+            self.size = max(self.size, end)
+            self.position = end % self.capacity
+        self.episodes.clear()
+        self.ep_position = -1
+
+    def sample(self, batch_size):
+        inds = self.rng.integers(0, self.size, size=batch_size)
+        batch = [array[inds] for array in self.memory]
+        start = self.ep_start[inds]
+        end = self.ep_end[inds]
+        relabel = self.rng.uniform(size=batch_size) < self.relabel_prob
+        if self.sampling_strategy == 'future':
+            # the last transition of an episode has no future goal and keeps its own
+            relabel &= (inds + 1) < end
+            goal_inds = inds + 1 + (self.rng.uniform(size=batch_size) * (end - inds - 1)).astype(np.int64)
+        elif self.sampling_strategy == 'episode':
+            goal_inds = start + (self.rng.uniform(size=batch_size) * (end - start)).astype(np.int64)
+        else:
+            goal_inds = end - 1
+        goal_inds = goal_inds[relabel]
+
+        desired_goal = batch[self._desired_goal_ind]
+        desired_goal[relabel] = self.memory[self._achieved_goal_ind][goal_inds]
+        reward = goal_distance_reward(desired_goal[relabel], batch[self._achieved_goal_ind][relabel],
+                                      self.goal_distance_threshold)
+        batch[self._reward_ind][relabel] = reward
+        if self.terminate_on_achieve:
+            batch[self._done_ind][relabel] = (reward != 0.0).astype(batch[self._done_ind].dtype)
+        return self.Transition(*batch)
+
+    def __len__(self):
+        return self.size
+
+
+class PrioritisedSampling(object):
+    """
+    Proportional prioritised sampling with importance-sampling weights, shared by the prioritised buffers.
+    A buffer calls _init_priorities() in its constructor and implements _gather(inds),
+        which returns the transitions at the storage indices $inds as a transition namedtuple.
+    New priorities of the trees are all written by _set_priorities(), which a buffer extends to keep a copy of them.
+    """
+    def _init_priorities(self, capacity, alpha, beta, epsilon, rng):
         if rng is None:
             self.rng = np.random.default_rng(seed=0)
         else:
             self.rng = rng
-        self.capacity = capacity
-        self.memory = []
-        self.mem_position = 0
-        self.Transition = tr_namedtuple
         self.alpha = alpha
         self.beta = beta
         self.epsilon = epsilon
@@ -207,6 +544,54 @@ class PrioritisedReplayBuffer(object):
         self.min_tree = MinSegmentTree(tree_capacity)
         self._max_priority = 1.0
 
+    def _set_priorities(self, inds, new_priorities):
+        # the priorities of several transitions, already raised to alpha, are written with one call per tree
+        self.sum_tree.set_many(inds, new_priorities)
+        self.min_tree.set_many(inds, new_priorities)
+
+    def sample(self, batch_size, beta=None):
+        if beta is None:
+            beta = self.beta
+        assert beta > 0, "beta should be greater than 0"
+        inds, priority_sum = self.sample_proportion(batch_size)
+        batch = self._gather(inds)
+        minimal_priority = self.min_tree.min()
+        max_weight = (minimal_priority / priority_sum * len(self)) ** (-beta)
+        sample_priorities = self.sum_tree[inds] / priority_sum
+        weights = (sample_priorities * len(self)) ** (-beta) / max_weight
+
+        return batch, weights, inds
+
+    def sample_proportion(self, batch_size):
+        # leaves beyond len(self) hold zeros, so the root is the total priority of the stored transitions
+        priority_sum = self.sum_tree.sum()
+        interval = priority_sum / batch_size
+        # one stratified mass per batch element, all looked up in a single tree descent
+        masses = self.rng.uniform(size=batch_size) * interval + np.arange(batch_size) * interval
+        inds = self.sum_tree.find_prefixsum_idx_batch(masses)
+        # guard against a rounding error walking into the empty leaves
+        inds = np.minimum(inds, len(self) - 1)
+        return inds, priority_sum
+
+    def update_priority(self, inds, priorities):
+        inds = np.asarray(inds, dtype=np.int64).reshape(-1)
+        priorities = np.asarray(priorities, dtype=np.float64).reshape(-1)
+        assert np.all(priorities >= 0)
+        assert np.all((0 <= inds) & (inds < len(self)))
+        # the whole batch is written back with one call per tree
+        self._set_priorities(inds, (priorities + self.epsilon) ** self.alpha)
+        self._max_priority = max(self._max_priority, priorities.max())
+
+
+class PrioritisedReplayBuffer(PrioritisedSampling):
+    def __init__(self, capacity, tr_namedtuple, alpha=0.5, beta=0.8, epsilon=1e-6, rng=None, saving_path=None):
+        self.saving_path = saving_path
+        self.capacity = capacity
+        self.memory = []
+        self.mem_position = 0
+        self.Transition = tr_namedtuple
+        self._init_priorities(capacity, alpha, beta, epsilon, rng)
+
     def store_experience(self, *args):
         if len(self.memory) < self.capacity:
             self.memory.append(None)
@@ -223,70 +608,35 @@ class PrioritisedReplayBuffer(object):
         self.min_tree[self.mem_position] = (priority + self.epsilon) ** self.alpha
         self.mem_position = (self.mem_position + 1) % self.capacity
 
-    def sample(self, batch_size, beta=None):
-        if beta is None:
-            beta = self.beta
-        assert beta > 0, "beta should be greater than 0"
-        inds, priority_sum = self.sample_proportion(batch_size)
-        batch = []
-        weights = []
-        minimal_priority = self.min_tree.min()
-        max_weight = (minimal_priority / priority_sum * len(self)) ** (-beta)
-        for ind in inds:
-            batch.append(self.memory[ind])
-            sample_priority = self.sum_tree[ind] / priority_sum
-            weight = (sample_priority * len(self)) ** (-beta)
-            weight = weight / max_weight
-            weights.append(weight)
+    def store_experiences(self, *columns, priorities=None):
+        # each argument holds one field of several transitions,
+        #   their priorities (the max priority if not given) are written to the trees in one call
+        rows = list(map(self.Transition._make, zip(*[np.array(column) for column in columns])))
+        positions, self.mem_position = store_rows(self.memory, self.capacity, self.mem_position, rows)
+        if priorities is None:
+            new_priorities = np.full(len(positions), self._max_priority ** self.alpha)
+        else:
+            priorities = np.asarray(priorities, dtype=np.float64).reshape(-1)[len(rows) - len(positions):]
+            new_priorities = (priorities + self.epsilon) ** self.alpha
+        self._set_priorities(positions, new_priorities)
 
-        return self.Transition(*zip(*batch)), np.array(weights), inds
+    def _gather(self, inds):
+        return self.Transition(*zip(*[self.memory[ind] for ind in inds]))
 
-    def sample_proportion(self, batch_size):
-        inds = []
-        priority_sum = self.sum_tree.sum(0, len(self) - 1)
-        interval = priority_sum / batch_size
-        for i in range(batch_size):
-            mass = self.rng.uniform() * interval + i * interval
-            ind = self.sum_tree.find_prefixsum_idx(mass)
-            inds.append(ind)
-        return inds, priority_sum
+    def get_experiences(self, start, end):
+        # transitions [start, end) in storage order, as one array per field
+        batch = self.Transition(*zip(*self.memory[start:end]))
+        return self.Transition(*[np.array(column) for column in batch])
 
-    def update_priority(self, inds, priorities):
-        for ind, priority in zip(inds, priorities):
-            assert priority >= 0
-            assert 0 <= ind < len(self)
-            self.sum_tree[ind] = (priority + self.epsilon) ** self.alpha
-            self.min_tree[ind] = (priority + self.epsilon) ** self.alpha
-            self._max_priority = max(self._max_priority, priority)
-
-    def save_as_npy(self, start=None, end=None):
+    def save_as_npy(self, start=None, end=None, shard_size=100000):
+        # transitions [start, end) of the storage, all of them by default, as a dataset in saving_path,
+        #   see .replay_dataset
         assert self.saving_path is not None
-        if start is None:
-            batch = self.Transition(*zip(*self.memory))
-        else:
-            assert end is not None
-            batch = self.Transition(*zip(*self.memory[start:end]))
-
-        np.save(self.saving_path + '/state', np.array(batch.state))
-        np.save(self.saving_path + '/action', np.array(batch.action))
-        np.save(self.saving_path + '/next_state', np.array(batch.next_state))
-        np.save(self.saving_path + '/reward', np.array(batch.reward))
-        np.save(self.saving_path + '/done', np.array(batch.done))
+        save_dataset(self, self.saving_path, shard_size=shard_size, start=0 if start is None else start, end=end)
 
-    def load_from_npy(self):
+    def load_from_npy(self, mmap=False, max_transitions=None):
         assert self.saving_path is not None
-        state = np.load(self.saving_path + '/state.npy')
-        action = np.load(self.saving_path + '/action.npy')
-        next_state = np.load(self.saving_path + '/next_state.npy')
-        reward = np.load(self.saving_path + '/reward.npy')
-        done = np.load(self.saving_path + '/done.npy')
-
-        for i in range(state.shape[0]):
-            self.store_experience(state[i],
-                                  action[i],
-                                  next_state[i],
-                                  reward[i],
-                                  done[i])
+        return load_dataset(self, self.saving_path, mmap=mmap, max_transitions=max_transitions)
 
     def clear_memory(self):
         self.memory.clear()
@@ -300,12 +650,44 @@ class PrioritisedReplayBuffer(object):
         return len(self.memory)
 
 
-class PrioritisedEpisodeWiseReplayBuffer(object):
-    def __init__(self, capacity, tr_namedtuple, alpha=0.5, beta=0.8, epsilon=1e-6, rng=None):
-        if rng is None:
-            self.rng = np.random.default_rng(seed=0)
+class PrioritisedArrayReplayBuffer(PrioritisedSampling, ArrayReplayBuffer):
+    """
+    An ArrayReplayBuffer with proportional prioritised sampling,
+        several transitions are stored with one or two slice copies per field and one set_many call per tree.
+    """
+    def __init__(self, capacity, tr_namedtuple, alpha=0.5, beta=0.8, epsilon=1e-6, rng=None, saving_path=None):
+        ArrayReplayBuffer.__init__(self, capacity, tr_namedtuple, saving_path=saving_path)
+        self._init_priorities(capacity, alpha, beta, epsilon, rng)
+
+    def _new_positions(self, num):
+        # storage positions of the last $num stored transitions
+        return (self.position - num + np.arange(num)) % self.capacity
+
+    def store_experience(self, *args):
+        ArrayReplayBuffer.store_experience(self, *args)
+        self._set_priorities(self._new_positions(1), np.full(1, self._max_priority ** self.alpha))
+
+    def store_experience_with_given_priority(self, priority, *args):
+        ArrayReplayBuffer.store_experience(self, *args)
+        self._set_priorities(self._new_positions(1), np.full(1, (priority + self.epsilon) ** self.alpha))
+
+    def store_experiences(self, *columns, priorities=None):
+        ArrayReplayBuffer.store_experiences(self, *columns)
+        num = min(len(columns[0]), self.capacity)
+        if priorities is None:
+            new_priorities = np.full(num, self._max_priority ** self.alpha)
         else:
-            self.rng = rng
+            new_priorities = (np.asarray(priorities, dtype=np.float64).reshape(-1)[-num:] + self.epsilon) ** self.alpha
+        self._set_priorities(self._new_positions(num), new_priorities)
+
+    def clear_memory(self):
+        ArrayReplayBuffer.clear_memory(self)
+        # new trees, as sampling reads the totals of all the leaves
+        self._init_priorities(self.capacity, self.alpha, self.beta, self.epsilon, self.rng)
+
+
+class PrioritisedEpisodeWiseReplayBuffer(PrioritisedSampling):
+    def __init__(self, capacity, tr_namedtuple, alpha=0.5, beta=0.8, epsilon=1e-6, rng=None):
         self.capacity = capacity
         self.memory = []
         self.mem_position = 0
@@ -313,15 +695,7 @@ class PrioritisedEpisodeWiseReplayBuffer(object):
         self.episodes = []
         self.ep_position = -1
         self.Transition = tr_namedtuple
-        self.alpha = alpha
-        self.beta = beta
-        self.epsilon = epsilon
-        tree_capacity = 1
-        while tree_capacity < capacity:
-            tree_capacity *= 2
-        self.sum_tree = SumSegmentTree(tree_capacity)
-        self.min_tree = MinSegmentTree(tree_capacity)
-        self._max_priority = 1.0
+        self._init_priorities(capacity, alpha, beta, epsilon, rng)
 
     def store_experience(self, *args):
         if self.new_episode:
@@ -332,52 +706,21 @@ class PrioritisedEpisodeWiseReplayBuffer(object):
     def store_episodes(self):
         if len(self.episodes) == 0:
             return
+        positions = []
         for ep in self.episodes:
             for n in range(len(ep)):
                 if len(self.memory) < self.capacity:
                     self.memory.append(None)
                 self.memory[self.mem_position] = ep[n]
-                self.sum_tree[self.mem_position] = self._max_priority ** self.alpha
-                self.min_tree[self.mem_position] = self._max_priority ** self.alpha
+                positions.append(self.mem_position)
                 self.mem_position = (self.mem_position + 1) % self.capacity
+        # new transitions get the max priority, written to the trees in one call
+        self._set_priorities(positions, np.full(len(positions), self._max_priority ** self.alpha))
         self.episodes.clear()
         self.ep_position = -1
 
-    def sample(self, batch_size, beta=None):
-        if beta is None:
-            beta = self.beta
-        assert beta > 0, "beta should be greater than 0"
-        inds, priority_sum = self.sample_proportion(batch_size)
-        batch = []
-        weights = []
-        minimal_priority = self.min_tree.min()
-        max_weight = (minimal_priority / priority_sum * len(self)) ** (-beta)
-        for ind in inds:
-            batch.append(self.memory[ind])
-            sample_priority = self.sum_tree[ind] / priority_sum
-            weight = (sample_priority * len(self)) ** (-beta)
-            weight = weight / max_weight
-            weights.append(weight)
-
-        return self.Transition(*zip(*batch)), np.array(weights), inds
-
-    def sample_proportion(self, batch_size):
-        inds = []
-        priority_sum = self.sum_tree.sum(0, len(self) - 1)
-        interval = priority_sum / batch_size
-        for i in range(batch_size):
-            mass = self.rng.uniform() * interval + i * interval
-            ind = self.sum_tree.find_prefixsum_idx(mass)
-            inds.append(ind)
-        return inds, priority_sum
-
-    def update_priority(self, inds, priorities):
-        for ind, priority in zip(inds, priorities):
-            assert priority >= 0
-            assert 0 <= ind < len(self)
-            self.sum_tree[ind] = (priority + self.epsilon) ** self.alpha
-            self.min_tree[ind] = (priority + self.epsilon) ** self.alpha
-            self._max_priority = max(self._max_priority, priority)
+    def _gather(self, inds):
+        return self.Transition(*zip(*[self.memory[ind] for ind in inds]))
 
     def __len__(self):
         return len(self.memory)
@@ -458,6 +801,371 @@ class PrioritisedHindsightReplayBuffer(PrioritisedEpisodeWiseReplayBuffer):
         return goals
 
 
+class NStepReplayBuffer(object):
+    """
+    Turns the transitions stored into a uniform or prioritised buffer into n-step transitions.
+    A rolling window of the last $n_step transitions is kept per stream (e.g., one stream per environment),
+        every insert emits the window head with the discounted sum of the next m <= n rewards and the state m steps later,
+        so sampling is unchanged.
+    The discounted sum of each window is updated as rewards enter and leave it, and recomputed every $n_step removals
+        to keep the rounding errors of the divisions by gamma from growing over long episodes.
+    The stored done is mask * gamma^(m-1), so that the targets of the agents, r + done * gamma * V(s'),
+        bootstrap with gamma^m and stop at terminal states.
+    An episode ends with a done mask of 0 (the agents store 1 - int(done)) or when a state does not continue the window,
+        the rest of the window is then emitted with shorter horizons.
+    With $discard_time_limit, the agents bootstrap at the end of the episodes as well.
+    store_stream_experiences() takes one transition per row for several streams and writes the emitted rows in one call.
+    Other attributes and methods are those of the wrapped buffer, store_experiences() stores already accumulated rows as they are.
+    """
+    def __init__(self, buffer, n_step=3, gamma=0.99, discard_time_limit=False):
+        self.buffer = buffer
+        self.n_step = n_step
+        self.gamma = gamma
+        self.discard_time_limit = discard_time_limit
+        fields = buffer.Transition._fields
+        self._state, self._next_state, self._reward, self._done = \
+            [fields.index(name) for name in ('state', 'next_state', 'reward', 'done')]
+        self.windows = {}
+        # the discounted reward sum of each window and the number of removals since it was last recomputed
+        self.window_returns = {}
+        self._emitted = None
+
+    def __getattr__(self, name):
+        # only called for the attributes not found on the wrapper
+        if name == 'buffer':
+            raise AttributeError(name)
+        return getattr(self.buffer, name)
+
+    def store_experience(self, *args, stream=0):
+        if stream not in self.windows:
+            self.windows[stream] = deque()
+            self.window_returns[stream] = [0.0, 0]
+        window, ret = self.windows[stream], self.window_returns[stream]
+        if len(window) > 0:
+            last_next_state = window[-1][self._next_state]
+            state = args[self._state]
+            if (state is not last_next_state) and (not np.array_equal(state, last_next_state)):
+                # the previous episode was cut short
+                self._flush(window, ret, terminal=False)
+        ret[0] += (self.gamma ** len(window)) * args[self._reward]
+        window.append(args)
+        if args[self._done] == 0:
+            self._flush(window, ret, terminal=not self.discard_time_limit)
+        elif len(window) == self.n_step:
+            self._emit(window, ret, terminal=False)
+            self._pop(window, ret)
+
+    def _pop(self, window, ret):
+        # removes the window head and its reward from the discounted sum
+        head = window.popleft()
+        ret[1] += 1
+        if len(window) == 0:
+            ret[0], ret[1] = 0.0, 0
+        elif ret[1] < self.n_step:
+            ret[0] = (ret[0] - head[self._reward]) / self.gamma
+        else:
+            ret[0] = 0.0
+            for i, transition in enumerate(window):
+                ret[0] += (self.gamma ** i) * transition[self._reward]
+            ret[1] = 0
+
+    def _emit(self, window, ret, terminal):
+        row = list(window[0])
+        row[self._next_state] = window[-1][self._next_state]
+        row[self._reward] = ret[0]
+        row[self._done] = 0.0 if terminal else self.gamma ** (len(window) - 1)
+        if self._emitted is not None:
+            self._emitted.append(row)
+        else:
+            self.buffer.store_experience(*row)
+
+    def store_stream_experiences(self, *columns, streams=None):
+        # row i of the columns is a transition of stream streams[i], by default stream i
+        if streams is None:
+            streams = range(len(columns[0]))
+        self._emitted = []
+        try:
+            for row, stream in zip(zip(*columns), streams):
+                self.store_experience(*row, stream=stream)
+            if len(self._emitted) > 0:
+                self.buffer.store_experiences(*zip(*self._emitted))
+        finally:
+            self._emitted = None
+
+    def _flush(self, window, ret, terminal):
+        while len(window) > 0:
+            self._emit(window, ret, terminal)
+            self._pop(window, ret)
+
+    def flush_windows(self):
+        # emit the pending transitions of all streams, e.g., before saving the buffer
+        for stream, window in self.windows.items():
+            self._flush(window, self.window_returns[stream], terminal=False)
+
+    def clear_memory(self):
+        self.windows = {}
+        self.window_returns = {}
+        self.buffer.clear_memory()
+
+    def __len__(self):
+        return len(self.buffer)
+
+
+class MemmapStore(object):
+    """
+    A directory of numpy memmap files with a small json header.
+    The header records the layout of every array and the buffer counters (position, size, max priority),
+        so that a buffer can reopen its arrays from disk instead of reloading the transitions.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.header_file = os.path.join(self.path, 'header.json')
+        if os.path.exists(self.header_file):
+            with open(self.header_file, 'r') as f:
+                self.header = json.load(f)
+        else:
+            self.header = {'arrays': {}, 'counters': {}}
+        self.arrays = {}
+
+    @property
+    def counters(self):
+        return self.header['counters']
+
+    def layout(self, name):
+        if name not in self.header['arrays']:
+            return None
+        layout = self.header['arrays'][name]
+        return tuple(layout['shape']), np.dtype(layout['dtype'])
+
+    def array(self, name, shape, dtype):
+        # an existing file with the same layout is reopened, otherwise a new one is created
+        file = os.path.join(self.path, name + '.dat')
+        layout = {'shape': list(shape), 'dtype': np.dtype(dtype).str}
+        if self.header['arrays'].get(name) == layout and os.path.exists(file):
+            mode = 'r+'
+        else:
+            mode = 'w+'
+            self.header['arrays'][name] = layout
+        self.arrays[name] = np.memmap(file, dtype=dtype, mode=mode, shape=tuple(shape))
+        return self.arrays[name]
+
+    def write_header(self, **counters):
+        self.header['counters'].update(counters)
+        # write to a temporary file first so that a crash never leaves a truncated header
+        tmp_file = self.header_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.header, f)
+        os.replace(tmp_file, self.header_file)
+
+    def flush(self):
+        for array in self.arrays.values():
+            array.flush()
+
+    def reopen(self, names, capacity):
+        # the recorded arrays of a buffer, None if there is no buffer to resume
+        if 'size' not in self.counters:
+            return None
+        layouts = [self.layout(name) for name in names]
+        assert all((layout is not None) and (layout[0][0] == capacity) for layout in layouts), \
+            "the buffer in %s does not hold the fields %s with capacity %i" % (self.path, names, capacity)
+        return [self.array(name, shape, dtype) for name, (shape, dtype) in zip(names, layouts)]
+
+    def check_layout(self, arrays, names, capacity, transition):
+        # the arrays of a resumed buffer must have the layout that new transitions would allocate
+        for array, name, arg in zip(arrays, names, transition):
+            shape, dtype = array_layout(capacity, arg)
+            assert (array.shape == shape) and (array.dtype == dtype), \
+                "the field '%s' of the buffer in %s has shape %s and dtype %s, the new transitions need %s and %s" \
+                % (name, self.path, array.shape, array.dtype, shape, dtype)
+
+
+class MemmapReplayBuffer(ArrayReplayBuffer):
+    """
+    An ArrayReplayBuffer whose field arrays are numpy memmap files under $saving_path/replay_buffer,
+        so that the capacity is bounded by disk space rather than RAM.
+    New transitions are staged in RAM and copied to the memmaps in chunks of $write_chunk rows,
+        they become visible to sample() and len() once their chunk is committed.
+    The header is rewritten on every commit, the memmaps are only flushed to disk every $flush_interval commits
+        (and on flush()), as the page cache keeps the data of a crashed process anyway.
+    Transitions staged at the end of a run are only written by flush().
+    With $resume, a buffer found in $saving_path/replay_buffer is reopened with its transitions,
+        its capacity must match and the first new transition must have the layout of its fields.
+        Otherwise the files are reused as an empty buffer.
+    """
+    def __init__(self, capacity, tr_namedtuple, saving_path, seed=0, write_chunk=1024, flush_interval=100,
+                 resume=False):
+        assert saving_path is not None, 'please specify a path for the memmap files'
+        self.store = MemmapStore(os.path.join(saving_path, 'replay_buffer'))
+        self.write_chunk = min(write_chunk, capacity)
+        self.flush_interval = flush_interval
+        self.resume = resume
+        self._staged = None
+        self._num_staged = 0
+        self._num_commits = 0
+        self._layout_checked = True
+        ArrayReplayBuffer.__init__(self, capacity, tr_namedtuple, seed=seed, saving_path=saving_path)
+        self._reopen()
+
+    def _reopen(self):
+        memory = self.store.reopen(self.Transition._fields, self.capacity) if self.resume else None
+        if memory is None:
+            # the counters of an older buffer must not describe the new transitions
+            self.store.write_header(position=0, size=0)
+            return
+        self.memory = memory
+        self._allocate_staging()
+        self._layout_checked = False
+        self.position = self.store.counters['position']
+        self.size = self.store.counters['size']
+
+    def _check_layout(self, *args):
+        self.store.check_layout(self.memory, self.Transition._fields, self.capacity, args)
+        self._layout_checked = True
+
+    def _new_array(self, name, shape, dtype):
+        return self.store.array(name, shape, dtype)
+
+    def _allocate(self, *args):
+        ArrayReplayBuffer._allocate(self, *args)
+        self._allocate_staging()
+
+    def _allocate_staging(self):
+        self._staged = [np.zeros((self.write_chunk,) + array.shape[1:], dtype=array.dtype) for array in self.memory]
+
+    def store_experience(self, *args):
+        if self.memory is None:
+            self._allocate(*args)
+        elif not self._layout_checked:
+            self._check_layout(*args)
+        for staged, arg in zip(self._staged, args):
+            staged[self._num_staged] = arg
+        self._num_staged += 1
+        if self._num_staged == self.write_chunk:
+            self._commit()
+
+    def store_experiences(self, *columns):
+        if (not self._layout_checked) and len(columns[0]) > 0:
+            self._check_layout(*[column[0] for column in columns])
+        # staged transitions go first to keep the insertion order
+        self._commit()
+        self._write(*columns)
+
+    def _commit(self):
+        num = self._num_staged
+        if num == 0:
+            return
+        self._num_staged = 0
+        self._write(*[staged[:num] for staged in self._staged])
+
+    def _write(self, *columns):
+        num = min(len(columns[0]), self.capacity)
+        if num == 0:
+            return
+        ArrayReplayBuffer.store_experiences(self, *columns)
+        self._on_commit((self.position - num + np.arange(num)) % self.capacity)
+        self._num_commits += 1
+        self.store.write_header(**self._header_counters())
+        if self.flush_interval > 0 and self._num_commits % self.flush_interval == 0:
+            self.store.flush()
+
+    def _on_commit(self, inds):
+        pass
+
+    def _header_counters(self):
+        return {'position': self.position, 'size': self.size}
+
+    def flush(self):
+        self._commit()
+        self.store.flush()
+        self.store.write_header(**self._header_counters())
+
+    def clear_memory(self):
+        ArrayReplayBuffer.clear_memory(self)
+        self._num_staged = 0
+        self.store.write_header(**self._header_counters())
+
+
+class PrioritisedMemmapReplayBuffer(PrioritisedSampling, MemmapReplayBuffer):
+    """
+    A MemmapReplayBuffer with proportional prioritised sampling.
+    The sum/min trees live in RAM, their leaves are mirrored in a 'priority' memmap
+        and the trees are rebuilt from it with one set_many call when the buffer is reopened.
+    """
+    def __init__(self, capacity, tr_namedtuple, saving_path, alpha=0.5, beta=0.8, epsilon=1e-6, rng=None,
+                 write_chunk=1024, flush_interval=100, resume=False):
+        MemmapReplayBuffer.__init__(self, capacity, tr_namedtuple, saving_path,
+                                    write_chunk=write_chunk, flush_interval=flush_interval, resume=resume)
+        self._init_priorities(capacity, alpha, beta, epsilon, rng)
+        has_priority = self.store.layout('priority') == ((self.capacity,), np.dtype(np.float64))
+        self.priority = self.store.array('priority', (self.capacity,), np.float64)
+        if self.size > 0:
+            # rebuild the trees of a reopened buffer
+            if 'max_priority' in self.store.counters:
+                self._max_priority = self.store.counters['max_priority']
+            if not has_priority:
+                self.priority[:self.size] = self._max_priority ** self.alpha
+            PrioritisedSampling._set_priorities(self, np.arange(self.size), self.priority[:self.size])
+
+    def _set_priorities(self, inds, new_priorities):
+        self.priority[inds] = new_priorities
+        PrioritisedSampling._set_priorities(self, inds, new_priorities)
+
+    def _on_commit(self, inds):
+        self._set_priorities(inds, np.full(len(inds), self._max_priority ** self.alpha))
+
+    def store_experiences(self, *columns, priorities=None):
+        MemmapReplayBuffer.store_experiences(self, *columns)
+        if priorities is not None:
+            num = min(len(columns[0]), self.capacity)
+            inds = (self.position - num + np.arange(num)) % self.capacity
+            priorities = np.asarray(priorities, dtype=np.float64).reshape(-1)[-num:]
+            self._set_priorities(inds, (priorities + self.epsilon) ** self.alpha)
+
+    def _header_counters(self):
+        counters = MemmapReplayBuffer._header_counters(self)
+        counters['max_priority'] = float(self._max_priority)
+        return counters
+
+
+class MemmapHindsightReplayBuffer(LazyHindsightReplayBuffer):
+    """
+    A LazyHindsightReplayBuffer whose arrays, episode bounds included, are numpy memmap files
+        under $saving_path/replay_buffer.
+    Episodes are already written in batches by store_episodes(), after which the header is updated.
+    With $resume, a buffer found in $saving_path/replay_buffer is reopened as in MemmapReplayBuffer.
+    """
+    def __init__(self, capacity, tr_namedtuple, saving_path, resume=False, **kwargs):
+        assert saving_path is not None, 'please specify a path for the memmap files'
+        self.store = MemmapStore(os.path.join(saving_path, 'replay_buffer'))
+        LazyHindsightReplayBuffer.__init__(self, capacity, tr_namedtuple, **kwargs)
+        self._layout_checked = True
+        memory = self.store.reopen(self.Transition._fields, self.capacity) if resume else None
+        if memory is None:
+            self.store.write_header(position=0, size=0)
+        else:
+            self.memory = memory
+            self._layout_checked = False
+            self.position = self.store.counters['position']
+            self.size = self.store.counters['size']
+
+    def _new_array(self, name, shape, dtype):
+        return self.store.array(name, shape, dtype)
+
+    def store_episodes(self):
+        if len(self.episodes) == 0:
+            return
+        if not self._layout_checked:
+            self.store.check_layout(self.memory, self.Transition._fields, self.capacity, self.episodes[0][0])
+            self._layout_checked = True
+        LazyHindsightReplayBuffer.store_episodes(self)
+        self.store.write_header(position=self.position, size=self.size)
+
+    def flush(self):
+        self.store.flush()
+        self.store.write_header(position=self.position, size=self.size)
+
+
 def goal_distance_reward(goal_a, goal_b, distance_threshold=0.05):
     # sparse distance-based reward function for goal-conditioned env
     assert goal_a.shape == goal_b.shape
@@ -466,24 +1174,81 @@ def goal_distance_reward(goal_a, goal_b, distance_threshold=0.05):
 
 
 def make_buffer(mem_capacity, transition_tuple=None, prioritised=False, seed=0, rng=None,
-                # the last 4 args are only for goal-conditioned RL buffers
+                # 'list' keeps transitions as namedtuples, 'array' preallocates one numpy array per field,
+                # 'memmap' keeps the arrays in memory-mapped files under saving_path,
+                #   with resume, a memmap buffer already in saving_path is reopened with its transitions
+                storage='list', saving_path=None, resume=False,
+                # the last args are only for goal-conditioned RL buffers
                 goal_conditioned=False, store_goal_ind=False, sampling_strategy='future', num_sampled_goal=4, terminal_on_achieved=True,
-                goal_distance_threshold=0.05):
+                goal_distance_threshold=0.05,
+                # relabel goals when sampling instead of storing relabelled episodes, uniform replay only
+                relabel_at_sample=False, hindsight=True,
+                # stacked image observations are stored as deduplicated uint8 frames, uniform non-goal replay only,
+                #   image-obs agents opt in with the 'pixel_buffer' algo param
+                image_obs=False, frame_stack=3, frame_capacity=None,
+                # store n-step transitions, uniform and prioritised non-goal-conditioned replay only
+                n_step=1, gamma=0.99, discard_time_limit=False):
     t = namedtuple("transition", ('state', 'action', 'next_state', 'reward', 'done'))
     t_goal = namedtuple("transition",
                         ('state', 'desired_goal', 'action', 'next_state', 'achieved_goal', 'reward', 'done'))
     mem_capacity = int(mem_capacity)
+    assert storage in ['list', 'array', 'memmap']
+    if storage == 'array':
+        assert not goal_conditioned, "array storage is only implemented for non-goal-conditioned buffers"
+    if image_obs:
+        assert (not goal_conditioned) and (not prioritised) and (storage != 'memmap'), \
+            "pixel storage is only implemented for the uniform non-goal-conditioned buffer in memory"
+    if n_step > 1:
+        assert not goal_conditioned, "n-step transitions are only implemented for non-goal-conditioned buffers"
+    if storage == 'memmap' and goal_conditioned:
+        assert relabel_at_sample and (not prioritised), \
+            "memmap storage for goal-conditioned RL is only implemented with uniform sample-time relabelling"
     if not goal_conditioned:
         if transition_tuple is None:
             transition_tuple = t
-        if not prioritised:
+        if image_obs:
+            buffer = PixelReplayBuffer(mem_capacity, transition_tuple, frame_stack=frame_stack,
+                                       frame_capacity=frame_capacity, seed=seed)
+        elif storage == 'memmap':
+            if not prioritised:
+                buffer = MemmapReplayBuffer(mem_capacity, transition_tuple, saving_path, seed=seed, resume=resume)
+            else:
+                buffer = PrioritisedMemmapReplayBuffer(mem_capacity, transition_tuple, saving_path, rng=rng,
+                                                       resume=resume)
+        elif storage == 'array':
+            if not prioritised:
+                buffer = ArrayReplayBuffer(mem_capacity, transition_tuple, seed=seed)
+            else:
+                buffer = PrioritisedArrayReplayBuffer(mem_capacity, transition_tuple, rng=rng)
+        elif not prioritised:
             buffer = ReplayBuffer(mem_capacity, transition_tuple, seed=seed)
         else:
             buffer = PrioritisedReplayBuffer(mem_capacity, transition_tuple, rng=rng)
+        if n_step > 1:
+            buffer = NStepReplayBuffer(buffer, n_step=n_step, gamma=gamma, discard_time_limit=discard_time_limit)
     else:
         if transition_tuple is None:
             transition_tuple = t_goal
-        if not prioritised:
+        if storage == 'memmap':
+            buffer = MemmapHindsightReplayBuffer(mem_capacity, transition_tuple, saving_path, resume=resume,
+                                                 store_goal_ind=store_goal_ind,
+                                                 sampling_strategy=sampling_strategy,
+                                                 sampled_goal_num=num_sampled_goal,
+                                                 terminate_on_achieve=terminal_on_achieved,
+                                                 goal_distance_threshold=goal_distance_threshold,
+                                                 hindsight=hindsight,
+                                                 seed=seed)
+        elif relabel_at_sample:
+            assert not prioritised, "sample-time relabelling is only implemented for uniform replay"
+            buffer = LazyHindsightReplayBuffer(mem_capacity, transition_tuple,
+                                               store_goal_ind=store_goal_ind,
+                                               sampling_strategy=sampling_strategy,
+                                               sampled_goal_num=num_sampled_goal,
+                                               terminate_on_achieve=terminal_on_achieved,
+                                               goal_distance_threshold=goal_distance_threshold,
+                                               hindsight=hindsight,
+                                               seed=seed)
+        elif not prioritised:
             buffer = HindsightReplayBuffer(mem_capacity, transition_tuple,
                                            store_goal_ind=store_goal_ind,
                                            sampling_strategy=sampling_strategy,
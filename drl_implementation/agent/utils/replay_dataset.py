@@ -0,0 +1,112 @@
+"""
+A chunked on-disk format for replay buffer datasets.
+A dataset is a directory holding a manifest.json and, for every transition field,
+    one .npy file per shard of $shard_size transitions, e.g.:
+    manifest.json
+    state_00000.npy, action_00000.npy, next_state_00000.npy, reward_00000.npy, done_00000.npy
+    state_00001.npy, ...
+Saving reads one shard at a time from the buffer, loading copies one whole shard at a time into it,
+    so neither of them holds more than a shard in memory besides the buffer itself.
+The files of the former ReplayBuffer.save_as_npy, one <field>.npy per field without a manifest,
+    are loaded as a dataset of one shard.
+"""
+import os
+import json
+import numpy as np
+
+
+def shard_file(path, name, shard):
+    return os.path.join(path, '%s_%05i.npy' % (name, shard))
+
+
+def legacy_file(path, name, shard):
+    return os.path.join(path, name + '.npy')
+
+
+def legacy_manifest(path, fields):
+    # the manifest of the files of the former save_as_npy, read from the header of the first field
+    assert os.path.exists(legacy_file(path, fields[0], 0)), "no dataset found in {}".format(path)
+    num_transitions = np.load(legacy_file(path, fields[0], 0), mmap_mode='r').shape[0]
+    return {'fields': fields, 'num_transitions': num_transitions, 'num_shards': 1}
+
+
+def save_dataset(buffer, path, shard_size=100000, start=0, end=None):
+    """
+    Parameters
+    ----------
+    buffer : a replay buffer implementing get_experiences(start, end), see .replay_buffer
+    path : str
+        the dataset directory, created if it does not exist
+    shard_size : int
+        number of transitions per shard file
+    start, end : int
+        range of the buffer storage to save, the whole buffer by default, an empty range saves an empty dataset
+    """
+    if end is None:
+        end = len(buffer)
+    assert 0 <= start <= end <= len(buffer)
+    os.makedirs(path, exist_ok=True)
+    fields = list(buffer.Transition._fields)
+    layouts = {}
+    num_shards = 0
+    for shard_start in range(start, end, shard_size):
+        batch = buffer.get_experiences(shard_start, min(shard_start + shard_size, end))
+        for name, column in zip(fields, batch):
+            column = np.asarray(column)
+            np.save(shard_file(path, name, num_shards), column)
+            layouts[name] = {'shape': list(column.shape[1:]), 'dtype': column.dtype.str}
+        num_shards += 1
+
+    manifest = {
+        'fields': fields,
+        'layouts': layouts,
+        'num_transitions': end - start,
+        'shard_size': shard_size,
+        'num_shards': num_shards
+    }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_dataset(buffer, path, mmap=False, max_transitions=None):
+    """
+    Parameters
+    ----------
+    buffer : a replay buffer implementing store_experiences(*columns), see .replay_buffer
+        prioritised buffers give the max priority to all loaded transitions in one tree update per shard
+    path : str
+        the dataset directory
+    mmap : bool
+        memory-map the shard files instead of reading them into memory before copying
+    max_transitions : int
+        stop after loading this many transitions
+
+    Returns
+    -------
+    the number of loaded transitions
+    """
+    fields = list(buffer.Transition._fields)
+    manifest_file = os.path.join(path, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        files = shard_file
+    else:
+        manifest = legacy_manifest(path, fields)
+        files = legacy_file
+    assert set(fields) == set(manifest['fields']), \
+        "dataset fields {} do not match the buffer fields {}".format(manifest['fields'], fields)
+    if max_transitions is None:
+        max_transitions = manifest['num_transitions']
+    mmap_mode = 'r' if mmap else None
+
+    num_loaded = 0
+    for shard in range(manifest['num_shards']):
+        if num_loaded >= max_transitions:
+            break
+        columns = [np.load(files(path, name, shard), mmap_mode=mmap_mode) for name in fields]
+        num = min(columns[0].shape[0], max_transitions - num_loaded)
+        buffer.store_experiences(*[column[:num] for column in columns])
+        num_loaded += num
+    return num_loaded
@@ -3,7 +3,7 @@ The segment tree implementation from OpenAI baseline GitHub repo:
 https://github.com/openai/baselines/blob/ea25b9e8b234e6ee1bca43083f8f3cf974143998/baselines/common/segment_tree.py
 This is used in the prioritized replay buffer.
 """
-import operator
+import numpy as np
 
 
 class SegmentTree(object):
@@ -21,17 +21,19 @@ class SegmentTree(object):
         ---------
         capacity: int
             Total size of the array - must be a power of two.
-        operation: lambda obj, obj -> obj
-            and operation for combining elements (eg. sum, max)
+        operation: numpy ufunc, (array, array) -> array
+            and operation for combining elements (eg. np.add, np.maximum)
             must form a mathematical group together with the set of
-            possible values for array elements (i.e. be associative)
+            possible values for array elements (i.e. be associative),
+            it is applied element-wise to whole tree levels in `set_many`
         neutral_element: obj
             neutral element for the operation above. eg. float('-inf')
             for max and 0 for sum.
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
         self._capacity = capacity
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        # stored as a flat array so that batched queries can index a whole tree level at once
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
         self._operation = operation
 
     def _reduce_helper(self, start, end, node, node_start, node_end):
@@ -66,6 +68,9 @@ class SegmentTree(object):
         """
         if end is None:
             end = self._capacity
+        if start == 0 and end == self._capacity:
+            # the root caches the full-range aggregate
+            return self._value[1]
         if end < 0:
             end += self._capacity
         end -= 1
@@ -83,8 +88,30 @@ class SegmentTree(object):
             )
             idx //= 2
 
+    def set_many(self, indices, values):
+        """Set several items at once.
+        Leaves are written first, then the touched ancestors are recomputed
+        level by level, each level with one vectorized `operation` call.
+        Parameters
+        ----------
+        indices: array of int
+            positions of the items, duplicated positions take the last value
+        values: array of float
+            new values of the items
+        """
+        idx = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if idx.shape[0] == 0:
+            return
+        idx = idx + self._capacity
+        self._value[idx] = np.asarray(values, dtype=np.float64).reshape(-1)
+        idx = np.unique(idx // 2)
+        while idx[0] >= 1:
+            self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+            idx = np.unique(idx // 2)
+
     def __getitem__(self, idx):
-        assert 0 <= idx < self._capacity
+        # idx can be an integer or an array of integers
+        assert np.all((0 <= np.asarray(idx)) & (np.asarray(idx) < self._capacity))
         return self._value[self._capacity + idx]
 
 
@@ -92,7 +119,7 @@ class SumSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(SumSegmentTree, self).__init__(
             capacity=capacity,
-            operation=operator.add,
+            operation=np.add,
             neutral_element=0.0
         )
 
@@ -125,12 +152,36 @@ class SumSegmentTree(SegmentTree):
                 idx = 2 * idx + 1
         return idx - self._capacity
 
+    def find_prefixsum_idx_batch(self, prefixsums):
+        """Batched version of `find_prefixsum_idx`.
+        All prefix sums descend the tree together, one level per iteration,
+        so the Python loop runs log2(capacity) times regardless of the batch size.
+        Parameters
+        ----------
+        prefixsums: np.ndarray
+            upperbounds on the sum of array prefix
+        Returns
+        -------
+        idx: np.ndarray
+            highest indexes satisfying the prefixsum constraints
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        assert np.all(0 <= prefixsums) and np.all(prefixsums <= self.sum() + 1e-5)
+        idx = np.ones(prefixsums.shape[0], dtype=np.int64)
+        # leaves are all at the same depth as the capacity is a power of 2
+        while idx[0] < self._capacity:
+            left = self._value[2 * idx]
+            go_right = left <= prefixsums
+            prefixsums = np.where(go_right, prefixsums - left, prefixsums)
+            idx = 2 * idx + go_right
+        return idx - self._capacity
+
 
 class MinSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(MinSegmentTree, self).__init__(
             capacity=capacity,
-            operation=min,
+            operation=np.minimum,
             neutral_element=float('inf')
         )
 
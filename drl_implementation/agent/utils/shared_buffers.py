@@ -0,0 +1,225 @@
+import os
+import uuid
+import queue
+import numpy as np
+import torch as T
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from .vector_env import _shared_array, _view
+
+# sequence number, number of floats and number of tensors, followed by the size of each tensor and the parameters
+_HEADER_SIZE = 3
+
+
+class SharedParameterStore(object):
+    """
+    A versioned flat vector of float32 parameters in a named shared-memory segment,
+        written by one process (e.g., the learner) and read by any number of others (e.g., the workers).
+    The segment is created by the first write(), as the number of parameters is only known then,
+        and is attached by the readers under the same name, which is why the store can be made before forking.
+    The number of elements of each written tensor is recorded in the segment,
+        and checked against the $sizes expected by a reader when it attaches, see read().
+    Writes and reads are guarded by a sequence number (seqlock): it is odd while a write is in progress,
+        a reader copies the vector only when the number has changed since its last read,
+        and retries if it has changed during the copy. Nothing is pickled.
+    """
+    def __init__(self, name=None):
+        if name is None:
+            name = 'drl_params_%i_%s' % (os.getpid(), uuid.uuid4().hex[:8])
+        self.name = name
+        self.shm = None
+        self.header = None
+        self.sizes = None
+        self.data = None
+        # the version of the last read, see read()
+        self.version = 0
+        self.buffer = None
+        self.owner = False
+        # the processes made after this share one resource tracker, which unlinks the segment if they all crash,
+        #       and to which attaching readers register the segment again (python < 3.13) without unlinking it at exit
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+
+    def __getstate__(self):
+        # only the name is sent to other processes, they attach on their first read()
+        return {'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(name=state['name'])
+
+    def _map(self, shm):
+        self.shm = shm
+        self.header = np.ndarray((_HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        num_params, num_tensors = int(self.header[1]), int(self.header[2])
+        self.sizes = np.ndarray((num_tensors,), dtype=np.int64, buffer=shm.buf, offset=_HEADER_SIZE * 8)
+        self.data = np.ndarray((num_params,), dtype=np.float32, buffer=shm.buf,
+                               offset=(_HEADER_SIZE + num_tensors) * 8)
+
+    def _create(self, sizes):
+        num_params = int(np.sum(sizes))
+        shm = shared_memory.SharedMemory(name=self.name, create=True,
+                                         size=(_HEADER_SIZE + len(sizes)) * 8 + num_params * 4)
+        header = np.ndarray((_HEADER_SIZE + len(sizes),), dtype=np.int64, buffer=shm.buf)
+        header[0] = 0
+        header[2] = len(sizes)
+        header[_HEADER_SIZE:] = sizes
+        # written last, a reader only maps the segment once it is set
+        header[1] = num_params
+        self.owner = True
+        self._map(shm)
+
+    def _attach(self):
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except (FileNotFoundError, ValueError):
+            # nothing has been written yet, or the segment has not been sized yet
+            return False
+        if (shm.size < _HEADER_SIZE * 8) or (np.ndarray((_HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)[1] == 0):
+            # the writer has not finished creating the segment
+            shm.close()
+            return False
+        self._map(shm)
+        return True
+
+    def write(self, params):
+        # $params: an iterable of tensors, concatenated into one vector with a single device-to-host copy
+        params = [p.detach().reshape(-1) for p in params]
+        sizes = [p.numel() for p in params]
+        flat = T.cat(params).float().cpu().numpy()
+        if self.shm is None:
+            self._create(sizes)
+        assert np.array_equal(self.sizes, sizes), "the layout of the parameters has changed"
+        self.header[0] += 1
+        self.data[:] = flat
+        self.header[0] += 1
+        return int(self.header[0])
+
+    def read(self, sizes=None):
+        """
+        Returns a copy of the vector, or None if it has not changed since the last read.
+        $sizes: the number of elements of each tensor the reader expects, in order,
+            a ValueError is raised if they differ from those of the written tensors.
+        """
+        if self.shm is None:
+            if not self._attach():
+                return None
+            if (sizes is not None) and (not np.array_equal(self.sizes, sizes)):
+                written_sizes = self.sizes.tolist()
+                self.close()
+                raise ValueError("the parameters of the store have the sizes %s, expected %s"
+                                 % (written_sizes, list(sizes)))
+        if self.buffer is None:
+            self.buffer = np.empty_like(self.data)
+        while True:
+            version = int(self.header[0])
+            if version == self.version:
+                return None
+            if version % 2 == 1:
+                # a write is in progress
+                continue
+            self.buffer[:] = self.data
+            if int(self.header[0]) == version:
+                self.version = version
+                return self.buffer
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.header = None
+        self.sizes = None
+        self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+class SharedBatchRing(object):
+    """
+    A ring of $num_slots preallocated batches in shared memory, filled by one process (e.g., the replay process)
+        and consumed by another (e.g., the learner), made before forking or passed to the processes at their creation.
+    Each slot holds $batch_size rows of each of the $columns, a list of (name, row shape, dtype),
+        as contiguous arrays. Only slot indexes go through the queues: put() fills a free slot and marks it ready,
+        get() returns a ready slot with its columns as tensors sharing the memory of the slot (no copy),
+        which is given back by release() once the tensors are no longer used,
+        take() returns a copy of the columns on a device and gives the slot back at once.
+    """
+    def __init__(self, num_slots, batch_size, columns, ctx=None):
+        if ctx is None:
+            ctx = mp.get_context()
+        self.num_slots = num_slots
+        self.batch_size = batch_size
+        self.columns = [name for name, _, _ in columns]
+        self.slots = [{name: _shared_array((batch_size,) + tuple(shape), dtype) for name, shape, dtype in columns}
+                      for _ in range(num_slots)]
+        self.free_queue = ctx.Queue(maxsize=num_slots)
+        self.ready_queue = ctx.Queue(maxsize=num_slots)
+        for slot in range(num_slots):
+            self.free_queue.put(slot)
+        # numpy views and tensors of the slots, made once in each process
+        self._views = None
+        self._tensors = None
+
+    def views(self, slot):
+        if self._views is None:
+            self._views = [{name: _view(value) for name, value in arrays.items()} for arrays in self.slots]
+        return self._views[slot]
+
+    def tensors(self, slot):
+        if self._tensors is None:
+            self._tensors = [tuple(T.from_numpy(self.views(i)[name]) for name in self.columns)
+                             for i in range(self.num_slots)]
+        return self._tensors[slot]
+
+    def acquire(self, block=True, timeout=None):
+        # a free slot to be filled through views(), None if no slot has been freed in time
+        try:
+            return self.free_queue.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def commit(self, slot):
+        # marks a filled slot as ready for get()
+        self.ready_queue.put(slot)
+
+    def put(self, *columns, block=True, timeout=None):
+        # returns False if no slot has been freed in time
+        slot = self.acquire(block=block, timeout=timeout)
+        if slot is None:
+            return False
+        views = self.views(slot)
+        for name, column in zip(self.columns, columns):
+            views[name][:] = column
+        self.commit(slot)
+        return True
+
+    def get(self, block=True, timeout=None):
+        # returns the slot index and the tensors of the columns, (None, None) if no batch is ready in time
+        try:
+            slot = self.ready_queue.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None, None
+        return slot, self.tensors(slot)
+
+    def release(self, slot):
+        self.free_queue.put(slot)
+
+    def take(self, device, block=True, timeout=None):
+        # a copy of the columns of a ready batch on $device, None if no batch is ready in time,
+        #       the slot can be refilled as soon as this returns, so the copy is always made, even on the cpu
+        slot, tensors = self.get(block=block, timeout=timeout)
+        if slot is None:
+            return None
+        try:
+            return tuple(tensor.to(device, copy=True) for tensor in tensors)
+        finally:
+            self.release(slot)
+
+    def close(self):
+        for q in [self.free_queue, self.ready_queue]:
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+            q.close()
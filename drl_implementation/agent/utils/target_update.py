@@ -0,0 +1,33 @@
+import torch as T
+
+
+def soft_update(targets, sources, tau):
+    # targets, sources: lists of tensors, targets = (1 - tau) * targets + tau * sources in place
+    with T.no_grad():
+        if tau == 1:
+            for target, source in zip(targets, sources):
+                target.copy_(source)
+        else:
+            T._foreach_lerp_(targets, sources, tau)
+
+
+class PolyakAveraging(object):
+    """
+    Soft target network updates for several source/target network pairs at once.
+    The parameters of all registered pairs are updated in place by one multi-tensor call (torch._foreach_lerp_),
+        without a Python loop over the parameters or temporary tensors.
+    """
+    def __init__(self):
+        self.targets = []
+        self.sources = []
+
+    def register(self, source, target):
+        source_params = list(source.parameters())
+        target_params = list(target.parameters())
+        assert len(source_params) == len(target_params)
+        self.sources += source_params
+        self.targets += target_params
+        return self
+
+    def update(self, tau):
+        soft_update(self.targets, self.sources, tau)
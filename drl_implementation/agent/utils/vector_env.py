@@ -0,0 +1,396 @@
+import sys
+import numbers
+import traceback
+import multiprocessing as mp
+import numpy as np
+
+
+# the attribute values that the vector envs read from their first environment, methods go through call()
+_PLAIN_TYPES = (numbers.Number, str, bytes, type(None), np.ndarray, np.generic, tuple, list, dict)
+
+
+def _get_attr(obj, name):
+    # a dotted name, e.g., 'env.curriculum_goal_step', is looked up attribute by attribute
+    for part in name.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+
+def _set_attr(obj, name, value):
+    path, _, last = name.rpartition('.')
+    setattr(_get_attr(obj, path) if path else obj, last, value)
+
+
+def _plain_attr(obj, name):
+    value = getattr(obj, name)
+    if not isinstance(value, _PLAIN_TYPES):
+        raise AttributeError("'%s' is not a plain attribute of the environments, "
+                             "use call() for their methods and get_attr() for the others" % name)
+    return value
+
+
+class VectorEnv(object):
+    """
+    Steps $num_envs environments, made by calling each of $env_fns, one after the other in this process.
+    Observations, rewards and dones are returned stacked along a leading dimension of size num_envs,
+        dict observations (e.g., of goal-conditioned environments) as a dict of stacked arrays.
+    The environments are not reset automatically: step() only steps the environments selected by $active
+        (all of them by default) and leaves the rows of the others unchanged, with zero rewards,
+        so that episodes of different lengths can be run to completion side by side.
+    step_async() and step_wait() split step() for subclasses that simulate in the background.
+    Other plain attributes (numbers, strings, arrays and containers, e.g., distance_threshold)
+        are those of the first environment.
+    The methods of the environments are called on all of them with call(), e.g., call('activate_curriculum_update'),
+        get_attr() and set_attr() read and write an attribute of every environment.
+    """
+    def __init__(self, env_fns):
+        self.envs = [fn() for fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self._max_episode_steps = getattr(self.envs[0], '_max_episode_steps', None)
+        self.obs = None
+        self.dones = np.zeros(self.num_envs, dtype=bool)
+        self._actions = None
+        self._active = None
+
+    def __getattr__(self, name):
+        # only called for the attributes not found on the vector env
+        if name == 'envs':
+            raise AttributeError(name)
+        return _plain_attr(self.envs[0], name)
+
+    def call(self, name, *args, **kwargs):
+        # calls the method $name of every environment, returns the list of their results
+        return [getattr(env, name)(*args, **kwargs) for env in self.envs]
+
+    def get_attr(self, name):
+        return [_get_attr(env, name) for env in self.envs]
+
+    def set_attr(self, name, values):
+        # $values holds one value per environment
+        for env, value in zip(self.envs, values):
+            _set_attr(env, name, value)
+
+    def seed(self, seed=None):
+        for i, env in enumerate(self.envs):
+            env.seed(None if seed is None else seed + i)
+
+    def _new_obs(self, obs):
+        # stacked arrays allocated from the first observation
+        if isinstance(obs, dict):
+            return {key: np.zeros((self.num_envs,) + np.shape(value), dtype=np.asarray(value).dtype)
+                    for key, value in obs.items()}
+        return np.zeros((self.num_envs,) + np.shape(obs), dtype=np.asarray(obs).dtype)
+
+    def _copy_obs(self, obs):
+        if isinstance(obs, dict):
+            return {key: value.copy() for key, value in obs.items()}
+        return obs.copy()
+
+    def _set_obs(self, obs, i, value):
+        if isinstance(obs, dict):
+            for key in obs.keys():
+                obs[key][i] = value[key]
+        else:
+            obs[i] = value
+
+    def reset(self):
+        for i, env in enumerate(self.envs):
+            obs = env.reset()
+            if self.obs is None:
+                self.obs = self._new_obs(obs)
+            self._set_obs(self.obs, i, obs)
+        self.dones[:] = False
+        return self._copy_obs(self.obs)
+
+    def step_async(self, actions, active=None):
+        if active is None:
+            active = np.ones(self.num_envs, dtype=bool)
+        self._actions = actions
+        self._active = np.asarray(active, dtype=bool)
+
+    def step_wait(self):
+        rewards = np.zeros(self.num_envs)
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(self._active):
+            obs, rewards[i], self.dones[i], infos[i] = self.envs[i].step(self._actions[i])
+            self._set_obs(self.obs, i, obs)
+        return self._copy_obs(self.obs), rewards, self.dones.copy(), infos
+
+    def step(self, actions, active=None):
+        self.step_async(actions, active)
+        return self.step_wait()
+
+    def render(self, mode='human'):
+        return self.envs[0].render(mode=mode)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+_STEP, _RESET, _SEED, _CLOSE, _CALL = 0, 1, 2, 3, 4
+
+
+def _shared_array(shape, dtype):
+    # a numpy view on an unsynchronised shared-memory buffer, can be passed to child processes
+    buffer = mp.RawArray('b', max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+    return buffer, shape, dtype
+
+
+def _view(shared):
+    buffer, shape, dtype = shared
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _write_obs(obs_views, i, obs):
+    if isinstance(obs, dict):
+        for key, view in obs_views.items():
+            view[i] = obs[key]
+    else:
+        obs_views[i] = obs
+
+
+def _handle_call(envs, request):
+    # runs a call(), get_attr() or set_attr() request on the environments of a worker
+    kind, name, args, kwargs = request
+    if kind == 'call':
+        return [getattr(env, name)(*args, **kwargs) for env in envs]
+    if kind == 'get_attr':
+        return [_get_attr(env, name) for env in envs]
+    if kind == 'plain_attr':
+        return [_plain_attr(envs[0], name)]
+    for env, value in zip(envs, args[0]):
+        _set_attr(env, name, value)
+    return [None] * len(envs)
+
+
+def _worker(w, env_fns, env_inds, shared, commands, errors, start, finished, conn):
+    views = {name: (_view(value) if not isinstance(value, dict) else {key: _view(v) for key, v in value.items()})
+             for name, value in shared.items()}
+    try:
+        envs = [fn() for fn in env_fns]
+        while True:
+            start.wait()
+            start.clear()
+            command = commands[w]
+            if command == _STEP:
+                for env, i in zip(envs, env_inds):
+                    if views['active'][i]:
+                        obs, views['rewards'][i], views['dones'][i], _ = env.step(views['actions'][i])
+                        _write_obs(views['obs'], i, obs)
+            elif command == _RESET:
+                for env, i in zip(envs, env_inds):
+                    _write_obs(views['obs'], i, env.reset())
+            elif command == _SEED:
+                for env, i in zip(envs, env_inds):
+                    env.seed(int(views['seeds'][i]) if views['seeded'][i] else None)
+            elif command == _CALL:
+                # errors of a request are sent back to the caller instead of stopping the worker
+                try:
+                    reply = (True, _handle_call(envs, conn.recv()))
+                except Exception as e:
+                    reply = (False, e)
+                conn.send(reply)
+            elif command == _CLOSE:
+                for env in envs:
+                    env.close()
+                finished.set()
+                return
+            finished.set()
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+        errors[w] = 1
+        finished.set()
+
+
+class SubprocVectorEnv(VectorEnv):
+    """
+    A VectorEnv that runs its environments in worker processes, $envs_per_worker per process,
+        so that simulators holding the GIL (e.g., PyBullet) run on several cores.
+    Actions, observations (plain arrays or goal dicts), rewards and dones are exchanged through shared-memory arrays,
+        and each worker is driven by a pair of events (start, finished) instead of pickling through pipes.
+    step_async() returns as soon as the workers of the $active environments have been started,
+        so that the actions of another group of environments can be computed while they simulate,
+        step_wait() then waits for the workers of $active (by default all the started ones).
+    The rows of environments that are still simulating are not meaningful in the returned arrays.
+    The infos of the environments are not transferred, step() returns empty dicts.
+    The spaces and the observation layout are read from a copy of the first environment made (and closed) in this process.
+    Other plain attributes are read from the first environment in its worker,
+        call(), get_attr() and set_attr() are sent to the workers through pipes and their results returned in env order.
+    """
+    def __init__(self, env_fns, envs_per_worker=1, start_method=None):
+        env = env_fns[0]()
+        obs = env.reset()
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        self._max_episode_steps = getattr(env, '_max_episode_steps', None)
+        env.close()
+        self.num_envs = len(env_fns)
+        self.envs_per_worker = envs_per_worker
+
+        if isinstance(obs, dict):
+            obs_layout = {key: _shared_array((self.num_envs,) + np.shape(value), np.asarray(value).dtype)
+                          for key, value in obs.items()}
+        else:
+            obs_layout = _shared_array((self.num_envs,) + np.shape(obs), np.asarray(obs).dtype)
+        self.shared = {
+            'obs': obs_layout,
+            'actions': _shared_array((self.num_envs,) + self.action_space.shape, np.float64),
+            'rewards': _shared_array((self.num_envs,), np.float64),
+            'dones': _shared_array((self.num_envs,), np.bool_),
+            'active': _shared_array((self.num_envs,), np.bool_),
+            'seeds': _shared_array((self.num_envs,), np.int64),
+            'seeded': _shared_array((self.num_envs,), np.bool_),
+        }
+        self.views = {name: (_view(value) if not isinstance(value, dict) else {key: _view(v) for key, v in value.items()})
+                      for name, value in self.shared.items()}
+
+        ctx = mp.get_context(start_method)
+        self.num_workers = int(np.ceil(self.num_envs / envs_per_worker))
+        self.worker_envs = [np.arange(w * envs_per_worker, min((w + 1) * envs_per_worker, self.num_envs))
+                            for w in range(self.num_workers)]
+        self.commands = ctx.RawArray('i', self.num_workers)
+        self.errors = ctx.RawArray('i', self.num_workers)
+        self.start_events = [ctx.Event() for _ in range(self.num_workers)]
+        self.finished_events = [ctx.Event() for _ in range(self.num_workers)]
+        self.pipes = [ctx.Pipe() for _ in range(self.num_workers)]
+        self.pending = np.zeros(self.num_workers, dtype=bool)
+        # the active environments of each started worker, kept until its step_wait()
+        self.pending_active = np.zeros(self.num_envs, dtype=bool)
+        self.processes = []
+        for w, inds in enumerate(self.worker_envs):
+            p = ctx.Process(target=_worker,
+                            args=(w, [env_fns[i] for i in inds], inds, self.shared, self.commands, self.errors,
+                                  self.start_events[w], self.finished_events[w], self.pipes[w][1]),
+                            daemon=True)
+            p.start()
+            self.processes.append(p)
+        self.closed = False
+
+    def __getattr__(self, name):
+        # only called for the attributes not found on the vector env
+        if (name.startswith('__')) or ('closed' not in self.__dict__) or self.closed:
+            raise AttributeError(name)
+        return self._request({0: ('plain_attr', name, (), {})})[0]
+
+    def _request(self, requests):
+        # sends requests[w] to each worker w, returns the results of all their environments in env order
+        assert not self.closed, "the vector env is closed"
+        workers = np.zeros(self.num_workers, dtype=bool)
+        workers[list(requests.keys())] = True
+        for w, request in requests.items():
+            self.pipes[w][0].send(request)
+        self._start(_CALL, workers)
+        replies = {}
+        for w in np.flatnonzero(workers):
+            # the reply is read before waiting for the worker, which blocks on sending a large one
+            while not self.pipes[w][0].poll(1.0):
+                if self.errors[w] or (not self.processes[w].is_alive()):
+                    break
+            else:
+                replies[w] = self.pipes[w][0].recv()
+        self._wait(workers)
+        results = []
+        for w in np.flatnonzero(workers):
+            ok, reply = replies[w]
+            if not ok:
+                raise reply
+            results += reply
+        return results
+
+    def call(self, name, *args, **kwargs):
+        return self._request({w: ('call', name, args, kwargs) for w in range(self.num_workers)})
+
+    def get_attr(self, name):
+        return self._request({w: ('get_attr', name, (), {}) for w in range(self.num_workers)})
+
+    def set_attr(self, name, values):
+        # each worker gets the values of its environments
+        values = list(values)
+        self._request({w: ('set_attr', name, ([values[i] for i in inds],), {})
+                       for w, inds in enumerate(self.worker_envs)})
+
+    def _workers_of(self, active):
+        return np.array([active[inds].any() for inds in self.worker_envs])
+
+    def _start(self, command, workers):
+        for w in np.flatnonzero(workers):
+            assert not self.pending[w], "step_wait() has not been called for worker %i" % w
+            self.commands[w] = command
+            self.pending[w] = True
+            self.start_events[w].set()
+
+    def _wait(self, workers):
+        for w in np.flatnonzero(workers & self.pending):
+            while not self.finished_events[w].wait(timeout=1.0):
+                if not self.processes[w].is_alive():
+                    raise RuntimeError("the vector env worker %i has died" % w)
+            self.finished_events[w].clear()
+            self.pending[w] = False
+            if self.errors[w]:
+                raise RuntimeError("the vector env worker %i failed, see its traceback above" % w)
+
+    def _copy_obs(self, obs=None):
+        return VectorEnv._copy_obs(self, self.views['obs'])
+
+    def seed(self, seed=None):
+        self.views['seeded'][:] = seed is not None
+        if seed is not None:
+            self.views['seeds'][:] = seed + np.arange(self.num_envs)
+        workers = np.ones(self.num_workers, dtype=bool)
+        self._start(_SEED, workers)
+        self._wait(workers)
+
+    def reset(self):
+        workers = np.ones(self.num_workers, dtype=bool)
+        self._start(_RESET, workers)
+        self._wait(workers)
+        self.views['dones'][:] = False
+        return self._copy_obs()
+
+    def step_async(self, actions, active=None):
+        if active is None:
+            active = np.ones(self.num_envs, dtype=bool)
+        active = np.asarray(active, dtype=bool)
+        workers = self._workers_of(active)
+        assert not (workers & self.pending).any(), "step_wait() has not been called for some of the active environments"
+        # only the rows of the started workers are written, the others may still be simulating
+        for w in np.flatnonzero(workers):
+            inds = self.worker_envs[w]
+            self.views['actions'][inds[active[inds]]] = np.asarray(actions)[inds[active[inds]]]
+            self.views['active'][inds] = active[inds]
+            self.pending_active[inds] = active[inds]
+        self._start(_STEP, workers)
+
+    def step_wait(self, active=None):
+        if active is None:
+            workers = self.pending.copy()
+            active = np.zeros(self.num_envs, dtype=bool)
+            for w in np.flatnonzero(workers):
+                active[self.worker_envs[w]] = self.pending_active[self.worker_envs[w]]
+        else:
+            active = np.asarray(active, dtype=bool)
+            workers = self._workers_of(active)
+        self._wait(workers)
+        rewards = np.where(active, self.views['rewards'], 0.0)
+        infos = [{} for _ in range(self.num_envs)]
+        return self._copy_obs(), rewards, self.views['dones'].copy(), infos
+
+    def render(self, mode='human'):
+        raise NotImplementedError("the environments of a SubprocVectorEnv are rendered in their worker processes")
+
+    def close(self):
+        if self.closed:
+            return
+        self._wait(self.pending.copy())
+        workers = np.array([p.is_alive() for p in self.processes])
+        self._start(_CLOSE, workers)
+        self._wait(workers)
+        for p in self.processes:
+            p.join()
+        for parent_conn, child_conn in self.pipes:
+            parent_conn.close()
+            child_conn.close()
+        self.closed = True
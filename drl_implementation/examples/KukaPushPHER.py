@@ -5,6 +5,7 @@ import os
 import gym
 import pybullet_multigoal_gym as pmg
 from drl_implementation import GoalConditionedSAC, GoalConditionedDDPG
+from drl_implementation.runner import run_seeds, aggregate_statistics
 # you can replace the agent instantiation by one of the two above, with the proper params
 
 ddpg_params = {
@@ -64,28 +65,29 @@ ddpg_params = {
 #     'saving_gap': 25,
 # }
 seeds = [11, 22, 33, 44]
-seed_returns = []
-seed_success_rates = []
 path = os.path.dirname(os.path.realpath(__file__))
 path = os.path.join(path, 'PushPHER')
 
-for seed in seeds:
 
-    env = pmg.make_env(task='push',
-                       gripper='parallel_jaw',
-                       render=False,
-                       binary_reward=True,
-                       max_episode_steps=50,
-                       image_observation=False,
-                       depth_image=False,
-                       goal_image=False)
+def make_env():
     # use the render env for visualization
+    return pmg.make_env(task='push',
+                        gripper='parallel_jaw',
+                        render=False,
+                        binary_reward=True,
+                        max_episode_steps=50,
+                        image_observation=False,
+                        depth_image=False,
+                        goal_image=False)
 
-    seed_path = path + '/seed'+str(seed)
 
-    agent = GoalConditionedDDPG(algo_params=ddpg_params, env=env, path=seed_path, seed=seed)
-    agent.run(test=False)
+if __name__ == '__main__':
+    # the seeds are trained in parallel processes pinned to separate cores, see drl_implementation/runner.py
+    seed_statistics = run_seeds(GoalConditionedDDPG, ddpg_params, make_env, seeds, path)
+    seed_returns = [seed_statistics[seed]['epoch_test_return'] for seed in seeds]
+    seed_success_rates = [seed_statistics[seed]['epoch_test_success_rate'] for seed in seeds]
+    aggregate_statistics(seed_statistics, keys=['epoch_test_return', 'epoch_test_success_rate'], path=path)
+
     # the sleep argument pause the rendering for a while every step, useful for slowing down visualization
+    # agent = GoalConditionedDDPG(algo_params=ddpg_params, env=make_env(), path=path + '/seed11', seed=11)
     # agent.run(test=True, load_network_ep=50, sleep=0.05)
-    seed_returns.append(agent.statistic_dict['epoch_test_return'])
-    seed_success_rates.append(agent.statistic_dict['epoch_test_success_rate'])
@@ -3,6 +3,7 @@
 import os
 import pybullet_envs
 from drl_implementation import DDPG, SAC, TD3
+from drl_implementation.runner import run_seeds, aggregate_statistics
 # you can replace the agent instantiation by one of the three above, with the proper params
 
 # td3_params = {
@@ -71,18 +72,22 @@ ddpg_params = {
     'saving_gap': 50,
 }
 seeds = [11, 22, 33, 44, 55, 66]
-seed_returns = []
 path = os.path.dirname(os.path.realpath(__file__))
-for seed in seeds:
 
-    env = pybullet_envs.make("InvertedPendulumSwingupBulletEnv-v0")
-    # call render() before training to visualize (pybullet-gym-specific)
-    # env.render()
-    seed_path = path + '/seed'+str(seed)
 
-    agent = DDPG(algo_params=ddpg_params, env=env, path=seed_path, seed=seed)
-    agent.run(test=False)
+def make_env():
+    return pybullet_envs.make("InvertedPendulumSwingupBulletEnv-v0")
+
+
+if __name__ == '__main__':
+    # the seeds are trained in parallel processes pinned to separate cores, see drl_implementation/runner.py
+    seed_statistics = run_seeds(DDPG, ddpg_params, make_env, seeds, path)
+    seed_returns = [seed_statistics[seed]['episode_return'] for seed in seeds]
+    aggregate_statistics(seed_statistics, keys=['episode_return', 'episode_test_return'], path=path)
+
+    # to visualize, call render() on the env before testing (pybullet-gym-specific)
     # the sleep argument pause the rendering for a while at every env step, useful for slowing down visualization
+    # env = make_env()
+    # env.render()
+    # agent = DDPG(algo_params=ddpg_params, env=env, path=path + '/seed11', seed=11)
     # agent.run(test=True, load_network_ep=50, sleep=0.05)
-    seed_returns.append(agent.statistic_dict['episode_return'])
-    del env, agent
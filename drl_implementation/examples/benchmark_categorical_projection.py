@@ -0,0 +1,96 @@
+# times the batched torch projection of DistributionalDDPG against the former numpy loop over atoms,
+#       across batch sizes and atom counts, run with python -m drl_implementation.examples.benchmark_categorical_projection
+#       the former projection and make_agent() are also used by tests/test_categorical_projection.py
+import time
+import types
+import numpy as np
+import torch as T
+from drl_implementation.agent.continuous_action.distributional_ddpg import DistributionalDDPG
+
+
+def numpy_projection(agent, value_dist, rewards, done):
+    # the former implementation, one masked scatter-add per atom on the cpu
+    copy_value_dist = value_dist.data.cpu().numpy()
+    copy_rewards = rewards.data.cpu().numpy()
+    copy_done = (1 - done).data.cpu().numpy().astype(bool)
+    batch_size, n_atoms = copy_value_dist.shape
+    projected_dist = np.zeros((batch_size, n_atoms), dtype=np.float32)
+    for atom in range(n_atoms):
+        atom_ = copy_rewards + (agent.value_min + atom * agent.delta_z) * agent.gamma
+        tz_j = np.clip(atom_, a_max=agent.value_max, a_min=agent.value_min)
+        b_j = (tz_j - agent.value_min) / agent.delta_z
+        l = np.floor(b_j).astype(np.int64)
+        u = np.ceil(b_j).astype(np.int64)
+        eq_mask = (u == l)
+        projected_dist[eq_mask, l[eq_mask]] += copy_value_dist[eq_mask, atom]
+        ne_mask = (u != l)
+        projected_dist[ne_mask, l[ne_mask]] += copy_value_dist[ne_mask, atom] * (u - b_j)[ne_mask]
+        projected_dist[ne_mask, u[ne_mask]] += copy_value_dist[ne_mask, atom] * (b_j - l)[ne_mask]
+    if copy_done.any():
+        projected_dist[copy_done] = 0.0
+        tz_j = np.clip(copy_rewards[copy_done], a_max=agent.value_max, a_min=agent.value_min)
+        b_j = (tz_j - agent.value_min) / agent.delta_z
+        l = np.floor(b_j).astype(np.int64)
+        u = np.ceil(b_j).astype(np.int64)
+        eq_mask = (u == l)
+        eq_dones = copy_done.copy()
+        eq_dones[copy_done] = eq_mask
+        if eq_dones.any():
+            projected_dist[eq_dones, l[eq_mask]] = 1.0
+        ne_mask = (u != l)
+        ne_dones = copy_done.copy()
+        ne_dones[copy_done] = ne_mask
+        if ne_dones.any():
+            projected_dist[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
+            projected_dist[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
+    return projected_dist
+
+
+def make_agent(num_atoms, value_min=-50.0, value_max=0.0, gamma=0.98, device=T.device('cpu')):
+    # only the attributes used by the projection
+    agent = types.SimpleNamespace(num_atoms=num_atoms, value_min=value_min, value_max=value_max, gamma=gamma)
+    agent.delta_z = (value_max - value_min) / (num_atoms - 1)
+    agent.discounted_support = T.tensor([(value_min + atom * agent.delta_z) * gamma for atom in range(num_atoms)],
+                                        dtype=T.float, device=device)
+    agent.terminal_dist = T.zeros(num_atoms, device=device)
+    agent.terminal_dist[0] = 1.0
+    return agent
+
+
+def timeit(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if T.cuda.is_available():
+        T.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1e6
+
+
+def main():
+    device = T.device("cuda" if T.cuda.is_available() else "cpu")
+    rng = np.random.default_rng(0)
+    print("device", device)
+    print("%6s %6s %14s %14s %10s" % ("batch", "atoms", "numpy (us)", "torch (us)", "max diff"))
+    for num_atoms in [11, 51, 101]:
+        agent = make_agent(num_atoms, device=device)
+        for batch_size in [64, 256, 1024, 4096]:
+            value_dist = T.softmax(T.as_tensor(rng.normal(size=(batch_size, num_atoms)), dtype=T.float, device=device), dim=1)
+            # integer rewards land exactly on atoms, to cover both the floor == ceiling and the terminal cases
+            rewards = T.as_tensor(np.where(rng.random(batch_size) < 0.5, rng.integers(-60, 5, batch_size),
+                                           rng.uniform(-60, 5, batch_size)), dtype=T.float, device=device)
+            done = T.as_tensor(rng.random(batch_size) > 0.1, dtype=T.float, device=device)
+
+            expected = numpy_projection(agent, value_dist, rewards, done)
+            projected = DistributionalDDPG.project_value_distribution(agent, value_dist, rewards, done)
+            max_diff = np.abs(projected.cpu().numpy() - expected).max()
+
+            repeats = 20 if batch_size > 1024 else 100
+            numpy_time = timeit(lambda: numpy_projection(agent, value_dist, rewards, done), repeats)
+            torch_time = timeit(lambda: DistributionalDDPG.project_value_distribution(agent, value_dist, rewards, done),
+                                repeats)
+            print("%6i %6i %14.1f %14.1f %10.2e" % (batch_size, num_atoms, numpy_time, torch_time, max_diff))
+
+
+if __name__ == '__main__':
+    main()
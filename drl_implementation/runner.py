@@ -0,0 +1,136 @@
+# run an agent with several seeds in parallel processes, each pinned to its own cores,
+#       e.g., python -m drl_implementation.runner --agent ddpg --params params.json --env my_envs:make_env --seeds 11 22 33 44
+
+import os
+import json
+import queue
+import argparse
+import importlib
+import multiprocessing as mp
+import numpy as np
+import torch as T
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .agent.utils.plot import get_mean_and_deviation
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def partition_cpus(num_slots, cpus=None):
+    # split the cores into $num_slots contiguous groups of (almost) equal sizes
+    if cpus is None:
+        cpus = available_cpus()
+    num_slots = max(1, min(num_slots, len(cpus)))
+    return [chunk.tolist() for chunk in np.array_split(np.array(cpus), num_slots)]
+
+
+# the cores of each worker process, taken by _init_worker() from the queue of core groups
+_worker_cpus = None
+
+
+def _init_worker(cpu_queue, timeout=10.0):
+    # a worker that finds no group left (e.g., one started to replace another) is not pinned and uses all the cores
+    global _worker_cpus
+    try:
+        _worker_cpus = cpu_queue.get(timeout=timeout)
+    except queue.Empty:
+        print("No group of cores left for worker process %i, it uses all the cores" % os.getpid())
+        _worker_cpus = available_cpus()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, _worker_cpus)
+    T.set_num_threads(len(_worker_cpus))
+
+
+def _run_seed(agent, algo_params, env_fn, path, seed):
+    if isinstance(agent, str):
+        from drl_implementation import agents
+        agent = agents[agent]
+    env = env_fn()
+    seed_path = os.path.join(path, 'seed'+str(seed))
+    seed_agent = agent(algo_params=dict(algo_params), env=env, path=seed_path, seed=seed)
+    seed_agent.run(test=False)
+    # the statistics are converted to lists when they are saved at the end of training
+    statistics = {key: np.array(value).tolist() for key, value in seed_agent.statistic_dict.items()}
+    env.close()
+    return statistics
+
+
+def run_seeds(agent, algo_params, env_fn, seeds, path, num_workers=None, start_method=None):
+    """
+    Trains $agent (a class or a key of drl_implementation.agents) with each of the $seeds, in at most $num_workers
+        processes (default: one per seed), each pinned to its own group of the available cores,
+        with as many torch threads as cores.
+    $env_fn makes the environment of a seed in its process,
+        it must be picklable for the 'spawn' and 'forkserver' start methods (e.g., a module-level function).
+    The data of a seed are saved in $path/seed<seed>, as in the examples.
+    Returns a dict of the statistic_dict of each seed, in the order of $seeds.
+    """
+    if num_workers is None:
+        num_workers = len(seeds)
+    cpu_groups = partition_cpus(min(num_workers, len(seeds)))
+    ctx = mp.get_context(start_method)
+    cpu_queue = ctx.Queue()
+    for cpus in cpu_groups:
+        cpu_queue.put(cpus)
+    results = {}
+    with ProcessPoolExecutor(max_workers=len(cpu_groups), mp_context=ctx,
+                             initializer=_init_worker, initargs=(cpu_queue,)) as executor:
+        futures = {executor.submit(_run_seed, agent, algo_params, env_fn, path, seed): seed for seed in seeds}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            print("Seed %i finished" % futures[future])
+    return {seed: results[seed] for seed in seeds}
+
+
+def aggregate_statistics(seed_statistics, keys=None, path=None):
+    """
+    Returns the mean, upper and lower bounds across seeds of each of the statistic $keys (default: all),
+        see .agent.utils.plot.get_mean_and_deviation, truncated to the shortest seed.
+    With $path, each is also saved to $path/<key>_mean_and_deviation.json.
+    """
+    statistics = list(seed_statistics.values())
+    if keys is None:
+        keys = statistics[0].keys()
+    aggregated = {}
+    for key in keys:
+        data = [seed_data[key] for seed_data in statistics]
+        length = min(len(d) for d in data)
+        if length == 0:
+            continue
+        file_name = None if path is None else os.path.join(path, key+'_mean_and_deviation.json')
+        aggregated[key] = get_mean_and_deviation(np.array([d[:length] for d in data]),
+                                                 save_data=path is not None, file_name=file_name)
+    return aggregated
+
+
+def _load_env_fn(name):
+    # module:function, e.g., my_envs:make_env
+    module, fn = name.split(':')
+    return getattr(importlib.import_module(module), fn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train an agent with several seeds in parallel processes')
+    parser.add_argument('--agent', required=True, help='a key of drl_implementation.agents, e.g., ddpg')
+    parser.add_argument('--params', required=True, help='a json file of the algo_params')
+    parser.add_argument('--env', required=True, help='module:function that makes an environment')
+    parser.add_argument('--seeds', type=int, nargs='+', required=True)
+    parser.add_argument('--path', default=os.getcwd())
+    parser.add_argument('--workers', type=int, default=None, help='number of seeds run at the same time')
+    parser.add_argument('--start-method', default=None, choices=['fork', 'spawn', 'forkserver'])
+    parser.add_argument('--keys', nargs='+', default=None, help='statistics to aggregate, default: all')
+    args = parser.parse_args()
+
+    algo_params = json.load(open(args.params, 'r'))
+    seed_statistics = run_seeds(args.agent, algo_params, _load_env_fn(args.env), args.seeds, args.path,
+                                num_workers=args.workers, start_method=args.start_method)
+    aggregated = aggregate_statistics(seed_statistics, keys=args.keys, path=args.path)
+    for key, statistics in aggregated.items():
+        print(key, "final mean %0.3f" % statistics['mean'][-1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# checks the compiled learner step of Agent with a stand-in for torch.compile,
+#   and the asynchronous learner with a stand-in for _learn
+import time
+import threading
+import numpy as np
+import torch as T
+import pytest
+from drl_implementation.agent.agent_base import Agent
+
+
+def algo_params(**kwargs):
+    params = {
+        'state_dim': 3, 'action_dim': 1, 'action_max': np.ones(1), 'action_scaling': 1.0,
+        'prioritised': False, 'memory_capacity': 1000, 'discount_factor': 0.98, 'discard_time_limit': False,
+        'observation_normalization': False, 'init_input_means': None, 'init_input_vars': None,
+        'actor_learning_rate': 1e-3, 'critic_learning_rate': 1e-3, 'update_interval': 1, 'batch_size': 8,
+        'optimization_steps': 1, 'tau': 0.05,
+    }
+    params.update(kwargs)
+    return params
+
+
+class StubAgent(Agent):
+    # _optimize counts its calls and returns its input doubled, _learn counts the updates of the learner thread
+    def __init__(self, path, learn_time=0.0, fail_after=None, **kwargs):
+        Agent.__init__(self, algo_params(**kwargs), path=path, seed=0)
+        self.eager_calls = 0
+        self.network_dict['actor'] = T.nn.Linear(3, 1)
+        self.acting_network_key = 'actor'
+        self.learn_time = learn_time
+        self.fail_after = fail_after
+        self.learn_steps = 0
+        self.learner_threads = set()
+
+    def _optimize(self, x):
+        self.eager_calls += 1
+        return 2 * x
+
+    def _learn(self, steps=None):
+        self.learner_threads.add(threading.current_thread())
+        if (self.fail_after is not None) and self.learn_steps >= self.fail_after:
+            raise ValueError("learning failed")
+        time.sleep(self.learn_time)
+        self.learn_steps += steps
+
+
+def fake_compile(fail_on_call=None):
+    # a compiled function that runs the eager one, and raises on its $fail_on_call-th call
+    def compile(fn, dynamic=None):
+        calls = []
+
+        def compiled(*args):
+            calls.append(None)
+            if len(calls) == fail_on_call:
+                raise RuntimeError("recompilation failed")
+            return fn(*args)
+        return compiled
+    return compile
+
+
+def test_compiled_learner_reports_its_timings(tmp_path, monkeypatch):
+    monkeypatch.setattr(T, 'compile', fake_compile())
+    agent = StubAgent(str(tmp_path), compile_learner=True, compile_warmup_steps=4)
+    for step in range(12):
+        assert agent._learn_step(step) == 2 * step
+    assert agent.compile_learner and agent.compiled_optimize is not None
+    report = agent.compile_report
+    assert set(report.keys()) == {'eager_step_time', 'compile_time', 'compiled_step_time', 'speedup',
+                                  'break_even_steps'}
+    assert np.isclose(report['speedup'], report['eager_step_time'] / report['compiled_step_time'])
+
+
+@pytest.mark.parametrize('fail_on_call', [1, 3, 7])
+def test_compiled_learner_falls_back_to_eager(tmp_path, monkeypatch, fail_on_call):
+    # the first compiled call fails, or one of the later ones, before or after the timings are reported
+    monkeypatch.setattr(T, 'compile', fake_compile(fail_on_call))
+    agent = StubAgent(str(tmp_path), compile_learner=True, compile_warmup_steps=4)
+    for step in range(15):
+        assert agent._learn_step(step) == 2 * step
+    assert not agent.compile_learner
+    assert agent.compiled_optimize is None
+    assert 'recompilation failed' in agent.compile_report['fallback']
+    # every step ran exactly once, the failed one again eagerly
+    assert agent.eager_calls == 15
+
+
+def test_async_learner_keeps_the_update_to_data_ratio(tmp_path):
+    agent = StubAgent(str(tmp_path), learn_time=1e-3, async_learner=True, utd_ratio=0.5, optimization_steps=2,
+                      async_max_lag=6, actor_sync_interval=10)
+    agent.warmup_step = 20
+    for _ in range(400):
+        agent._collector_step(1)
+        # the collector never runs more than async_max_lag updates ahead of the learner
+        assert agent._due_updates() <= agent.async_max_lag
+        assert agent.acting_network_key == 'acting_snapshot'
+        assert agent.network_dict['acting_snapshot'] is not agent.network_dict['actor']
+    agent._stop_async_learner()
+    # the updates due at the end are run before stopping, none before the warmup steps
+    assert agent.async_updates == agent.learn_steps == 0.5 * (400 - 20)
+    assert agent.learner_threads and all(not thread.is_alive() for thread in agent.learner_threads)
+    assert threading.current_thread() not in agent.learner_threads
+    assert agent.learner_thread is None
+    assert agent.acting_network_key == 'actor'
+    assert 'acting_snapshot' not in agent.network_dict
+
+
+def test_async_learner_errors_reach_the_collector(tmp_path):
+    agent = StubAgent(str(tmp_path), fail_after=10, async_learner=True, utd_ratio=1, optimization_steps=1,
+                      async_max_lag=2)
+    with pytest.raises(RuntimeError, match='learner thread failed') as error:
+        for _ in range(1000):
+            agent._collector_step(1)
+    assert isinstance(error.value.__cause__, ValueError)
+    assert agent.learn_steps == 10
+    with pytest.raises(RuntimeError, match='learner thread failed'):
+        agent._stop_async_learner()
+    assert agent.learner_thread is None
+    assert agent.acting_network_key == 'actor'
@@ -0,0 +1,52 @@
+# checks the batched torch projection of DistributionalDDPG against the former numpy loop over atoms
+import numpy as np
+import torch as T
+from drl_implementation.agent.continuous_action.distributional_ddpg import DistributionalDDPG
+from drl_implementation.examples.benchmark_categorical_projection import numpy_projection, make_agent
+
+
+def test_projection_matches_numpy_loop():
+    rng = np.random.default_rng(0)
+    for num_atoms in [11, 51, 101]:
+        agent = make_agent(num_atoms)
+        for batch_size in [1, 64, 256]:
+            value_dist = T.softmax(T.as_tensor(rng.normal(size=(batch_size, num_atoms)), dtype=T.float), dim=1)
+            # integer rewards land exactly on atoms, to cover both the floor == ceiling and the terminal cases
+            rewards = T.as_tensor(np.where(rng.random(batch_size) < 0.5, rng.integers(-60, 5, batch_size),
+                                           rng.uniform(-60, 5, batch_size)), dtype=T.float)
+            done = T.as_tensor(rng.random(batch_size) > 0.1, dtype=T.float)
+
+            expected = numpy_projection(agent, value_dist, rewards, done)
+            projected = DistributionalDDPG.project_value_distribution(agent, value_dist, rewards, done)
+            assert np.abs(projected.numpy() - expected).max() < 1e-5
+            assert np.allclose(projected.sum(dim=1).numpy(), 1.0, atol=1e-5)
+
+
+def test_projection_of_terminal_states():
+    agent = make_agent(11, value_min=-10.0, value_max=0.0, gamma=0.9)
+    value_dist = T.full((3, 11), 1.0 / 11)
+    rewards = T.tensor([-3.0, -2.5, 5.0])
+    done = T.zeros(3)
+    projected = DistributionalDDPG.project_value_distribution(agent, value_dist, rewards, done).numpy()
+    # the rewards -3 (atom 7), -2.5 (between atoms 7 and 8) and 5 (clipped to atom 10)
+    assert projected[0, 7] == 1.0 and projected[0].sum() == 1.0
+    assert np.isclose(projected[1, 7], 0.5) and np.isclose(projected[1, 8], 0.5)
+    assert projected[2, 10] == 1.0
+
+
+def test_projection_of_n_step_rows():
+    # a 3-step row stores done = gamma^2 and bootstraps with gamma^3, as a 1-step row of an agent with gamma^3 does
+    rng = np.random.default_rng(1)
+    gamma = 0.9
+    agent = make_agent(51, gamma=gamma)
+    agent_3 = make_agent(51, gamma=gamma ** 3)
+    value_dist = T.softmax(T.as_tensor(rng.normal(size=(32, 51)), dtype=T.float), dim=1)
+    rewards = T.as_tensor(rng.uniform(-10, 0, 32), dtype=T.float)
+    projected = DistributionalDDPG.project_value_distribution(agent, value_dist, rewards, T.full((32,), gamma ** 2))
+    expected = DistributionalDDPG.project_value_distribution(agent_3, value_dist, rewards, T.ones(32))
+    assert np.abs(projected.numpy() - expected.numpy()).max() < 1e-5
+    # and the terminal rows of an n-step batch are still projected on their rewards only
+    done = T.as_tensor(np.where(rng.random(32) < 0.5, 0.0, gamma ** 2), dtype=T.float)
+    projected = DistributionalDDPG.project_value_distribution(agent, value_dist, rewards, done)
+    terminal = DistributionalDDPG.project_value_distribution(agent, value_dist, rewards, T.zeros(32))
+    assert np.allclose(projected.numpy()[done.numpy() == 0], terminal.numpy()[done.numpy() == 0])
@@ -0,0 +1,53 @@
+# checks PolicyInference against a plain forward pass of the actor through the normalizer
+import numpy as np
+import torch as T
+from drl_implementation.agent.utils.networks_mlp import Actor, StochasticActor
+from drl_implementation.agent.utils.normalizer import RunningNormalizer
+from drl_implementation.agent.utils.inference import PolicyInference
+
+
+def plain_forward(actor, normalizer, obs):
+    with T.no_grad():
+        inputs = T.as_tensor(normalizer(obs), dtype=T.float)
+        if isinstance(actor, StochasticActor):
+            return actor.get_action(inputs, mean_pi=True).numpy()
+        return actor(inputs).numpy()
+
+
+def test_inference_matches_actor_forward():
+    T.manual_seed(0)
+    rng = np.random.default_rng(0)
+    actor = Actor(5, 2, action_scaling=2.0)
+    normalizer = RunningNormalizer(5, None, None, activated=True)
+    normalizer.update(rng.normal(loc=3.0, scale=2.0, size=(100, 5)))
+    inference = PolicyInference(actor, normalizer)
+    for obs in [rng.normal(size=5), rng.normal(size=(8, 5))]:
+        assert np.allclose(inference(obs), plain_forward(actor, normalizer, obs), atol=1e-5)
+    # clipped inputs are in the hundreds, where float32 addmm and linear round differently
+    obs = 1e4 * rng.normal(size=(3, 5))
+    assert np.allclose(inference(obs), plain_forward(actor, normalizer, obs), atol=1e-4)
+
+    stochastic_actor = StochasticActor(5, 2, -20, 2)
+    inference.set_actor(stochastic_actor)
+    obs = rng.normal(size=(4, 5))
+    assert np.allclose(inference(obs, deterministic=True), plain_forward(stochastic_actor, normalizer, obs), atol=1e-5)
+
+
+def test_inference_refreshes_on_actor_updates_only():
+    T.manual_seed(1)
+    rng = np.random.default_rng(1)
+    actor = Actor(5, 2)
+    normalizer = RunningNormalizer(5, None, None, activated=True)
+    inference = PolicyInference(actor, normalizer)
+    obs = rng.normal(size=5)
+    inference(obs)
+    weights = inference.weights
+    # new statistics are used without copying the weights again
+    normalizer.update(rng.normal(loc=1.0, size=(10, 5)))
+    assert np.allclose(inference(obs), plain_forward(actor, normalizer, obs), atol=1e-5)
+    assert inference.weights is weights
+    # an optimizer step on the actor is picked up
+    with T.no_grad():
+        actor.pi.bias.add_(1.0)
+    assert np.allclose(inference(obs), plain_forward(actor, normalizer, obs), atol=1e-5)
+    assert inference.weights is not weights
@@ -0,0 +1,48 @@
+# checks the fused critic ensemble against separate critics with the same weights
+import torch as T
+import torch.nn.functional as F
+from drl_implementation.agent.utils.networks_mlp import Critic, CriticEnsemble
+
+
+def ensemble_of(critics):
+    # an ensemble holding the weights of $critics
+    ensemble = CriticEnsemble(critics[0].fc1.in_features, critics[0].v.out_features, num_critics=len(critics))
+    with T.no_grad():
+        for i, critic in enumerate(critics):
+            for weight, bias, layer in zip(ensemble.weights, ensemble.biases,
+                                           [critic.fc1, critic.fc2, critic.fc3, critic.v]):
+                weight[i].copy_(layer.weight.t())
+                bias[i, 0].copy_(layer.bias)
+    return ensemble
+
+
+def test_ensemble_matches_separate_critics():
+    T.manual_seed(0)
+    critics = [Critic(7, 1) for _ in range(3)]
+    for critic in critics:
+        # non-zero biases, which orthogonal_init leaves at 0
+        for layer in [critic.fc1, critic.fc2, critic.fc3, critic.v]:
+            T.nn.init.normal_(layer.bias)
+    ensemble = ensemble_of(critics)
+
+    inputs = T.randn(16, 7)
+    outputs = ensemble(inputs)
+    assert outputs.shape == (3, 16, 1)
+    for i, critic in enumerate(critics):
+        assert T.allclose(outputs[i], critic(inputs), atol=1e-5)
+    # inputs split across the critics
+    split_inputs = T.randn(3, 16, 7)
+    outputs = ensemble(split_inputs)
+    for i, critic in enumerate(critics):
+        assert T.allclose(outputs[i], critic(split_inputs[i]), atol=1e-5)
+
+    # the sum of the losses gives each critic the gradient of its own loss, as in Agent._fused_critic_step()
+    target = T.randn(16, 1)
+    weights = T.rand(16, 1)
+    losses = F.mse_loss(ensemble(inputs), target.expand(3, -1, -1), reduction='none')
+    (losses * weights).mean(dim=(1, 2)).sum().backward()
+    for i, critic in enumerate(critics):
+        (F.mse_loss(critic(inputs), target, reduction='none') * weights).mean().backward()
+        for weight, bias, layer in zip(ensemble.weights, ensemble.biases, [critic.fc1, critic.fc2, critic.fc3, critic.v]):
+            assert T.allclose(weight.grad[i], layer.weight.grad.t(), atol=1e-5)
+            assert T.allclose(bias.grad[i, 0], layer.bias.grad, atol=1e-5)
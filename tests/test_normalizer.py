@@ -0,0 +1,81 @@
+# checks the running statistics of RunningNormalizer against the statistics of all the inputs at once,
+#   and TorchNormalizer against Normalizer.__call__
+import numpy as np
+import torch as T
+from drl_implementation.agent.utils.normalizer import Normalizer, RunningNormalizer, TorchNormalizer
+
+
+def test_running_statistics_match_full_batch():
+    rng = np.random.default_rng(0)
+    normalizer = RunningNormalizer(4, None, None, activated=True)
+    history_normalizer = Normalizer(4, None, None, activated=True)
+    # batches of different sizes, single inputs included, with a shift of the mean
+    batches = [rng.normal(loc=5.0, scale=3.0, size=(n, 4)) + shift for n, shift in [(1, 0), (50, 0), (1, 0),
+                                                                                      (7, 10), (300, -2)]]
+    for batch in batches:
+        normalizer.store_history(batch)
+        normalizer.update_mean()
+        for row in batch:
+            history_normalizer.store_history(row)
+        history_normalizer.update_mean()
+    inputs = np.concatenate(batches)
+    assert normalizer.sample_count == len(inputs)
+    assert np.allclose(normalizer.history_mean, inputs.mean(axis=0))
+    # history_var holds the standard deviation
+    assert np.allclose(normalizer.history_var, inputs.std(axis=0))
+    # Normalizer merges the variances without the shift between the batch means, so only the means agree
+    assert np.allclose(normalizer.history_mean, history_normalizer.history_mean)
+    test_inputs = rng.normal(size=(10, 4))
+    expected = np.clip((test_inputs - inputs.mean(axis=0)) / (inputs.std(axis=0) + normalizer.epsilon), -1e3, 1e3)
+    assert np.allclose(normalizer(test_inputs), expected)
+
+
+def test_statistics_are_updated_in_place():
+    normalizer = RunningNormalizer(3, None, None, activated=True)
+    mean, std = normalizer.history_mean, normalizer.history_var
+    version = normalizer.version
+    normalizer.update(np.ones((5, 3)))
+    normalizer.update(np.empty((0, 3)))
+    assert (normalizer.history_mean is mean) and (normalizer.history_var is std)
+    assert normalizer.version == version + 1
+    assert np.allclose(mean, 1.0) and np.allclose(std, 0.0)
+
+
+def test_torch_normalizer_matches_normalizer():
+    rng = np.random.default_rng(1)
+    for activated, clip_range, scale_factor in [(True, None, 1), (True, 0.5, 1), (True, 2.0, 3), (False, None, 2)]:
+        normalizer = RunningNormalizer(4, None, None, activated=activated,
+                                       clip_range=clip_range, scale_factor=scale_factor)
+        normalizer.update(rng.normal(loc=2.0, scale=3.0, size=(100, 4)))
+        torch_normalizer = TorchNormalizer(4)
+        torch_normalizer.sync(normalizer)
+        assert torch_normalizer.version == normalizer.version
+        inputs = rng.normal(loc=2.0, scale=5.0, size=(32, 4))
+        expected = normalizer(inputs)
+
+        # normalized in place
+        tensor = T.as_tensor(inputs, dtype=T.float32)
+        assert torch_normalizer(tensor) is tensor
+        assert np.allclose(tensor.numpy(), expected, atol=1e-5)
+
+        # only the first input_dims features of the inputs with actions appended
+        actions = rng.normal(size=(32, 2))
+        tensor = T.as_tensor(np.concatenate((inputs, actions), axis=1), dtype=T.float32)
+        torch_normalizer(tensor)
+        assert np.allclose(tensor[:, :4].numpy(), expected, atol=1e-5)
+        assert np.allclose(tensor[:, 4:].numpy(), actions, atol=1e-6)
+
+        # a first layer folded with the statistics takes the raw inputs, as long as they are not clipped
+        linear = T.nn.Linear(6, 3)
+        folded = torch_normalizer.fold_into(linear)
+        raw = T.as_tensor(np.concatenate((normalizer.history_mean + 0.1 * rng.normal(size=(8, 4)),
+                                          rng.normal(size=(8, 2))), axis=1), dtype=T.float32)
+        with T.no_grad():
+            assert T.allclose(folded(raw), linear(torch_normalizer(raw.clone())), atol=1e-5)
+
+    # new statistics are picked up by the next sync
+    normalizer.activated = True
+    normalizer.update(rng.normal(loc=-4.0, size=(10, 4)))
+    torch_normalizer.sync(normalizer)
+    tensor = T.as_tensor(inputs, dtype=T.float32)
+    assert np.allclose(torch_normalizer(tensor).numpy(), normalizer(inputs), atol=1e-5)
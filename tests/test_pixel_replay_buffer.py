@@ -0,0 +1,83 @@
+# checks the frame-deduplicated pixel buffer against the stacks it was given
+import numpy as np
+import pytest
+from drl_implementation.agent.utils.replay_buffer import make_buffer, PixelReplayBuffer
+
+
+def stacked_episodes(rng, lengths, frame_stack=3, shape=(2, 4, 4), floats=False):
+    # (state, next_state) stacks of the episodes of a FrameStack wrapper, which repeats the reset frame
+    for length in lengths:
+        if floats:
+            frames = rng.integers(0, 256, size=(length + 1,) + shape) / 255.0
+        else:
+            frames = rng.integers(0, 256, size=(length + 1,) + shape).astype(np.uint8)
+        stack = [frames[0]] * frame_stack
+        for t in range(length):
+            state = np.concatenate(stack, axis=0)
+            stack = stack[1:] + [frames[t + 1]]
+            yield state, np.concatenate(stack, axis=0)
+
+
+def to_uint8(stack):
+    return stack if stack.dtype == np.uint8 else np.round(stack * 255).astype(np.uint8)
+
+
+def store(buffer, transitions):
+    # the action of a transition is its number, to find its stacks in the sampled batches
+    expected = []
+    for state, next_state in transitions:
+        buffer.store_experience(state, np.array([len(expected)]), next_state, 0.0, 1)
+        expected.append((to_uint8(state), to_uint8(next_state)))
+    return expected
+
+
+def assert_batch_matches(batch, expected):
+    for state, action, next_state in zip(batch.state, batch.action, batch.next_state):
+        expected_state, expected_next_state = expected[int(action[0])]
+        assert state.dtype == np.uint8
+        assert np.array_equal(state, expected_state)
+        assert np.array_equal(next_state, expected_next_state)
+
+
+def test_pixel_buffer_returns_the_stored_stacks():
+    t = make_buffer(1).Transition
+    rng = np.random.default_rng(0)
+    for floats in [False, True]:
+        buffer = PixelReplayBuffer(1000, t, frame_stack=3, seed=0)
+        lengths = [10, 1, 25, 7]
+        expected = store(buffer, stacked_episodes(rng, lengths, floats=floats))
+        # the reset frame is stored once per episode, then one new frame per step
+        assert buffer.frame_count == sum(length + 1 for length in lengths)
+        memory = buffer.get_experiences(0, len(buffer))
+        assert_batch_matches(memory, expected)
+        assert_batch_matches(buffer.sample(200), expected)
+
+    # a state that does not continue the previous transition has all its frames stored
+    buffer = PixelReplayBuffer(100, t, frame_stack=3)
+    transitions = list(stacked_episodes(rng, [4]))
+    expected = store(buffer, [transitions[0], transitions[2], transitions[3]])
+    assert buffer.frame_count == 2 + (3 + 1) + 1
+    assert_batch_matches(buffer.get_experiences(0, 3), expected)
+
+
+def test_pixel_buffer_skips_overwritten_frames():
+    t = make_buffer(1).Transition
+    rng = np.random.default_rng(1)
+    # room for the frames of the last ~170 of the 200 transitions
+    buffer = PixelReplayBuffer(200, t, frame_stack=3, frame_capacity=180, seed=0)
+    expected = store(buffer, stacked_episodes(rng, [20] * 10))
+    valid = buffer._valid(np.arange(len(buffer)))
+    assert 0 < valid.sum() < len(buffer)
+    # only the most recent transitions are left
+    assert valid[-valid.sum():].all()
+    assert_batch_matches(buffer.get_experiences(len(buffer) - valid.sum(), len(buffer)), expected)
+    for _ in range(20):
+        batch = buffer.sample(64)
+        assert_batch_matches(batch, expected)
+        assert (batch.action[:, 0] >= len(buffer) - valid.sum()).all()
+
+    # a frame store too small for any transition
+    buffer = PixelReplayBuffer(200, t, frame_stack=3, frame_capacity=2)
+    store(buffer, stacked_episodes(rng, [20]))
+    with pytest.raises(AssertionError):
+        buffer.sample(8)
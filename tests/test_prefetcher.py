@@ -0,0 +1,50 @@
+# checks that prefetched batches keep their own indices and weights, and that the thread hands its errors over
+import numpy as np
+import pytest
+from drl_implementation.agent.utils.replay_buffer import make_buffer, PrioritisedArrayReplayBuffer
+from drl_implementation.agent.utils.prefetcher import BatchPrefetcher
+
+
+def test_prefetched_prioritised_batches_keep_their_indices_and_weights():
+    t = make_buffer(1).Transition
+    buffer = PrioritisedArrayReplayBuffer(200, t, rng=np.random.default_rng(0))
+    # the state of a transition is its storage index, and every transition has its own priority
+    num = 150
+    buffer.store_experiences(np.arange(num)[:, None] * np.ones(3), np.zeros((num, 2)), np.zeros((num, 3)),
+                             np.zeros(num), np.ones(num))
+    priorities = np.random.default_rng(1).uniform(0.1, 5, size=num)
+    buffer.update_priority(np.arange(num), priorities)
+    probabilities = (priorities + buffer.epsilon) ** buffer.alpha
+    probabilities /= probabilities.sum()
+    expected_weights = (probabilities * num) ** -buffer.beta / (probabilities.min() * num) ** -buffer.beta
+
+    prefetcher = BatchPrefetcher(lambda: buffer.sample(32), num_batches=3)
+    try:
+        for _ in range(50):
+            batch, weights, inds = prefetcher.get()
+            assert (batch.state[:, 0] == inds).all()
+            assert np.allclose(weights, expected_weights[inds])
+    finally:
+        prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    assert prefetcher.queue.empty()
+    with pytest.raises(RuntimeError, match='closed'):
+        prefetcher.get()
+
+
+def test_sampler_errors_are_raised_by_get():
+    calls = []
+
+    def sample():
+        calls.append(len(calls))
+        if len(calls) == 3:
+            raise ValueError("sampling failed")
+        return calls[-1]
+
+    prefetcher = BatchPrefetcher(sample, num_batches=1)
+    assert prefetcher.get() == 0
+    assert prefetcher.get() == 1
+    with pytest.raises(RuntimeError) as error:
+        prefetcher.get()
+    assert isinstance(error.value.__cause__, ValueError)
+    prefetcher.close()
@@ -0,0 +1,197 @@
+# checks the replay buffers against direct computations of what they should store or sample
+import numpy as np
+import pytest
+from drl_implementation.agent.utils.replay_buffer import make_buffer, ReplayBuffer, ArrayReplayBuffer, \
+    PrioritisedReplayBuffer, PrioritisedMemmapReplayBuffer, goal_distance_reward
+
+
+def test_array_buffer_matches_list_buffer():
+    t = make_buffer(1).Transition
+    list_buffer = ReplayBuffer(50, t)
+    array_buffer = ArrayReplayBuffer(50, t)
+    rng = np.random.default_rng(0)
+    # single stores, a bulk store that wraps around the end and one larger than the capacity
+    for num, bulk in [(30, False), (35, True), (120, True), (7, False)]:
+        columns = (rng.normal(size=(num, 3)), rng.normal(size=(num, 2)), rng.normal(size=(num, 3)),
+                   rng.normal(size=num), rng.integers(0, 2, size=num))
+        for buffer in [list_buffer, array_buffer]:
+            if bulk:
+                buffer.store_experiences(*columns)
+            else:
+                for row in zip(*columns):
+                    buffer.store_experience(*row)
+        assert len(array_buffer) == len(list_buffer)
+        assert array_buffer.position == list_buffer.position
+        for stored, expected in zip(array_buffer.get_experiences(0, len(array_buffer)),
+                                    list_buffer.get_experiences(0, len(list_buffer))):
+            assert np.allclose(stored, expected)
+
+    batch = array_buffer.sample(16)
+    assert all(len(column) == 16 for column in batch)
+    assert batch.state.dtype == np.float32 and batch.state.shape == (16, 3)
+
+
+def test_prioritised_sampling_matches_scalar_tree_queries():
+    t = make_buffer(1).Transition
+    rng = np.random.default_rng(0)
+    buffer = PrioritisedReplayBuffer(100, t, rng=np.random.default_rng(1))
+    for i in range(70):
+        buffer.store_experience(np.full(3, i), np.zeros(2), np.zeros(3), 0.0, 1)
+    inds = rng.integers(0, 70, size=40)
+    priorities = rng.uniform(0, 5, size=40)
+    buffer.update_priority(inds, priorities)
+
+    # the same priorities written one at a time, the last write of a duplicated index wins
+    # stored with the initial max priority of 1
+    expected_priorities = np.ones(70)
+    for ind, priority in zip(inds, priorities):
+        expected_priorities[ind] = (priority + buffer.epsilon) ** buffer.alpha
+    assert np.allclose(buffer.sum_tree[np.arange(70)], expected_priorities)
+    assert np.isclose(buffer.sum_tree.sum(), expected_priorities.sum())
+    assert np.isclose(buffer.min_tree.min(), expected_priorities.min())
+
+    batch, weights, sampled_inds = buffer.sample(32, beta=0.6)
+    # the former sampling, one stratified mass and one tree descent per batch element
+    masses = np.random.default_rng(1).uniform(size=32)
+    interval = buffer.sum_tree.sum() / 32
+    expected_inds = [min(buffer.sum_tree.find_prefixsum_idx((i + mass) * interval), 69)
+                     for i, mass in enumerate(masses)]
+    assert (sampled_inds == expected_inds).all()
+    probabilities = expected_priorities / expected_priorities.sum()
+    max_weight = (probabilities.min() * 70) ** -0.6
+    assert np.allclose(weights, (probabilities[expected_inds] * 70) ** -0.6 / max_weight)
+    assert np.allclose(np.array(batch.state)[:, 0], expected_inds)
+
+
+def test_prioritised_buffers_sample_alike(tmp_path):
+    # the list and memmap buffers share their sampling, so the same priorities and seed give the same batches
+    t = make_buffer(1).Transition
+    list_buffer = PrioritisedReplayBuffer(100, t, rng=np.random.default_rng(1))
+    memmap_buffer = PrioritisedMemmapReplayBuffer(100, t, str(tmp_path), rng=np.random.default_rng(1), write_chunk=8)
+    rng = np.random.default_rng(0)
+    columns = (np.arange(60)[:, None] * np.ones(3), np.zeros((60, 2)), np.zeros((60, 3)), np.zeros(60), np.ones(60))
+    for buffer in [list_buffer, memmap_buffer]:
+        buffer.store_experiences(*columns)
+    inds = rng.integers(0, 60, size=30)
+    priorities = rng.uniform(0, 5, size=30)
+    for buffer in [list_buffer, memmap_buffer]:
+        buffer.update_priority(inds, priorities)
+    assert np.allclose(memmap_buffer.priority[:60], list_buffer.sum_tree[np.arange(60)])
+    for _ in range(3):
+        list_batch, list_weights, list_inds = list_buffer.sample(16, beta=0.6)
+        memmap_batch, memmap_weights, memmap_inds = memmap_buffer.sample(16, beta=0.6)
+        assert (list_inds == memmap_inds).all()
+        assert np.allclose(list_weights, memmap_weights)
+        assert np.allclose(np.array(list_batch.state), memmap_batch.state)
+
+
+def store_goal_episodes(buffer, lengths):
+    # the state and achieved goal of step t of episode e encode (e, t), the desired goals are never achieved
+    for e, length in enumerate(lengths):
+        for t in range(length):
+            buffer.new_episode = (t == 0)
+            buffer.store_experience(np.array([e, t], dtype=float), np.full(2, -1.0), np.zeros(1),
+                                    np.array([e, t + 1], dtype=float), np.array([e, t + 1], dtype=float), -1.0, 1)
+        buffer.store_episodes()
+
+
+def test_sample_time_relabelling():
+    for strategy in ['future', 'episode', 'final']:
+        # the capacity is not a multiple of the episode lengths, so the oldest episodes are partially overwritten
+        buffer = make_buffer(230, goal_conditioned=True, relabel_at_sample=True, sampling_strategy=strategy)
+        lengths = [50, 20, 50, 35, 50, 50, 50]
+        store_goal_episodes(buffer, lengths)
+        batch = buffer.sample(20000)
+        episode, step = batch.state[:, 0], batch.state[:, 1]
+        relabelled = batch.desired_goal[:, 0] >= 0
+        # relabelled goals are achieved goals of the same episode
+        assert (batch.desired_goal[relabelled, 0] == episode[relabelled]).all()
+        goal_step = batch.desired_goal[relabelled, 1] - 1
+        if strategy == 'future':
+            assert (goal_step > step[relabelled]).all()
+        elif strategy == 'final':
+            ends = np.array(lengths)[episode[relabelled].astype(int)] - 1
+            assert (goal_step == ends).all()
+        assert np.allclose(batch.reward, goal_distance_reward(batch.desired_goal, batch.achieved_goal))
+        # the proportion of HindsightReplayBuffer, k / (k + 1), except for the last steps with the 'future' strategy
+        has_goal = np.ones(len(step), dtype=bool)
+        if strategy == 'future':
+            has_goal = step < np.array(lengths)[episode.astype(int)] - 1
+        assert abs(relabelled[has_goal].mean() - 0.8) < 0.02
+        assert not relabelled[~has_goal].any()
+
+    buffer = make_buffer(230, goal_conditioned=True, relabel_at_sample=True, hindsight=False)
+    store_goal_episodes(buffer, [50, 50])
+    assert (buffer.sample(1000).desired_goal == -1).all()
+
+
+def test_n_step_returns_match_direct_sums():
+    n_step, gamma = 3, 0.9
+    rng = np.random.default_rng(0)
+    buffer = make_buffer(1000, storage='array', n_step=n_step, gamma=gamma)
+    # two episodes of 50 and 7 steps, the second one ending at a terminal state
+    episodes = []
+    for length, terminal in [(50, False), (7, True)]:
+        states = rng.normal(size=(length + 1, 2))
+        rewards = rng.uniform(-1, 1, length)
+        for t in range(length):
+            done = 0 if (terminal and t == length - 1) else 1
+            buffer.store_experience(states[t], np.zeros(1), states[t + 1], rewards[t], done)
+        episodes.append((states, rewards, terminal))
+    buffer.flush_windows()
+
+    memory = buffer.full_memory
+    row = 0
+    for states, rewards, terminal in episodes:
+        length = len(rewards)
+        for t in range(length):
+            m = min(n_step, length - t)
+            assert np.allclose(memory.state[row], states[t])
+            assert np.allclose(memory.next_state[row], states[t + m])
+            assert np.isclose(memory.reward[row], np.sum(rewards[t:t + m] * gamma ** np.arange(m)), atol=1e-5)
+            expected_done = 0.0 if (terminal and t + m == length) else gamma ** (m - 1)
+            assert np.isclose(memory.done[row], expected_done)
+            row += 1
+    assert row == len(buffer)
+
+
+def store_transitions(buffer, num, state_dim=3, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = (rng.normal(size=(num, state_dim)), rng.normal(size=(num, 2)), rng.normal(size=(num, state_dim)),
+               rng.normal(size=num), rng.integers(0, 2, size=num))
+    for row in zip(*columns):
+        buffer.store_experience(*row)
+    return columns
+
+
+def test_memmap_buffer_reopens_flushed_transitions(tmp_path):
+    # fewer transitions than one write chunk, so they are only written by flush()
+    buffer = make_buffer(5000, storage='memmap', saving_path=str(tmp_path))
+    columns = store_transitions(buffer, 300)
+    assert len(buffer) == 0
+    buffer.flush()
+    assert len(buffer) == 300
+
+    resumed = make_buffer(5000, storage='memmap', saving_path=str(tmp_path), resume=True)
+    assert len(resumed) == 300
+    for stored, column in zip(resumed.full_memory, columns):
+        assert np.allclose(stored, column)
+    # new transitions continue after the resumed ones
+    store_transitions(resumed, 10, seed=1)
+    resumed.flush()
+    assert len(resumed) == 310
+
+    # without resume, the files are reused as an empty buffer
+    assert len(make_buffer(5000, storage='memmap', saving_path=str(tmp_path))) == 0
+    assert len(make_buffer(5000, storage='memmap', saving_path=str(tmp_path), resume=True)) == 0
+
+
+def test_memmap_buffer_rejects_other_layouts(tmp_path):
+    buffer = make_buffer(5000, storage='memmap', saving_path=str(tmp_path))
+    store_transitions(buffer, 20)
+    buffer.flush()
+    with pytest.raises(AssertionError):
+        make_buffer(4000, storage='memmap', saving_path=str(tmp_path), resume=True)
+    resumed = make_buffer(5000, storage='memmap', saving_path=str(tmp_path), resume=True)
+    with pytest.raises(AssertionError):
+        store_transitions(resumed, 1, state_dim=4)
@@ -0,0 +1,101 @@
+# checks the sharded dataset format against the transitions of the saved buffers
+import os
+import json
+import numpy as np
+from drl_implementation.agent.utils.replay_buffer import make_buffer, ReplayBuffer, ArrayReplayBuffer, \
+    PrioritisedReplayBuffer, PrioritisedArrayReplayBuffer, store_rows
+from drl_implementation.agent.utils.replay_dataset import save_dataset, load_dataset
+
+
+def random_columns(num, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.normal(size=(num, 3)).astype(np.float32), rng.normal(size=(num, 2)).astype(np.float32),
+            rng.normal(size=(num, 3)).astype(np.float32), rng.normal(size=num).astype(np.float32),
+            rng.integers(0, 2, size=num).astype(np.float32))
+
+
+def assert_holds(buffer, columns):
+    assert len(buffer) == len(columns[0])
+    for stored, column in zip(buffer.get_experiences(0, len(buffer)), columns):
+        assert np.allclose(stored, column)
+
+
+def test_dataset_round_trip(tmp_path):
+    t = make_buffer(1).Transition
+    columns = random_columns(250)
+    source = ArrayReplayBuffer(1000, t)
+    source.store_experiences(*columns)
+    manifest = save_dataset(source, str(tmp_path), shard_size=64)
+
+    with open(os.path.join(str(tmp_path), 'manifest.json'), 'r') as f:
+        assert json.load(f) == manifest
+    assert manifest['num_transitions'] == 250 and manifest['num_shards'] == 4
+    assert manifest['layouts']['state'] == {'shape': [3], 'dtype': np.dtype(np.float32).str}
+    assert np.load(os.path.join(str(tmp_path), 'state_00003.npy')).shape == (250 - 3 * 64, 3)
+
+    for mmap in [False, True]:
+        for buffer in [ReplayBuffer(1000, t), ArrayReplayBuffer(1000, t),
+                       PrioritisedReplayBuffer(1000, t), PrioritisedArrayReplayBuffer(1000, t)]:
+            assert load_dataset(buffer, str(tmp_path), mmap=mmap) == 250
+            assert_holds(buffer, columns)
+    # the loaded transitions get the max priority
+    assert np.allclose(buffer.sum_tree[np.arange(250)], 1.0)
+
+    # loading stops in the middle of a shard
+    buffer = ArrayReplayBuffer(1000, t)
+    assert load_dataset(buffer, str(tmp_path), mmap=True, max_transitions=100) == 100
+    assert_holds(buffer, [column[:100] for column in columns])
+
+    # a range of the storage
+    save_dataset(source, str(tmp_path / 'range'), shard_size=64, start=30, end=200)
+    buffer = ArrayReplayBuffer(1000, t)
+    assert load_dataset(buffer, str(tmp_path / 'range')) == 170
+    assert_holds(buffer, [column[30:200] for column in columns])
+
+
+def test_empty_and_former_datasets(tmp_path):
+    t = make_buffer(1).Transition
+    manifest = save_dataset(ArrayReplayBuffer(100, t), str(tmp_path / 'empty'))
+    assert manifest['num_transitions'] == 0 and manifest['num_shards'] == 0
+    buffer = ReplayBuffer(100, t)
+    assert load_dataset(buffer, str(tmp_path / 'empty')) == 0
+    assert len(buffer) == 0
+
+    # the files of the former save_as_npy, one per field
+    columns = random_columns(40)
+    for name, column in zip(t._fields, columns):
+        np.save(os.path.join(str(tmp_path), name), column)
+    buffer = ArrayReplayBuffer(100, t, saving_path=str(tmp_path))
+    assert buffer.load_from_npy() == 40
+    assert_holds(buffer, columns)
+
+
+def test_save_and_load_from_npy(tmp_path):
+    t = make_buffer(1).Transition
+    columns = random_columns(80)
+    buffer = ReplayBuffer(100, t, saving_path=str(tmp_path))
+    buffer.store_experiences(*columns)
+    buffer.save_as_npy(shard_size=32)
+    assert os.path.exists(os.path.join(str(tmp_path), 'done_00002.npy'))
+    loaded = PrioritisedArrayReplayBuffer(100, t, saving_path=str(tmp_path))
+    assert loaded.load_from_npy(mmap=True) == 80
+    assert_holds(loaded, columns)
+
+
+def test_store_rows_matches_single_stores():
+    rng = np.random.default_rng(0)
+    for capacity in [1, 7, 20]:
+        memory, expected = [], []
+        position = expected_position = 0
+        for num in rng.integers(0, 3 * capacity, size=30):
+            rows = list(rng.integers(0, 1000, size=num))
+            positions, position = store_rows(memory, capacity, position, rows)
+            for row in rows:
+                if len(expected) < capacity:
+                    expected.append(None)
+                expected[expected_position] = row
+                expected_position = (expected_position + 1) % capacity
+            assert memory == expected
+            assert position == expected_position
+            kept = rows[len(rows) - len(positions):]
+            assert [memory[i] for i in positions] == kept
@@ -0,0 +1,124 @@
+# checks that the replay server of the distributed agents stores every chunk sent by the workers,
+#   and that the workers count the transitions they send and drop
+import time
+import queue
+import threading
+import multiprocessing as mp
+import numpy as np
+from collections import namedtuple
+from drl_implementation.agent.distributed_agent_base import ReplayServer, Worker
+from drl_implementation.agent.utils.shared_buffers import SharedBatchRing
+from drl_implementation.agent.utils.replay_buffer import PrioritisedArrayReplayBuffer
+
+t = namedtuple("transition", ('state', 'action', 'next_state', 'reward', 'done'))
+columns = [('state', (3,), np.float32), ('action', (2,), np.float32), ('next_state', (3,), np.float32),
+           ('reward', (), np.float32), ('done', (), np.float32), ('weights', (), np.float32), ('inds', (), np.int64)]
+
+
+def make_chunk(size):
+    return [np.random.rand(size, 3), np.random.rand(size, 2), np.random.rand(size, 3), np.random.rand(size),
+            np.ones(size)], np.random.rand(size)
+
+
+def test_chunks_sent_after_the_learner_has_finished_are_stored():
+    queues = {'replay_queue': mp.Queue(4), 'priority_queue': mp.Queue(4), 'learner_step_count': mp.Value('i', 0),
+              'batch_ring': SharedBatchRing(2, 16, columns)}
+
+    def learner():
+        for _ in range(10):
+            slot, batch = queues['batch_ring'].get(timeout=10)
+            queues['priority_queue'].put((batch[6].numpy().copy(), np.full(16, 2.0)))
+            queues['batch_ring'].release(slot)
+        queues['learner_step_count'].value = 10
+
+    chunks = [make_chunk(32) for _ in range(10)]
+
+    def worker():
+        for chunk in chunks[:5]:
+            queues['replay_queue'].put(chunk)
+        learner_thread.join()
+        # the last chunks arrive after the learner has finished
+        for chunk in chunks[5:]:
+            queues['replay_queue'].put(chunk)
+        queues['replay_queue'].put(None)
+
+    learner_thread = threading.Thread(target=learner)
+    worker_thread = threading.Thread(target=worker)
+    learner_thread.start()
+    worker_thread.start()
+    buffer = PrioritisedArrayReplayBuffer(1000, t)
+    ReplayServer(buffer, queues, 16, 10, num_workers=1, prioritised=True, store_with_given_priority=True).run()
+    worker_thread.join()
+    assert len(buffer) == 320
+    # the chunks are stored in the order they were sent, with their priorities unless the learner has updated them
+    for stored, column in zip(buffer.full_memory, zip(*[chunk[0] for chunk in chunks])):
+        assert np.allclose(stored, np.concatenate(column))
+    priorities = (np.concatenate([chunk[1] for chunk in chunks]) + buffer.epsilon) ** buffer.alpha
+    updated = np.isclose(buffer.sum_tree[np.arange(320)], (2.0 + buffer.epsilon) ** buffer.alpha)
+    assert np.allclose(buffer.sum_tree[np.arange(320)][~updated], priorities[~updated])
+
+
+def make_worker(tmp_path, replay_queue, policy, chunk_size=4, learner_steps=10):
+    algo_params = {
+        'worker_update_gap': 1, 'learner_steps': learner_steps, 'worker_chunk_size': chunk_size,
+        'replay_queue_policy': policy, 'state_dim': 3, 'action_dim': 2, 'action_max': np.ones(2),
+        'action_scaling': 1.0, 'observation_normalization': False, 'init_input_means': None,
+        'init_input_vars': None, 'discount_factor': 0.98, 'tau': 0.05,
+    }
+    queues = {'replay_queue': replay_queue, 'learner_step_count': mp.Value('i', 0),
+              'sent_transitions': mp.Value('q', 0), 'dropped_transitions': mp.Value('q', 0)}
+    return Worker(algo_params, queues, path=str(tmp_path))
+
+
+def remember(worker, num, start=0):
+    for i in range(start, start + num):
+        worker._remember({'transition': (np.full(3, i), np.zeros(2), np.full(3, i + 1), float(i), 1.0),
+                          'priority': float(i)})
+
+
+def test_drop_policy_counts_the_dropped_transitions(tmp_path):
+    replay_queue = queue.Queue(maxsize=2)
+    worker = make_worker(tmp_path, replay_queue, 'drop')
+    # three full chunks and one partial chunk sent when the worker finishes, the queue only takes two
+    remember(worker, 13)
+    worker._flush_chunk()
+    assert worker.queues['sent_transitions'].value == 8
+    assert worker.queues['dropped_transitions'].value == worker.dropped_transitions == 5
+    for i in range(2):
+        columns, priorities = replay_queue.get_nowait()
+        assert np.array_equal(columns[0][:, 0], np.arange(4 * i, 4 * i + 4))
+        assert np.array_equal(priorities, np.arange(4 * i, 4 * i + 4))
+    # there is room again
+    remember(worker, 2, start=13)
+    worker._flush_chunk()
+    assert worker.queues['sent_transitions'].value == 10
+    assert worker.queues['dropped_transitions'].value == 5
+    columns, priorities = replay_queue.get_nowait()
+    assert np.array_equal(columns[3], [13.0, 14.0])
+
+
+def test_block_policy_waits_for_room(tmp_path):
+    replay_queue = queue.Queue(maxsize=1)
+    worker = make_worker(tmp_path, replay_queue, 'block')
+    received = []
+
+    def replay_process():
+        # starts consuming late, the worker waits instead of dropping
+        time.sleep(0.3)
+        for _ in range(3):
+            received.append(replay_queue.get(timeout=5.0))
+
+    consumer = threading.Thread(target=replay_process)
+    consumer.start()
+    remember(worker, 12)
+    consumer.join()
+    assert worker.queues['sent_transitions'].value == 12
+    assert worker.queues['dropped_transitions'].value == 0
+    assert np.array_equal(np.concatenate([chunk[0][0][:, 0] for chunk in received]), np.arange(12))
+
+    # once the learner has finished, a chunk that finds no room is dropped instead of blocking forever
+    replay_queue.put(None)
+    worker.queues['learner_step_count'].value = 10
+    remember(worker, 4)
+    assert worker.queues['sent_transitions'].value == 12
+    assert worker.queues['dropped_transitions'].value == 4
@@ -0,0 +1,49 @@
+# checks the aggregation of the statistics of several seeds and the partition of the cores
+import os
+import json
+import queue
+import numpy as np
+import torch as T
+import drl_implementation.runner as runner
+from drl_implementation.runner import aggregate_statistics, partition_cpus
+
+
+def test_aggregate_statistics_truncates_to_the_shortest_seed(tmp_path):
+    rng = np.random.default_rng(0)
+    seed_statistics = {seed: {'episode_return': rng.normal(size=length).tolist(), 'critic_loss': []}
+                       for seed, length in [(11, 10), (22, 7), (33, 12)]}
+    aggregated = aggregate_statistics(seed_statistics, path=str(tmp_path))
+    # statistics that no seed recorded are skipped
+    assert list(aggregated.keys()) == ['episode_return']
+    data = np.array([seed_statistics[seed]['episode_return'][:7] for seed in [11, 22, 33]])
+    statistics = aggregated['episode_return']
+    assert np.allclose(statistics['mean'], data.mean(axis=0))
+    assert np.allclose(statistics['upper'], data.max(axis=0))
+    assert np.allclose(statistics['lower'], data.min(axis=0))
+    with open(os.path.join(str(tmp_path), 'episode_return_mean_and_deviation.json'), 'r') as f:
+        assert json.load(f) == statistics
+
+
+def test_partition_cpus():
+    groups = partition_cpus(3, cpus=list(range(8)))
+    assert groups == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    # never more groups than cores
+    assert partition_cpus(5, cpus=[2, 3]) == [[2], [3]]
+    assert partition_cpus(1, cpus=[4, 5]) == [[4, 5]]
+
+
+def test_worker_without_a_group_of_cores_uses_all_of_them():
+    num_threads = T.get_num_threads()
+    cpu_queue = queue.Queue()
+    try:
+        cpu_queue.put(runner.available_cpus())
+        runner._init_worker(cpu_queue, timeout=0.1)
+        assert runner._worker_cpus == runner.available_cpus()
+        # the queue is empty now, the initializer falls back instead of blocking
+        runner._worker_cpus = None
+        runner._init_worker(cpu_queue, timeout=0.1)
+        assert runner._worker_cpus == runner.available_cpus()
+        assert T.get_num_threads() == len(runner.available_cpus())
+    finally:
+        T.set_num_threads(num_threads)
+        runner._worker_cpus = None
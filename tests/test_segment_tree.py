@@ -0,0 +1,47 @@
+# checks the batched segment tree operations against their scalar counterparts
+import numpy as np
+from drl_implementation.agent.utils.segment_tree import SumSegmentTree, MinSegmentTree
+
+
+def test_set_many_matches_sequential_sets():
+    rng = np.random.default_rng(0)
+    for tree_class in [SumSegmentTree, MinSegmentTree]:
+        tree = tree_class(64)
+        sequential_tree = tree_class(64)
+        for _ in range(5):
+            # duplicated indexes take the last value, as with sequential sets
+            inds = rng.integers(0, 50, size=30)
+            values = rng.uniform(0, 10, size=30)
+            tree.set_many(inds, values)
+            for ind, value in zip(inds, values):
+                sequential_tree[ind] = value
+            assert np.allclose(tree._value, sequential_tree._value)
+    tree.set_many([], [])
+    assert np.allclose(tree._value, sequential_tree._value)
+
+
+def test_reductions_match_numpy():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(0, 10, size=40)
+    sum_tree, min_tree = SumSegmentTree(64), MinSegmentTree(64)
+    sum_tree.set_many(np.arange(40), values)
+    min_tree.set_many(np.arange(40), values)
+    assert np.isclose(sum_tree.sum(), values.sum())
+    assert np.isclose(min_tree.min(), values.min())
+    for start, end in [(0, 40), (3, 17), (10, 11), (25, 40)]:
+        assert np.isclose(sum_tree.sum(start, end), values[start:end].sum())
+        assert np.isclose(min_tree.min(start, end), values[start:end].min())
+
+
+def test_batched_descent_matches_scalar_descent():
+    rng = np.random.default_rng(2)
+    values = rng.uniform(0, 10, size=100)
+    # zero priorities must never be returned
+    values[rng.integers(0, 100, size=10)] = 0.0
+    tree = SumSegmentTree(128)
+    tree.set_many(np.arange(100), values)
+    prefixsums = np.concatenate([rng.uniform(0, tree.sum(), size=500), [0.0, tree.sum()], np.cumsum(values)[:-1]])
+    inds = tree.find_prefixsum_idx_batch(prefixsums)
+    assert (inds == [tree.find_prefixsum_idx(prefixsum) for prefixsum in prefixsums]).all()
+    inside = prefixsums < tree.sum()
+    assert (values[inds[inside]] > 0).all()
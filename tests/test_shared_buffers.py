@@ -0,0 +1,95 @@
+# checks the shared-memory parameter store and batch ring of the distributed agents
+import os
+import pickle
+import pytest
+import numpy as np
+import torch as T
+import multiprocessing as mp
+from drl_implementation.agent.utils.shared_buffers import SharedParameterStore, SharedBatchRing
+
+
+def test_read_only_new_versions():
+    store = SharedParameterStore()
+    reader = pickle.loads(pickle.dumps(store))
+    try:
+        assert reader.read() is None
+        store.write([T.ones(2, 3), T.zeros(2)])
+        assert np.array_equal(reader.read(sizes=[6, 2]), [1, 1, 1, 1, 1, 1, 0, 0])
+        assert reader.read() is None
+        store.write([T.full((2, 3), 2.0), T.ones(2)])
+        assert np.array_equal(reader.read(), [2, 2, 2, 2, 2, 2, 1, 1])
+    finally:
+        reader.close()
+        store.close()
+
+
+def test_layout_mismatch():
+    store = SharedParameterStore()
+    reader = pickle.loads(pickle.dumps(store))
+    try:
+        store.write([T.ones(2, 3), T.zeros(2)])
+        # same number of parameters, different tensors
+        with pytest.raises(ValueError):
+            reader.read(sizes=[2, 6])
+        with pytest.raises(AssertionError):
+            store.write([T.ones(8)])
+    finally:
+        reader.close()
+        store.close()
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason="POSIX shared memory files are not in /dev/shm")
+def test_attach_before_the_segment_is_sized():
+    store = SharedParameterStore()
+    # a segment that exists but has not been sized yet by the writer
+    open(os.path.join('/dev/shm', store.name), 'w').close()
+    try:
+        assert store.read() is None
+    finally:
+        os.remove(os.path.join('/dev/shm', store.name))
+
+
+def make_ring(num_slots=2):
+    return SharedBatchRing(num_slots, 4, [('state', (3,), np.float32), ('inds', (), np.int64)])
+
+
+def test_batch_ring_slots_are_shared_until_released():
+    ring = make_ring()
+    try:
+        assert ring.put(np.ones((4, 3)), np.arange(4))
+        slot, (state, inds) = ring.get(timeout=1.0)
+        assert np.array_equal(state.numpy(), np.ones((4, 3))) and np.array_equal(inds.numpy(), np.arange(4))
+        # the tensors share the memory of the slot
+        assert state.data_ptr() == ring.views(slot)['state'].ctypes.data
+        ring.views(slot)['state'][0, 0] = 5.0
+        assert state[0, 0] == 5.0
+
+        # no batch ready
+        assert ring.get(timeout=0.05) == (None, None)
+        # the slot of the batch being used is not refilled until it is released
+        assert ring.put(np.zeros((4, 3)), np.zeros(4))
+        assert not ring.put(np.zeros((4, 3)), np.zeros(4), timeout=0.05)
+        ring.release(slot)
+        assert ring.put(np.full((4, 3), 2.0), np.zeros(4), timeout=1.0)
+    finally:
+        ring.close()
+
+
+def fill_ring(ring, num_batches):
+    for i in range(num_batches):
+        ring.put(np.full((4, 3), i), np.full(4, i))
+
+
+def test_batch_ring_take_copies_and_releases():
+    ring = make_ring()
+    # filled by another process, while the batches taken so far are kept
+    process = mp.get_context('fork').Process(target=fill_ring, args=(ring, 10))
+    process.start()
+    try:
+        batches = [ring.take(T.device('cpu'), timeout=5.0) for _ in range(10)]
+        for i, (state, inds) in enumerate(batches):
+            assert (state == i).all() and (inds == i).all()
+        assert ring.take(T.device('cpu'), timeout=0.05) is None
+    finally:
+        process.join()
+        ring.close()
@@ -0,0 +1,39 @@
+# checks the fused target network updates against the former per-parameter soft update
+import copy
+import torch as T
+from drl_implementation.agent.utils.networks_mlp import Actor, Critic
+from drl_implementation.agent.utils.target_update import soft_update, PolyakAveraging
+
+
+def loop_soft_update(source, target, tau):
+    # the former Agent._soft_update
+    for target_param, param in zip(target.parameters(), source.parameters()):
+        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+
+
+def test_polyak_averaging_matches_loop():
+    T.manual_seed(0)
+    sources = [Actor(5, 2), Critic(7, 1)]
+    targets = [Actor(5, 2), Critic(7, 1)]
+    expected = copy.deepcopy(targets)
+    averaging = PolyakAveraging()
+    for source, target in zip(sources, targets):
+        averaging.register(source, target)
+    for _ in range(10):
+        for source in sources:
+            with T.no_grad():
+                for param in source.parameters():
+                    param.add_(T.randn_like(param) * 0.1)
+        averaging.update(0.05)
+        for source, target in zip(sources, expected):
+            loop_soft_update(source, target, 0.05)
+    for target, expected_target in zip(targets, expected):
+        for param, expected_param in zip(target.parameters(), expected_target.parameters()):
+            assert T.allclose(param, expected_param, atol=1e-6)
+
+
+def test_hard_update_copies():
+    source, target = Critic(7, 1), Critic(7, 1)
+    soft_update(list(target.parameters()), list(source.parameters()), 1)
+    for param, source_param in zip(target.parameters(), source.parameters()):
+        assert T.equal(param, source_param)
@@ -0,0 +1,112 @@
+# checks the subprocess vector env against the in-process one, including overlapping steps of groups of envs
+import time
+import numpy as np
+import pytest
+from drl_implementation.agent.utils.vector_env import VectorEnv, SubprocVectorEnv
+
+
+class Box(object):
+    def __init__(self, n):
+        self.shape = (n,)
+        self.high = np.ones(n, dtype=np.float32)
+        self.low = -self.high
+
+
+class Limit(object):
+    def __init__(self):
+        self.steps = 10
+
+
+class CountingEnv(object):
+    # obs: the number of steps, reward: 1 + the sum of the action, slow enough for the steps of two groups to overlap
+    observation_space = Box(3)
+    action_space = Box(2)
+    distance_threshold = 0.05
+
+    def __init__(self):
+        self.limit = Limit()
+
+    def shorten(self, steps):
+        self.limit.steps -= steps
+        return self.limit.steps
+
+    def seed(self, seed=None):
+        pass
+
+    def reset(self):
+        self.t = 0
+        return np.zeros(3, dtype=np.float32)
+
+    def step(self, action):
+        time.sleep(0.05)
+        self.t += 1
+        return np.full(3, self.t, dtype=np.float32), 1.0 + float(np.sum(action)), self.t >= self.limit.steps, {}
+
+    def close(self):
+        pass
+
+
+def test_step_matches_vector_env():
+    envs = VectorEnv([CountingEnv for _ in range(5)])
+    subproc_envs = SubprocVectorEnv([CountingEnv for _ in range(5)], envs_per_worker=2)
+    try:
+        envs.reset()
+        subproc_envs.reset()
+        actions = np.random.uniform(-1, 1, (5, 2))
+        active = np.array([1, 0, 1, 1, 0], dtype=bool)
+        obs, rewards, dones, _ = envs.step(actions, active)
+        subproc_obs, subproc_rewards, subproc_dones, _ = subproc_envs.step(actions, active)
+        assert np.allclose(obs, subproc_obs)
+        assert np.allclose(rewards, subproc_rewards)
+        assert (dones == subproc_dones).all()
+    finally:
+        subproc_envs.close()
+
+
+def test_overlapping_groups():
+    subproc_envs = SubprocVectorEnv([CountingEnv for _ in range(4)], envs_per_worker=2)
+    try:
+        subproc_envs.reset()
+        group_a = np.array([1, 1, 0, 0], dtype=bool)
+        group_b = ~group_a
+        actions = np.ones((4, 2))
+        # group b is started while group a is still simulating
+        subproc_envs.step_async(actions, group_a)
+        subproc_envs.step_async(actions * 2, group_b)
+        obs, rewards, _, _ = subproc_envs.step_wait(active=group_a)
+        assert np.allclose(obs[group_a], 1.0)
+        assert np.allclose(rewards, [3.0, 3.0, 0.0, 0.0])
+        obs, rewards, _, _ = subproc_envs.step_wait()
+        assert np.allclose(obs, 1.0)
+        assert np.allclose(rewards, [0.0, 0.0, 5.0, 5.0])
+        # the groups are stepped again in the other order
+        subproc_envs.step_async(actions * 2, group_b)
+        subproc_envs.step_async(actions, group_a)
+        obs, rewards, _, _ = subproc_envs.step_wait()
+        assert np.allclose(obs, 2.0)
+        assert np.allclose(rewards, [3.0, 3.0, 5.0, 5.0])
+    finally:
+        subproc_envs.close()
+
+
+def test_calls_and_attributes_reach_every_env():
+    for envs in [VectorEnv([CountingEnv for _ in range(5)]),
+                 SubprocVectorEnv([CountingEnv for _ in range(5)], envs_per_worker=2)]:
+        try:
+            assert envs.distance_threshold == 0.05
+            # the methods of a single environment are not forwarded
+            with pytest.raises(AttributeError):
+                envs.shorten(1)
+            with pytest.raises(AttributeError):
+                envs.limit
+            assert envs.call('shorten', 2) == [8] * 5
+            envs.set_attr('limit.steps', [1, 2, 3, 4, 5])
+            assert envs.get_attr('limit.steps') == [1, 2, 3, 4, 5]
+            with pytest.raises(AttributeError):
+                envs.call('missing_method')
+            # the new limits are used by the environments
+            envs.reset()
+            _, _, dones, _ = envs.step(np.zeros((5, 2)))
+            assert (dones == [True, False, False, False, False]).all()
+        finally:
+            envs.close()